@@ -1,4 +1,4 @@
-import string, urllib2, re, os, logging, mosHelper
+import string, urllib2, re, os, logging, mosHelper, runstats
 
 # written Sep 2013
 # last updated: Nov 2016
@@ -276,15 +276,24 @@ def GrabEm():
 
                 # Note that in order to reach this part of the script, the file
                 # size must pass the above if-else.
-                response = urllib2.urlopen(furl)
-                contents = response.read()
-                response.close()
+                with runstats.stage('fetch', key = furl) as st:
+                    response = urllib2.urlopen(furl)
+                    contents = response.read()
+                    response.close()
+                    st.nbytes = len(contents)
 
                 module_logger.info('Writing to %s', localfilename)
                 fullname = os.path.join(dictDirNames['raw'], localfilename)
-                output = open(fullname, 'w')
+                # Write to a temporary file first and then swap it in, so that
+                # anyone else reading the raw files directory (e.g., the other
+                # nodes, see sharding) never reads half a file
+                tempname = fullname + '.tmp'
+                output = open(tempname, 'w')
                 output.write(contents)
                 output.close()
+                if os.path.exists(fullname):
+                    os.remove(fullname)
+                os.rename(tempname, fullname)
                 rawfiles.append(localfilename)
                     
         else:
@@ -0,0 +1,446 @@
+import os, json, signal, logging, argparse, multiprocessing
+import datetime as dt
+import numpy as np
+import mosHelper, scheduler
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # New in Python 3.8. Without it, there is no --pipeline mode.
+    shared_memory = None
+
+# Rebuild the graphics for past cycles, e.g. after a failed run or after adding
+# stations to mosHelper.setStations.
+#
+# Example: remake a week of MAV and MEX graphics for the SGF stations plus KSTL
+#     python backfill.py --start 2014020100 --end 2014020712 --mos MAV MEX --groups SGF --stations KSTL
+#
+# Raw files still on disk are used, and so are the older cycles that
+# purge.cleanHouse has put in the daily bundles (see mosbundle). The work is
+# done in two steps, each spread across all of the CPUs:
+# 1. parse: split each raw file in the date range (and the history before it)
+#    into processed files for the requested stations. Raw files whose processed
+#    files all exist are skipped.
+# 2. render: make the images and JSON for each station, MOS type, and cycle.
+#    The latest cycle on disk goes to the images directory as usual. Older
+#    cycles go to images/backfill/YYYYMMDD_CC so they don't overwrite it.
+#
+# Finished render jobs are recorded in state/backfill.json. If a backfill is
+# interrupted, run the same command again and it picks up where it stopped
+# (use --restart to redo everything). A job is redone if its raw file changed.
+#
+# Don't run a backfill while a scheduled run might clear the processed files
+# out from under it.
+#
+# With --pipeline, step 2 is split in two: 'arrays' workers build each
+# station's display arrays and put them in a block of shared memory, and
+# 'render' workers draw from that block without copying it. Only a small
+# description of the block (its name and where each array is) goes through
+# the queue between them, instead of the arrays themselves. At most
+# pipelineDepth blocks per worker are waiting to be rendered at once.
+
+moslist = scheduler.moslist
+
+# Each graphic also needs the cycles before it, going back this many hours for
+# the MEX (see mosplots.calc_dates), so those raw files get parsed too.
+historyHours = 180
+
+
+def ledgerPath():
+    # Full path of the record of finished backfill jobs
+    scheduler.ledgerPath()      # creates the state directory
+    return os.path.join(mosHelper.getDirNames()['state'], 'backfill.json')
+
+
+def loadLedger():
+    # Returns a dictionary of {job key: raw file signature} for every finished
+    # render job.
+    fullname = ledgerPath()
+    if not os.path.exists(fullname):
+        return {}
+    try:
+        fileobj = open(fullname, 'r')
+        ledger = json.load(fileobj)
+        fileobj.close()
+    except ValueError:
+        logging.getLogger('mosgraphics.backfill').warning('Could not read %s. Starting a new one.', fullname)
+        ledger = {}
+    return ledger
+
+
+def saveLedger(ledger):
+    # Same as scheduler.saveLedger, but for the backfill ledger
+    fullname = ledgerPath()
+    tempname = fullname + '.tmp'
+    fileobj = open(tempname, 'w')
+    json.dump(ledger, fileobj, indent = 0, sort_keys = True)
+    fileobj.close()
+    if os.path.exists(fullname):
+        os.remove(fullname)
+    os.rename(tempname, fullname)
+
+
+def rawCycle(rawfile):
+    # Returns the model cycle of a raw file as a datetime object.
+    dictParms = mosHelper.transformFilename(rawfile)
+    return dt.datetime(int(dictParms['year']), int(dictParms['month']), int(dictParms['day']), int(dictParms['cycle']))
+
+
+def findRawFiles(mostypes, start, end):
+    # Returns a dictionary of {MOS type: sorted list of raw filenames} for the
+    # raw files on disk or in the daily bundles with cycles from 'start' to
+    # 'end' (datetime objects, inclusive).
+    import mosbundle
+    dictRaw = {}
+    for mostype in mostypes:
+        rawfiles = set(mosHelper.listRawFiles(mostype)).union(mosbundle.listBundled(mostype))
+        dictRaw[mostype] = sorted(fn for fn in rawfiles if start <= rawCycle(fn) <= end)
+    return dictRaw
+
+
+def rawSignature(rawfile):
+    # Same as scheduler.rawSignature, or the signature the raw file had when
+    # it was bundled if it isn't on disk anymore
+    if os.path.exists(os.path.join(mosHelper.getDirNames()['raw'], rawfile)):
+        return scheduler.rawSignature(rawfile)
+    import mosbundle
+    return mosbundle.bundledSignature(rawfile)
+
+
+def initWorker(logqueue):
+    # Leave Ctrl-C to the main process, which stops the workers itself, and
+    # log through the main process's log queue (mosHelper.logQueue)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    mosHelper.setUpWorkerLogger(logqueue)
+
+
+def parseJob(job):
+    # Split one raw file into processed files for the given stations.
+    # Runs in a worker process.
+    # Returns (raw filename, error message or None).
+    #
+    # 'job' is a tuple of (raw filename, list of stations).
+    rawfile, stations = job
+    try:
+        fullname = os.path.join(mosHelper.getDirNames()['raw'], rawfile)
+        if os.path.exists(fullname):
+            mosHelper.parseRawFile(set(stations), fullname)
+        else:
+            # Only these stations are read out of the bundle
+            import mosbundle
+            mosbundle.parseBundled(set(stations), rawfile)
+    except Exception as e:
+        return rawfile, '%s: %s' % (type(e).__name__, e)
+    return rawfile, None
+
+
+def renderJob(job):
+    # Make the images and JSON for one station, MOS type, and cycle.
+    # Runs in a worker process.
+    # Returns (job key, error message or None).
+    #
+    # 'job' is a tuple of (job key, processed filename, directory for the output).
+    import mosplots
+    key, procfile, imgdir = job
+    try:
+        if not os.path.isdir(imgdir):
+            try:
+                os.makedirs(imgdir)
+            except OSError:
+                # Another worker made it first
+                pass
+        plotme, xdt, info, prev = mosplots.makeDisplayArrays(procfile)
+        mosplots.makePlots(plotme, xdt, info, prev, imgdir)
+        mosplots.exportJSON(plotme, xdt, info, prev, imgdir)
+    except Exception as e:
+        return key, '%s: %s' % (type(e).__name__, e)
+    return key, None
+
+
+# Blocks of shared memory waiting to be rendered, per worker (see --pipeline)
+pipelineDepth = 2
+
+
+def shareArrays(displayArrays):
+    # Copy the display arrays (as returned by mosplots.makeDisplayArrays) into
+    # one new block of shared memory.
+    # Returns a description of the block for attachArrays: (name of the
+    # block, list of (wx element, offset, shape, dtype)).
+    # Keep the order: makePlots draws them in this order
+    wxelements = list(displayArrays.keys())
+    arrays = [np.ascontiguousarray(displayArrays[wx]) for wx in wxelements]
+    block = shared_memory.SharedMemory(create = True, size = max(sum(arr.nbytes for arr in arrays), 1))
+    # The main process unlinks the block once it has been rendered (see
+    # renderPipeline), so this process shouldn't clean it up when it exits
+    resource_tracker.unregister(block._name, 'shared_memory')
+    layout = []
+    offset = 0
+    for wx, arr in zip(wxelements, arrays):
+        view = np.ndarray(arr.shape, dtype = arr.dtype, buffer = block.buf, offset = offset)
+        view[...] = arr
+        layout.append((wx, offset, arr.shape, arr.dtype.str))
+        offset = offset + arr.nbytes
+    del view
+    block.close()
+    return block.name, layout
+
+
+def attachArrays(description):
+    # Returns (block, dictionary of display arrays) for a block of shared
+    # memory described by shareArrays. The arrays are views of the block, so
+    # drop them before closing it.
+    name, layout = description
+    block = shared_memory.SharedMemory(name = name)
+    # Same as in shareArrays
+    resource_tracker.unregister(block._name, 'shared_memory')
+    displayArrays = {}
+    for wx, offset, shape, dtype in layout:
+        displayArrays[wx] = np.ndarray(shape, dtype = np.dtype(dtype), buffer = block.buf, offset = offset)
+    return block, displayArrays
+
+
+def unlinkArrays(description):
+    # Free a block of shared memory described by shareArrays.
+    block = shared_memory.SharedMemory(name = description[0])
+    block.close()
+    block.unlink()
+
+
+def arraysJob(job):
+    # Build the display arrays for one station, MOS type, and cycle and put
+    # them in shared memory. Runs in a worker process (see --pipeline).
+    # Returns (render job, description of the block or None, the rest of
+    # what makeDisplayArrays returned or an error message).
+    #
+    # 'job' is a render job (see renderJob).
+    import mosplots
+    key, procfile, imgdir = job
+    try:
+        plotme, xdt, info, prev = mosplots.makeDisplayArrays(procfile)
+        return job, shareArrays(plotme), (xdt, info, prev)
+    except Exception as e:
+        return job, None, '%s: %s' % (type(e).__name__, e)
+
+
+def renderSharedJob(job, description, rest):
+    # Make the images and JSON from display arrays in shared memory. Runs in
+    # a worker process (see --pipeline).
+    # Returns (job key, error message or None).
+    import mosplots
+    key, procfile, imgdir = job
+    try:
+        if not os.path.isdir(imgdir):
+            try:
+                os.makedirs(imgdir)
+            except OSError:
+                # Another worker made it first
+                pass
+        block, plotme = attachArrays(description)
+        try:
+            xdt, info, prev = rest
+            mosplots.makePlots(plotme, xdt, info, prev, imgdir)
+            mosplots.exportJSON(plotme, xdt, info, prev, imgdir)
+        finally:
+            del plotme
+            block.close()
+    except Exception as e:
+        return key, '%s: %s' % (type(e).__name__, e)
+    return key, None
+
+
+def renderPipeline(arraysPool, renderjobs, processes):
+    # Same as running renderJob over 'renderjobs' in 'arraysPool', but with
+    # the display arrays built there and drawn by a second pool, handed over
+    # in shared memory (see --pipeline).
+    # Yields (job key, error message or None) as each job finishes.
+    renderPool = multiprocessing.Pool(processes, initWorker, (mosHelper.logQueue,))
+    depth = pipelineDepth * (processes or multiprocessing.cpu_count())
+    pending = []
+    try:
+        for job, description, rest in arraysPool.imap_unordered(arraysJob, renderjobs):
+            if description is None:
+                yield job[0], rest
+                continue
+            pending.append((description, renderPool.apply_async(renderSharedJob, (job, description, rest))))
+            # Don't let the blocks pile up faster than they're rendered
+            while len(pending) >= depth:
+                description, result = pending.pop(0)
+                try:
+                    yield result.get()
+                finally:
+                    unlinkArrays(description)
+        while pending:
+            description, result = pending.pop(0)
+            try:
+                yield result.get()
+            finally:
+                unlinkArrays(description)
+        renderPool.close()
+    except:
+        renderPool.terminate()
+        for description, result in pending:
+            unlinkArrays(description)
+        raise
+    finally:
+        renderPool.join()
+
+
+def findRenderJobs(mostypes, stations, dictRaw, ledger, restart = False):
+    # Returns a list of render jobs (see renderJob) for every station, MOS
+    # type, and cycle that isn't in the ledger yet (or all of them, if
+    # 'restart' is True), and a dictionary of {job key: raw file signature}
+    # to record in the ledger when they finish.
+    #
+    # 'dictRaw' is the dictionary returned by findRawFiles.
+    module_logger = logging.getLogger('mosgraphics.backfill')
+    dictDirNames = mosHelper.getDirNames()
+    procfiles = set(os.listdir(dictDirNames['proc']))
+
+    renderjobs = []
+    signatures = {}
+    for mostype in mostypes:
+        # The latest cycle on disk goes where the viewer looks for it
+        latest = sorted(mosHelper.listRawFiles(mostype))[-1:]
+        for rawfile in dictRaw[mostype]:
+            cycle = rawCycle(rawfile)
+            if rawfile in latest:
+                imgdir = dictDirNames['img']
+            else:
+                imgdir = os.path.join(dictDirNames['img'], 'backfill', cycle.strftime('%Y%m%d_%H'))
+            signature = rawSignature(rawfile)
+            for sta in stations:
+                procfile = mosHelper.makeFilenames(mostype, sta, cycle.year, cycle.month, cycle.day, '%02d' % cycle.hour)['proc']
+                if procfile not in procfiles:
+                    module_logger.info('%s isn\'t in %s', sta, rawfile)
+                    continue
+                key = '%s %s' % (procfile, imgdir)
+                signatures[key] = signature
+                if restart or (ledger.get(key) != signature):
+                    renderjobs.append((key, procfile, imgdir))
+
+    return renderjobs, signatures
+
+
+def backfill(mostypes, stations, start, end, processes = None, restart = False, pipeline = False):
+    # Parse and render every cycle of 'mostypes' from 'start' to 'end'
+    # (datetime objects, inclusive) for 'stations' (a list of station IDs),
+    # using 'processes' worker processes (default: one per CPU). If
+    # 'pipeline' is True, hand the display arrays from one set of workers to
+    # another in shared memory (see --pipeline).
+    # Returns the number of jobs that failed.
+    module_logger = logging.getLogger('mosgraphics.backfill')
+    dictDirNames = mosHelper.getDirNames()
+    stations = sorted(set(stations))
+    dictRaw = findRawFiles(mostypes, start, end)
+
+    # Parse the raw files that are missing processed files for any of the stations
+    dictHistory = findRawFiles(mostypes, start - dt.timedelta(hours = historyHours), end)
+    procfiles = set(os.listdir(dictDirNames['proc']))
+    parsejobs = []
+    for mostype in mostypes:
+        for rawfile in dictHistory[mostype]:
+            cycle = rawCycle(rawfile)
+            missing = [sta for sta in stations if mosHelper.makeFilenames(mostype, sta, cycle.year, cycle.month, cycle.day, '%02d' % cycle.hour)['proc'] not in procfiles]
+            if restart:
+                missing = stations
+            if missing:
+                parsejobs.append((rawfile, missing))
+
+    module_logger.info('Backfilling %s from %s to %s for %d stations: %d raw files to parse',
+                       mostypes, start, end, len(stations), len(parsejobs))
+
+    ledger = loadLedger()
+    failed = 0
+    pool = multiprocessing.Pool(processes, initWorker, (mosHelper.logQueue,))
+    try:
+        # Step 1: everything has to be parsed before anything can be rendered,
+        # because each graphic needs the previous cycles too.
+        for rawfile, error in pool.imap_unordered(parseJob, parsejobs):
+            if error is not None:
+                failed = failed + 1
+                module_logger.warning('Could not parse %s: %s', rawfile, error)
+
+        # Step 2: render, recording each finished job so an interrupted
+        # backfill can pick up where it left off
+        renderjobs, signatures = findRenderJobs(mostypes, stations, dictRaw, ledger, restart)
+        module_logger.info('%d station cycles to render', len(renderjobs))
+        if pipeline:
+            results = renderPipeline(pool, renderjobs, processes)
+        else:
+            results = pool.imap_unordered(renderJob, renderjobs)
+        count = 0
+        for key, error in results:
+            count = count + 1
+            if error is None:
+                ledger[key] = signatures[key]
+            else:
+                failed = failed + 1
+                module_logger.warning('Could not render %s: %s', key.split(' ')[0], error)
+            if count % 50 == 0:
+                saveLedger(ledger)
+                module_logger.info('Rendered %d of %d station cycles', count, len(renderjobs))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        saveLedger(ledger)
+
+    module_logger.info('Backfill done. %d jobs failed.', failed)
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Remake the graphics for past cycles from the raw files on disk.')
+    parser.add_argument('--start', required = True,
+                        help = 'first cycle as YYYYMMDDHH')
+    parser.add_argument('--end', default = None,
+                        help = 'last cycle as YYYYMMDDHH (default: now)')
+    parser.add_argument('--mos', nargs = '+', default = moslist,
+                        help = 'MOS types (default: %s)' % ' '.join(moslist))
+    parser.add_argument('--stations', nargs = '+', default = [],
+                        help = 'station IDs')
+    parser.add_argument('--groups', nargs = '+', default = [],
+                        help = 'station groups from mosHelper.setStations (e.g., LSX SGF)')
+    parser.add_argument('--cwa', nargs = '+', default = [],
+                        help = 'every station in these CWAs (see stationcatalog)')
+    parser.add_argument('--state', nargs = '+', default = [],
+                        help = 'every station in these states (e.g., MO IL)')
+    parser.add_argument('--processes', type = int, default = None,
+                        help = 'worker processes (default: one per CPU)')
+    parser.add_argument('--restart', action = 'store_true',
+                        help = 'ignore what earlier backfills finished and redo everything')
+    parser.add_argument('--pipeline', action = 'store_true',
+                        help = 'build the display arrays and render them in separate workers, handing them over in shared memory')
+    args = parser.parse_args()
+    if args.pipeline and (shared_memory is None):
+        parser.error('--pipeline needs Python 3.8 or newer')
+
+    logger = mosHelper.setUpTheLogger()
+
+    stations = list(args.stations)
+    CWAlist = mosHelper.setStations()
+    for group in args.groups:
+        stations.extend(CWAlist[group])
+    if args.cwa or args.state:
+        import stationcatalog
+        stations.extend(stationcatalog.loadCatalog().select(cwas = args.cwa, states = args.state))
+    if not stations:
+        parser.error('give some --stations, --groups, --cwa, and/or --state')
+
+    start = dt.datetime.strptime(args.start, '%Y%m%d%H')
+    if args.end is None:
+        end = dt.datetime.utcnow()
+    else:
+        end = dt.datetime.strptime(args.end, '%Y%m%d%H')
+
+    try:
+        failed = backfill([m.upper() for m in args.mos], stations, start, end, args.processes, args.restart, args.pipeline)
+    except KeyboardInterrupt:
+        logger.info('Interrupted. Run the same command again to pick up where this left off.')
+        failed = 1
+    finally:
+        logging.shutdown()
+
+    raise SystemExit(min(failed, 1))
@@ -0,0 +1,237 @@
+import os, json, time, socket, logging
+import mosHelper
+
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+# Keep runs that overlap from stepping on each other.
+#
+# A scheduled run can take longer than the time between runs. Without this,
+# the second run would fetch the same files, make the same graphics, and clear
+# the processed files while the first run is still reading them.
+#
+# Instead, the first run holds a lock on a file in the state directory for as
+# long as it runs, and puts the (MOS type, station) pairs it has to plot in a
+# queue on disk (a JSON file next to the lock). Any run that starts while the
+# lock is held doesn't fetch, doesn't look for new work, and doesn't clean up.
+# It just claims jobs from the queue that nobody has claimed yet and makes
+# those graphics, so an overlapping run speeds up the first one instead of
+# repeating it. The first run waits for every claimed job to finish before it
+# cleans up and lets go of the lock.
+#
+# The locks are released by the operating system if a run dies, so a crash
+# never leaves a stale lock behind. A claim that hasn't finished after
+# claimTimeout seconds is up for grabs again.
+
+# Name of the run lock and the queue in the state directory. Each node gets
+# its own when the stations are split across nodes (see sharding).
+lockName = 'run.lock'
+queueName = 'queue.json'
+
+# Seconds to wait between looks at the queue
+pollInterval = 5
+
+# Seconds after which a claimed job that hasn't finished can be claimed again
+# (e.g., the run that claimed it died). One station takes a few seconds.
+claimTimeout = 600
+
+
+def statePath(filename):
+    # Full path of a file in the state directory. Creates the directory if needed.
+    dictDirNames = mosHelper.getDirNames()
+    if not os.path.isdir(dictDirNames['state']):
+        os.makedirs(dictDirNames['state'])
+    return os.path.join(dictDirNames['state'], filename)
+
+
+def jobKey(mostype, staname):
+    # Key of one job in the queue
+    return '%s %s' % (mostype.upper(), staname.upper())
+
+
+class FileLock(object):
+    """ Exclusive lock on a file, held until released or the process ends """
+
+    def __init__(self, fullname):
+
+        # (string) full path of the lock file
+        self.fullname = fullname
+
+        # (file object) the open lock file while the lock is held
+        self.fileobj = None
+
+
+    def acquire(self, blocking = False):
+        # Take the lock. Returns True if it was taken, or False if someone else
+        # has it and 'blocking' is False. If 'blocking' is True, wait for it.
+        fileobj = open(self.fullname, 'a+')
+        while True:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fileobj.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    fileobj.seek(0)
+                    msvcrt.locking(fileobj.fileno(), msvcrt.LK_NBLCK, 1)
+                break
+            except (IOError, OSError):
+                if not blocking:
+                    fileobj.close()
+                    return False
+                time.sleep(0.05)
+        self.fileobj = fileobj
+        return True
+
+
+    def release(self):
+        # Let go of the lock, if it's held
+        if self.fileobj is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self.fileobj.fileno(), fcntl.LOCK_UN)
+        else:
+            self.fileobj.seek(0)
+            msvcrt.locking(self.fileobj.fileno(), msvcrt.LK_UNLCK, 1)
+        self.fileobj.close()
+        self.fileobj = None
+
+
+class JobQueue(object):
+    """ Queue of (MOS type, station) jobs on disk, shared by overlapping runs """
+
+    def __init__(self):
+
+        # (string) full path of the queue
+        self.fullname = statePath(queueName)
+
+        # (FileLock) held only while the queue is read or written
+        self.lock = FileLock(self.fullname + '.lock')
+
+        # (string) who claims jobs from this process
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+    def load(self):
+        # Returns the queue as a dictionary. Call with self.lock held.
+        #     'open': True while the run that holds the run lock is taking help
+        #     'jobs': job keys, in the order they should be done
+        #     'claims': {job key: [owner, time claimed]} for jobs being done
+        #     'done': {job key: owner} for jobs that are finished
+        queue = {'open': False, 'jobs': [], 'claims': {}, 'done': {}}
+        if os.path.exists(self.fullname):
+            try:
+                fileobj = open(self.fullname, 'r')
+                queue = json.load(fileobj)
+                fileobj.close()
+            except ValueError:
+                logging.getLogger('mosgraphics.coordinator').warning('Could not read %s. Starting a new one.', self.fullname)
+        return queue
+
+
+    def save(self, queue):
+        # Write the queue to disk. Write to a temporary file first and then
+        # swap it in (like scheduler.saveLedger). Call with self.lock held.
+        tempname = self.fullname + '.tmp'
+        fileobj = open(tempname, 'w')
+        json.dump(queue, fileobj, sort_keys = True)
+        fileobj.close()
+        if os.path.exists(self.fullname):
+            os.remove(self.fullname)
+        os.rename(tempname, self.fullname)
+
+
+    def update(self, change):
+        # Load the queue, pass it to change(), save it if change() returns
+        # True as the first of its two return values, and return the second.
+        self.lock.acquire(blocking = True)
+        try:
+            queue = self.load()
+            modified, result = change(queue)
+            if modified:
+                self.save(queue)
+        finally:
+            self.lock.release()
+        return result
+
+
+    def start(self):
+        # Empty the queue for a new run. Only the run that holds the run lock
+        # does this. The queue stays closed until the jobs are added.
+        def change(queue):
+            queue.clear()
+            queue.update({'open': False, 'jobs': [], 'claims': {}, 'done': {}})
+            return True, None
+        self.update(change)
+
+
+    def add(self, jobs):
+        # Add (MOS type, station ID) jobs to the queue and open it for help.
+        # Jobs that are already in it are left alone.
+        def change(queue):
+            known = set(queue['jobs'])
+            for mostype, staname in jobs:
+                key = jobKey(mostype, staname)
+                if key not in known:
+                    queue['jobs'].append(key)
+                    known.add(key)
+            queue['open'] = True
+            return True, None
+        self.update(change)
+
+
+    def close(self):
+        # Stop taking help. Runs that are still helping finish the jobs they
+        # already claimed.
+        def change(queue):
+            queue['open'] = False
+            return True, None
+        self.update(change)
+
+
+    def isOpen(self):
+        # True if the queue is taking help
+        return self.update(lambda queue: (False, queue['open']))
+
+
+    def claim(self):
+        # Claim the next job that isn't done or claimed (or whose claim is more
+        # than claimTimeout seconds old). Returns (MOS type, station ID), or
+        # None if there's nothing left to claim or the queue is closed.
+        def change(queue):
+            if not queue['open']:
+                return False, None
+            now = time.time()
+            for key in queue['jobs']:
+                if key in queue['done']:
+                    continue
+                claim = queue['claims'].get(key)
+                if (claim is not None) and (now - claim[1] < claimTimeout):
+                    continue
+                queue['claims'][key] = [self.owner, now]
+                return True, tuple(key.split(' '))
+            return False, None
+        return self.update(change)
+
+
+    def finish(self, mostype, staname):
+        # Mark a claimed job as done
+        def change(queue):
+            key = jobKey(mostype, staname)
+            queue['claims'].pop(key, None)
+            queue['done'][key] = self.owner
+            return True, None
+        self.update(change)
+
+
+    def allDone(self, jobs):
+        # True if every one of the (MOS type, station ID) jobs is done
+        def change(queue):
+            for mostype, staname in jobs:
+                if jobKey(mostype, staname) not in queue['done']:
+                    return False, False
+            return False, True
+        return self.update(change)
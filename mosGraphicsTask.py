@@ -1,107 +1,420 @@
-import datetime as dt
-import os, logging, GoGetFiles, mosHelper, mosplots, purge
+import time
+# Start the clock before anything else is imported so that the startup
+# time logged below includes the imports.
+starttime = time.time()
+import os, logging, argparse, GoGetFiles, mosHelper, purge, scheduler, runstats, sharding, coordinator, stationcatalog
+# mosplots is NOT imported here. It pulls in matplotlib, which takes about a
+# second, and many of the scheduled runs have nothing to plot. It is
+# imported below only if there is something to plot.
+
+# Startup time budget in seconds, from the first import until the logger is
+# ready to go. Anything over this gets a warning in the log, which usually
+# means a heavy import has crept back in at the top of a module.
+startupBudget = 0.5
 
 # Here's the deal:
 # MET usually comes in at 00/12z + 3 hours
 # MAV usually comes in at 00/06/12/18z + 4 hours
 # MEX usually comes in at 00/12z + 5 hours
 #
-# In an ideal world, we could schedule the task to run at
-# 03z, 04z, 05z, 10z, 15z, 16z, 17z, 22z. However, the Windows
-# scheduler on the server only permits regular intervals of
-# hours. 6 hours is too sparse, so let's schedule it to run every
-# 3 hours and do some checking to figure out which hours to skip
-# and which MOS to run at which hours. This only matters if the
-# total runtime will exceed 3 hours (possible for a lot of sites,
-# but unknown as of 1/28/2014), otherwise it might be a nice
-# feature to run every MOS at every opportunity-- if one of the
-# MOS products was delayed, it will still be processed on the
-# next run.
-#
-# Here is one option:
-# CDT  7p 10p 01a 04a 07a 10a  1p  4p
-# CST  6p  9p 12a 03a 06a 09a 12p  3p
-# UTC 00z 03z 06z 09z 12z 15z 18z 21z
-#     MAV MET MAV  X  MAV MET MAV  X
-#             MEX             MEX
-
-# Trying to be clever and get around the DST/standard time issues. This part
-# was written during standard time. Be sure to check after the switch to DST
-# that it still works as intended.
-rightnow = dt.datetime.utcnow()
-# Define a dictionary whose keys correspond to str(rightnow.hour) and whose
-# values are the MOS products to generate on that hour's run.
-dictTimeControl = {}
-dictTimeControl['0'] = ['MAV']
-dictTimeControl['3'] = ['MET']
-dictTimeControl['6'] = ['MAV', 'MEX']
-dictTimeControl['12'] = ['MAV']
-dictTimeControl['15'] = ['MET']
-dictTimeControl['18'] = ['MAV', 'MEX']
-# Use this to cheat to force all graphics on an off hour.
-#dictTimeControl[str(rightnow.hour)] = ['MAV', 'MEX', 'MET']
+# ...but "usually" isn't always. Rather than guess from the clock which MOS
+# should be ready (and fight with the DST/standard time switch), let the files
+# decide. Every run asks MDL for everything, then scheduler.findWork reports
+# which MOS types have a raw file that is new or has changed since it was
+# last processed. Only those get processed, and they get processed right away.
+# A late cycle is picked up on the first run after it shows up, and nothing
+# is processed twice. Runs that find nothing new only fetch and purge, so the
+# task can be scheduled as often as the Windows scheduler allows (every hour,
+# or more often).
 #
-# The Windows Scheduler is on standard time. DST cheap trick.
-dictTimeControl['1'] = ['MAV']
-dictTimeControl['4'] = ['MET']
-dictTimeControl['7'] = ['MAV', 'MEX']
-dictTimeControl['13'] = ['MAV']
-dictTimeControl['16'] = ['MET']
-dictTimeControl['19'] = ['MAV', 'MEX']
-
-# Create the logger used by this script, GoGetFiles, and mosplots
-logger = mosHelper.setUpTheLogger()
-
-# Go get files from MDL
-# Design decision: keep this outside of the try/except below, and don't
-# specify which MOS to download (request all 3 types). Do this because
-# occasionally the connection with MDL is lost and some files aren't
-# downloaded, so it's better to have more opportunities to get the
-# latest files. May need to revisit this design decision depending on
-# performance.
-newfiles = GoGetFiles.GrabEm()
+# Alternatively, run this script with --daemon and leave it running. It polls
+# MDL every few minutes and keeps matplotlib, the parsed station histories,
+# the colormaps, and the figures warm in memory between cycles, so each cycle
+# only has to deal with the data that just arrived.
+
+# Output to write for each station and MOS type:
+# 'png' renders one image per wx element with matplotlib.
+# 'json' writes the display arrays so MosGraphicsViewer.html can draw the
+# grids itself. It costs little more than serialization, so if the viewer
+# is the only consumer of the images, ['json'] alone will do. The viewer
+# shows the thumbnails from 'png' (or the sprite sheet) when there are any,
+# and only draws the grids when there aren't.
+# 'overview' draws every station in each group from siteGroups as small
+# multiples, one image per group, MOS type, and wx element.
+# 'sprite' puts every wx element of a station and MOS type into one sprite
+# sheet (STAID_MOS_sprite.png, with the panel offsets in STAID_MOS_sprite.json)
+# from the same render as 'png', so the viewer needs one image request per MOS
+# type instead of five. Use it with 'png' or instead of it.
+outputModes = ['png', 'json', 'overview']
+
+# Archive each new or changed raw file (see mosarchive) before making the
+# graphics. mosplots then reads the station histories from the archive
+# instead of parsing a processed file for every previous cycle.
+archiveMOS = True
+
+# Log one line per station and MOS type with all of its steps, instead of a
+# line for each step (see mosHelper.logSummary). Warnings still get their own
+# lines.
+logSummaries = True
+
+# Formats to export each newly archived cycle in, for other tools to read
+# (see mosexport): 'arrow' (Arrow IPC) and/or 'parquet'. These need pyarrow;
+# without it, nothing is exported.
+exportFormats = ['arrow']
 
 # Set station lists for which to process raw files
 CWAlist = mosHelper.setStations()
-sites = [CWAlist['LSX'],
-         CWAlist['SGF'],
-         CWAlist['EAX_lite'],
-         CWAlist['ILX_lite'],
-         #CWAlist['LIX_lite'],
-         CWAlist['PAH_lite'],
-         CWAlist['DVN_lite'],
-         CWAlist['TEST']
-         ]
-
-# Set mos types for which to process raw files based on the hour.
-# If nothing is defined for this hour, then quit.
-try:
+siteGroups = ['LSX',
+              'SGF',
+              'EAX_lite',
+              'ILX_lite',
+              #'LIX_lite',
+              'PAH_lite',
+              'DVN_lite',
+              'TEST'
+              ]
+sites = [CWAlist[group] for group in siteGroups]
+
+
+def plotStation(mos, asos, logger, processed = False):
+    # Process the raw files and make the graphics for one station and MOS type.
+    # Returns the display arrays as (plotme, xdt, info, prev) for the overview,
+    # or None if nothing could be plotted.
+    #
+    # 'processed' is the same as for makeGraphics.
+    import mosplots
+    with mosHelper.logSummary('%s %s' % (mos, asos), enabled = logSummaries):
+        logger.info('Processing: %s %s', mos, asos)
+        if not processed:
+            mosHelper.processFromSavedFiles(mos, asos)
+        try:
+            logger.info('Attempting to plot: %s %s', mos, asos)
+            fn = mosHelper.getLatestFilename(mos, asos)
+            with runstats.stage('arrays', key = fn, station = asos):
+                plotme, xdt, info, prev = mosplots.makeDisplayArrays(fn)
+            if ('png' in outputModes) or ('sprite' in outputModes):
+                mosplots.makePlots(plotme, xdt, info, prev,
+                                   images = 'png' in outputModes, sprite = 'sprite' in outputModes)
+            if 'json' in outputModes:
+                mosplots.exportJSON(plotme, xdt, info, prev)
+            return (plotme, xdt, info, prev)
+        except IndexError:
+            logger.warning('This error usually means that %s doesn\'t exist in %s', asos, mos)
+        except:
+            logger.warning('Something, somewhere, went horribly wrong. Barfed on %s %s', asos, mos)
+    return None
+
+
+def stationArrays(mos, asos):
+    # Returns the display arrays of a station that another run plotted (see
+    # coordinator), or None if it doesn't exist in this MOS type.
+    import mosplots
     try:
-        mostypes = dictTimeControl[str(rightnow.hour)]
-        logger.info('It\'s %02dz, time for: %s', rightnow.hour, mostypes)
-    except KeyError:
-        logger.info('It\'s %02dz, nothing to process. Move along, move along, nothing to see here.', rightnow.hour)
-        mostypes = [] # Define it to avoid NameError: name 'mostypes' is not defined
-    for CWA in sites:
-        for asos in CWA:
+        return mosplots.makeDisplayArrays(mosHelper.getLatestFilename(mos, asos))
+    except IndexError:
+        return None
+
+
+def makeGraphics(mostypes, logger, groups = None, processed = False, queue = None):
+    # Process the raw files and make the graphics for every station in 'sites'
+    # for each of the given MOS types.
+    #
+    # 'mostypes' is a list of MOS types (MAV, MEX, MET).
+    # 'logger' is the logger returned by mosHelper.setUpTheLogger.
+    # 'groups' is a list of (group name, list of station IDs) to use instead of
+    # siteGroups and sites, e.g. one node's share of a whole bulletin (see
+    # sharding). These groups get no overview.
+    # 'processed': if True, the processed files were already made for every
+    # station (see sharding.processStations), so don't make them one by one.
+    # 'queue' is the coordinator.JobQueue of this run. Each station and MOS
+    # type is put in it, so that runs that overlap this one can help out, and
+    # this run takes them back out one at a time.
+    if not mostypes:
+        return
+    if groups is None:
+        groups = list(zip(siteGroups, sites))
+        makeOverviews = 'overview' in outputModes
+    else:
+        makeOverviews = False
+
+    # There's something to plot, so now it's worth paying for matplotlib.
+    # (In daemon mode, this was already paid for once at startup.)
+    importstart = time.time()
+    import mosplots
+    logger.info('Imported the plotting stack in %.2f s', time.time() - importstart)
+
+    # Every station and MOS type once, even if it's in more than one group,
+    # and only if it's in the latest raw file of that MOS type
+    allStations = []
+    for group, CWA in groups:
+        allStations.extend(CWA)
+    jobs = stationcatalog.workSet(mostypes, allStations)
+    jobSet = set(jobs)
+
+    # Hang on to each station's display arrays for the group overviews
+    plotted = {}
+    if queue is None:
+        for mos, asos in jobs:
+            plotted[(mos, asos)] = plotStation(mos, asos, logger, processed)
+    else:
+        queue.add(jobs)
+        while True:
+            job = queue.claim()
+            if job is not None:
+                plotted[job] = plotStation(job[0], job[1], logger, processed)
+                queue.finish(job[0], job[1])
+            elif queue.allDone(jobs):
+                break
+            else:
+                # Everything left is being plotted by another run
+                time.sleep(coordinator.pollInterval)
+        helped = len(jobs) - len(plotted)
+        if helped:
+            logger.info('Other runs plotted %d of %d stations', helped, len(jobs))
+
+    if makeOverviews:
+        for group, CWA in groups:
             for mos in mostypes:
-                logger.info('Processing: %s %s', mos, asos)
-                mosHelper.processFromSavedFiles(mos, asos)
                 try:
-                    logger.info('Attempting to plot: %s %s', mos, asos)
-                    fn = mosHelper.getLatestFilename(mos, asos)
-                    plotme, xdt, info, prev = mosplots.makeDisplayArrays(fn)
-                    mosplots.makePlots(plotme, xdt, info, prev)
-                except IndexError:
-                    logger.warning('This error usually means that %s doesn\'t exist in %s', asos, mos)
+                    logger.info('Attempting to plot the overview: %s %s', mos, group)
+                    overview = []
+                    for asos in CWA:
+                        if (mos, asos) not in jobSet:
+                            continue
+                        if (mos, asos) not in plotted:
+                            plotted[(mos, asos)] = stationArrays(mos, asos)
+                        if plotted[(mos, asos)] is not None:
+                            overview.append(plotted[(mos, asos)])
+                    mosplots.makeOverview(group, overview)
                 except:
-                    logger.warning('Something, somewhere, went horribly wrong. Barfed on %s %s', asos, mos)
-finally:
-    # Get rid of old raw files
-    purge.cleanHouse()
-    # Clear all processed files in preparation for the next run
-    purge.clearProcFiles()
-    
-    logger.info('--------------------------------Dun dun dun...done.')
-    # Perform an orderly shutdown of the logger (flush and close all handlers)
-    logging.shutdown()
+                    logger.warning('Something, somewhere, went horribly wrong. Barfed on the %s %s overview', group, mos)
+
+
+def joinRun(logger, queue):
+    # Help the run that holds the run lock: make the graphics for jobs in its
+    # queue that nobody has claimed yet. Doesn't fetch, look for new work, or
+    # clean up; that's up to the other run.
+    # Returns False if the other run isn't taking help (yet), or True once
+    # there's nothing left to claim.
+    if not queue.isOpen():
+        return False
+    count = 0
+    job = queue.claim()
+    while job is not None:
+        plotStation(job[0], job[1], logger)
+        queue.finish(job[0], job[1])
+        count = count + 1
+        job = queue.claim()
+    logger.info('Helped another run with %d stations', count)
+    return True
+
+
+def myStations(shard):
+    # Stations whose processed files this node may clear: all of them (None),
+    # or only those of its own shard if the stations are split across nodes.
+    if shard is None:
+        return None
+    return sharding.procStations(shard[0], shard[1])
+
+
+def runOnce(logger, fetch = True, keepProcFiles = False, shard = None):
+    # One pass through the whole process: fetch, figure out what's new,
+    # make the graphics, and clean up. If another run is still going, help it
+    # make its graphics instead (see coordinator).
+    #
+    # The arguments are the same as for leadRun.
+    queue = coordinator.JobQueue()
+    runLock = coordinator.FileLock(coordinator.statePath(coordinator.lockName))
+    while not runLock.acquire():
+        logger.info('Another run is still going. Joining it.')
+        if joinRun(logger, queue):
+            return
+        # It isn't taking help yet (e.g., it's still fetching)
+        time.sleep(coordinator.pollInterval)
+
+    try:
+        queue.start()
+        leadRun(logger, fetch, keepProcFiles, shard, queue)
+    finally:
+        queue.close()
+        runLock.release()
+
+
+def leadRun(logger, fetch, keepProcFiles, shard, queue):
+    # Fetch, figure out what's new, make the graphics, and clean up, while
+    # holding the run lock.
+    #
+    # 'fetch': if False, don't ask MDL for files and only look at what is
+    # already in the raw files directory (e.g., another process downloads them).
+    # 'keepProcFiles': if True, keep the processed files for the next pass and
+    # only reprocess the raw files that changed (daemon mode). Otherwise, clear
+    # all processed files at the end, as a scheduled run always has.
+    # 'shard': (K, N) to make the graphics for every station in the bulletins
+    # that belongs to shard K of N, instead of the stations in 'sites' (see
+    # sharding). Only the node that fetches archives, exports, and purges the
+    # raw files, and each node only clears its own processed files.
+    # 'queue' is the coordinator.JobQueue to share the graphics through.
+
+    passstart = time.time()
+    runstats.reset()
+
+    # Go get files from MDL
+    # Design decision: keep this outside of the try/except below, and don't
+    # specify which MOS to download (request all 3 types). Do this because
+    # occasionally the connection with MDL is lost and some files aren't
+    # downloaded, so it's better to have more opportunities to get the
+    # latest files. May need to revisit this design decision depending on
+    # performance.
+    if fetch:
+        newfiles = GoGetFiles.GrabEm()
+    else:
+        newfiles = []
+
+    # Set mos types for which to process raw files based on which raw files are
+    # new or have changed. If nothing is new, then quit.
+    try:
+        dictWork = scheduler.findWork(newfiles)
+        mostypes = sorted(dictWork.keys())
+        # Use this to cheat to force all graphics on this run.
+        #mostypes = ['MAV', 'MEX', 'MET']
+        if mostypes:
+            logger.info('Time for: %s', mostypes)
+        else:
+            logger.info('Nothing new to process. Move along, move along, nothing to see here.')
+
+        if keepProcFiles:
+            # Processed files made from an older copy of a changed raw file are stale.
+            changed = []
+            for mos in mostypes:
+                changed.extend(dictWork[mos].keys())
+            purge.clearProcFiles(changed, myStations(shard))
+
+        if archiveMOS and mostypes and (fetch or (shard is None)):
+            # Like mosplots, only imported if there is something to do
+            import mosarchive, mosexport
+            for mos in mostypes:
+                for rawfile in sorted(dictWork[mos].keys()):
+                    try:
+                        with runstats.stage('archive', key = rawfile):
+                            mosarchive.archiveRawFile(rawfile)
+                    except Exception:
+                        logger.exception('Could not archive %s. Its stations will be read from the processed files.', rawfile)
+                        continue
+                    if exportFormats:
+                        try:
+                            with runstats.stage('export_arrow', key = rawfile):
+                                mosexport.exportRawFile(rawfile, exportFormats)
+                        except Exception:
+                            logger.exception('Could not export %s', rawfile)
+
+        if shard is None:
+            makeGraphics(mostypes, logger, queue = queue)
+        else:
+            # Every station in this node's share of each bulletin. Read each raw
+            # file once for all of them rather than once per station.
+            shardCounts = {}
+            shardCycles = {}
+            for mos in mostypes:
+                # The cycle this node is about to make, taken before anything
+                # is read. The node that fetches can add a newer one to the
+                # raw files while this one is still plotting.
+                shardCycles[mos] = sharding.latestCycle(mos)
+                stations = sharding.shardStations(sharding.bulletinStations(mos), shard[0], shard[1])
+                logger.info('Shard %d of %d has %d %s stations', shard[0], shard[1], len(stations), mos)
+                sharding.processStations(mos, stations)
+                makeGraphics([mos], logger, groups = [('shard %d of %d' % shard, stations)], processed = True, queue = queue)
+                shardCounts[mos] = len(stations)
+
+        # Everything for these MOS types has had its shot, so don't do it again
+        # unless a raw file changes.
+        for mos in mostypes:
+            scheduler.markDone(dictWork, mos)
+            if shard is not None:
+                # Let the viewer know once every node is done with this cycle
+                sharding.markDone(mos, shardCycles[mos], shard[0], shard[1], shardCounts[mos])
+    finally:
+        # Get rid of old raw files
+        if fetch or (shard is None):
+            purge.cleanHouse()
+        if keepProcFiles:
+            # Only the processed files whose raw files are gone
+            purge.clearOrphanProcFiles(myStations(shard))
+        else:
+            # Clear all processed files in preparation for the next run
+            purge.clearProcFiles(stations = myStations(shard))
+
+        # Write down where the time went
+        runstats.writeReport({'run_wall': round(time.time() - passstart, 2)})
+
+
+def runDaemon(logger, interval, fetch = True, shard = None):
+    # Stay resident and call runOnce every 'interval' minutes, keeping the
+    # plotting stack, parsed station histories, colormaps, and figures in memory
+    # from one pass to the next. Runs until it is killed (Ctrl-C).
+    import mosplots
+    mosplots.enableWarmCaches()
+    logger.info('Running as a daemon. Checking for new files every %s minutes.', interval)
+
+    while True:
+        passstart = time.time()
+        try:
+            runOnce(logger, fetch = fetch, keepProcFiles = True, shard = shard)
+        except Exception:
+            # Log it and try again next time rather than bringing down the daemon
+            logger.exception('This pass failed. Trying again in %s minutes.', interval)
+        mosplots.pruneWarmCaches()
+        logger.info('Pass took %.1f s', time.time() - passstart)
+
+        time.sleep(max(interval * 60 - (time.time() - passstart), 0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Download MOS from MDL and make graphics.')
+    parser.add_argument('--daemon', action = 'store_true',
+                        help = 'stay running and check for new files every INTERVAL minutes')
+    parser.add_argument('--interval', type = float, default = 10,
+                        help = 'minutes between checks in daemon mode (default: 10)')
+    parser.add_argument('--no-fetch', dest = 'fetch', action = 'store_false',
+                        help = 'don\'t ask MDL for files; only watch the raw files directory')
+    parser.add_argument('--shards', type = int, default = None,
+                        help = 'split every station in the bulletins across this many nodes (see sharding.py)')
+    parser.add_argument('--shard', type = int, default = 0,
+                        help = 'which of the --shards nodes this is, from 0 (default: 0)')
+    parser.add_argument('--profile', action = 'store_true',
+                        help = 'profile each stage with cProfile and tracemalloc and save the results in the logs directory (same as MOSGRAPHICS_PROFILE=1)')
+    args = parser.parse_args()
+    shard = None
+    if args.shards is not None:
+        if not (0 <= args.shard < args.shards):
+            parser.error('--shard must be from 0 to %d' % (args.shards - 1))
+        shard = (args.shard, args.shards)
+        # Each node keeps track of what it has done on its own
+        scheduler.ledgerName = 'ledger-shard-%d-of-%d.json' % shard
+        coordinator.lockName = 'run-shard-%d-of-%d.lock' % shard
+        coordinator.queueName = 'queue-shard-%d-of-%d.json' % shard
+
+    # Create the logger used by this script, GoGetFiles, and mosplots
+    logger = mosHelper.setUpTheLogger()
+
+    if args.profile:
+        runstats.enableProfiling()
+    if runstats.profiling:
+        logger.info('Profiling is on. Expect this run to be slower than usual.')
+
+    startuptime = time.time() - starttime
+    if startuptime > startupBudget:
+        logger.warning('Startup took %.2f s, over the budget of %.2f s', startuptime, startupBudget)
+    else:
+        logger.info('Startup took %.2f s', startuptime)
+
+    try:
+        if args.daemon:
+            runDaemon(logger, args.interval, fetch = args.fetch, shard = shard)
+        else:
+            runOnce(logger, fetch = args.fetch, shard = shard)
+    except KeyboardInterrupt:
+        logger.info('Interrupted.')
+    finally:
+        logger.info('--------------------------------Dun dun dun...done.')
+        # Perform an orderly shutdown of the logger (flush and close all handlers)
+        logging.shutdown()
@@ -1,6 +1,19 @@
-import string, os, logging
+import string, os, time, atexit, logging, multiprocessing, runstats
 import datetime as dt
 
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    # New in Python 3.2. Without them, log messages are written by whoever
+    # logs them, as they always were.
+    QueueHandler = None
+    QueueListener = None
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 # A series of helper functions for working with mos stuff
 
 def getDirNames():
@@ -27,10 +40,65 @@ def getDirNames():
 
     # Directory for log files
     dictDirNames['logs'] = 'logs'
+
+    # Directory for bookkeeping that has to survive between runs
+    dictDirNames['state'] = 'state'
+
+    # Directory for the archive of parsed MOS, one subfolder per MOS type (see mosarchive)
+    dictDirNames['archive'] = 'archive'
+
+    # Directory for Arrow/Parquet exports of the archive (see mosexport)
+    dictDirNames['export'] = 'export'
+
+    # Directory for compressed daily bundles of raw files that have expired (see mosbundle)
+    dictDirNames['bundles'] = 'raw_bundles'
+
+    # Directory for the graphics made on demand by mosserver (emptied when it starts)
+    dictDirNames['cache'] = 'image_cache'
     
     return dictDirNames
 
 
+def getImageSettings():
+    # Hard-code the PNG output settings only once, then call this function
+    # elsewhere. These only take effect if PIL (Pillow) is installed;
+    # otherwise matplotlib writes full RGBA PNGs at its default settings.
+    dictImgSettings = {}
+
+    # Write 8-bit palette PNGs instead of full RGBA. The plots only have a few
+    # dozen distinct colors, so the files come out a fraction of the size.
+    dictImgSettings['palette'] = True
+
+    # Number of colors in the palette (at most 256). The boxes need only a few
+    # dozen, but the colorbar gradient shows banding below about 128.
+    dictImgSettings['colors'] = 128
+
+    # zlib compression level, from 0 (none, fastest) to 9 (smallest, slowest)
+    dictImgSettings['compress_level'] = 9
+
+    # Trade file size for speed: use a faster (coarser) quantizer and the
+    # lowest compression level. Handy for backfills and testing.
+    dictImgSettings['fast'] = False
+
+    # Thumbnails to write alongside each image, as {filename suffix: shrink factor}.
+    # They are shrunk from the same raster as the full-size image, so they're
+    # cheap. MosGraphicsViewer.html loads the '_thumb' images first.
+    dictImgSettings['thumbnails'] = {'thumb': 4}
+
+    # Write a manifest (STAID_MOS_manifest.json) next to each station's images
+    # with a content hash of each one (and of STAID_MOS.json), so
+    # MosGraphicsViewer.html can ask for them by URLs that only change when the
+    # file does. See mosplots.writeManifest.
+    dictImgSettings['manifest'] = True
+
+    # Number of colors in the palette of a sprite sheet (at most 256). One
+    # palette has to cover all of the wx elements' colormaps at once. Only
+    # used with the 'sprite' output mode of mosGraphicsTask.
+    dictImgSettings['sprite_colors'] = 256
+
+    return dictImgSettings
+
+
 def listRawFiles(mostype):
     # mostype is a 3-letter abbreviation
     mostype = mostype.lower()
@@ -113,8 +181,10 @@ def getLatestFilename(mostype, staname):
         if item.startswith(prefix):
             procFiles.append(item)
 
-    # Since the filenames include YYYYMMDD_CC, the last item in the list is
-    # the most recent file.
+    # Since the filenames include YYYYMMDD_CC, the last item in the sorted
+    # list is the most recent file. (os.listdir only happens to return sorted
+    # names on Windows.)
+    procFiles.sort()
     return procFiles[-1]
 
 
@@ -168,7 +238,94 @@ def getIssuance(data):
     return dictResult
 
 
+# One station's MOS is separated from the next by a line of 69 spaces
+stationSeparator = ' ' * 69 + '\n'
+
+# 3-letter abbreviations of the MOS types, by the name in each station's header
+modelNames = {'ECMX':'ECE', 'ECM':'ECS', 'NAM':'MET', 'GFSX':'MEX', 'GFS':'MAV'}
+
+
+def stationRecord(block):
+    # Returns (station ID, MOS type, cycle, text) for one station's lines of a
+    # bulletin, or None if they don't start with a station header (e.g., the
+    # newlines at the end of the bulletin). MOS type is the 3-letter
+    # abbreviation, and cycle is a datetime object.
+    #
+    # The header looks like this:
+    #  KSTL   GFS MOS GUIDANCE    2/02/2014  1200 UTC
+    if not block:
+        return None
+    header = block[0].split()
+    try:
+        mostype = modelNames[header[1]]
+        M, D, Y = header[4].split('/')
+        cycle = dt.datetime(int(Y), int(M), int(D), int(header[5][0:2]))
+    except (IndexError, KeyError, ValueError):
+        return None
+    return header[0], mostype, cycle, ''.join(block)
+
+
+def iterStations(lines):
+    # Split a bulletin into stations as it is read, one station at a time, so
+    # the whole bulletin never has to be in memory and whoever is downstream
+    # can start on the first station right away.
+    # Yields (station ID, MOS type, cycle, text) for each station, as returned
+    # by stationRecord. The text is exactly as it appears in the bulletin.
+    #
+    # 'lines' gives the bulletin one line at a time, newlines included (e.g.,
+    # an open file).
+    block = []
+    for line in lines:
+        if line == stationSeparator:
+            record = stationRecord(block)
+            if record is not None:
+                yield record
+            block = []
+        else:
+            block.append(line)
+    record = stationRecord(block)
+    if record is not None:
+        yield record
+
+
+def readStations(filename):
+    # Same as iterStations, reading the bulletin from a file.
+    #
+    # 'filename' is a complete filename, including the extension
+    fileobj = open(filename, mode = 'rt')
+    try:
+        for record in iterStations(fileobj):
+            yield record
+    finally:
+        fileobj.close()
+
+
+def writeStation(staname, mostype, cycle, text):
+    # Write one station's MOS (as yielded by iterStations) to its processed file.
+    filename = makeFilenames(mostype, staname, cycle.year, cycle.month, cycle.day, '%02d' % cycle.hour)['proc']
+    with runstats.stage('write', key = filename, station = staname, nbytes = len(text)):
+        fullname = os.path.join(getDirNames()['proc'], filename)
+        fileobj = open(fullname, 'w')
+        fileobj.write(text)
+        fileobj.close()
+
+
+def parseRawFile(stalist, filename):
+    # Create processed files for the stations in 'stalist' (a list of station
+    # identifiers) from one raw file, reading it one station at a time.
+    # Returns the number of processed files written.
+    #
+    # 'filename' is a complete filename, including the extension
+    count = 0
+    for staname, mostype, cycle, text in readStations(filename):
+        if staname in stalist:
+            writeStation(staname, mostype, cycle, text)
+            count = count + 1
+    return count
+
+
 def parseStations(stalist, data):
+    # Same as parseRawFile, for a bulletin that has already been read in.
     # 'stalist' is a list of station identifiers for which to create processed files
     # 'data' is a really big string as returned by load_file.
     # output filename has this form:
@@ -177,64 +334,28 @@ def parseStations(stalist, data):
     # SSSS = 4 alphanumeric station identifier
     # YYYYMMDD = date
     # CC = cycle
-
-    dictDirNames = getDirNames()
-    
-    modelNames = {'ECMX':'ECE', 'ECM':'ECS', 'NAM':'MET', 'GFSX':'MEX', 'GFS':'MAV'}
-    indivStations = data.split('                                                                     \n')
-    for item in indivStations:
-        try:
-            lines = item.split('\n')
-            header = lines[0].split()
-            staname = header[0]
-            mostype = header[1]
-            rundate = header[4].split('/')
-            runtime = header[5]
-            # preserve (or insert) leading zeros for month and day
-            #fileDate = ('%s%02d%02d' % (rundate[2], int(rundate[0]), int(rundate[1])))
-            #fileTime = runtime[0:2]
-            #filename = ('%s-%s-%s_%s' % (modelNames[mostype], staname, fileDate, fileTime))
-            dictFn = makeFilenames(modelNames[mostype], staname, rundate[2], rundate[0], rundate[1], runtime[0:2])
-            filename = dictFn['proc']
-            if staname in stalist:
-                #print 'Saving', filename
-                fullname = os.path.join(dictDirNames['proc'], filename)
-                fileobj = open(fullname, 'w')
-                fileobj.writelines(item)
-                fileobj.close()
-        except:
-            #don't care about lines that are just newlines
-            # On reflection, this may not be an entirely kosher use of try/except. Read up on this.
-            pass
+    count = 0
+    for staname, mostype, cycle, text in iterStations(StringIO(data)):
+        if staname in stalist:
+            writeStation(staname, mostype, cycle, text)
+            count = count + 1
+    return count
 
 
 def setStations():
-    # In retrospect, it would make more sense to keep a master list of stations with such
-    # useful columns as CWA and state. Then these lists could be constructed from a
-    # master list instead of being built laboriously by hand. Actually they'd be dictionaries. And
-    # it would make the mapping steps easier, too.
+    # The station lists by CWA come from the master list of stations (see
+    # stationcatalog), in the order of the table. The rest are hand-picked
+    # subsets and collections, which can overlap the CWAs and each other.
+    import stationcatalog
     stalist = {}
-    stalist['LSX'] = ['K3LF', 'KALN', 'KBLV', 'KCOU', 'KCPS', 'KENL', 'KFAM', 'KJEF', 'KPPQ', 'KSAR', 'KSET', 'KSLO', 'KSTL', 'KSUS', 'KUIN']
-    stalist['SGF'] = ['KAIZ', 'KJLN', 'KSGF', 'KTBN', 'KUNO', 'KVIH']
-    stalist['EAX'] = ['KCDJ', 'KDMO', 'KIRK', 'KIXD', 'KLXT', 'KMCI', 'KMKC', 'KOJC', 'KSTJ', 'KSZL']
+    for cwa, stations in stationcatalog.loadCatalog().byCWA.items():
+        stalist[cwa] = list(stations)
     stalist['EAX_lite'] = ['KCDJ', 'KIRK', 'KIXD', 'KMCI', 'KSTJ', 'KSZL']
-    stalist['ILX'] = ['K1H2', 'KAAA', 'KAJG', 'KBMI', 'KCMI', 'KDEC', 'KDNV', 'KFOA', 'KGBG', 'KIJX', 'KLWV', 'KMTO', 'KOLY', 'KPIA', 'KPRG', 'KRSV', 'KSPI', 'KTAZ', 'KTIP']
     stalist['ILX_lite'] = ['K1H2', 'KBMI', 'KCMI', 'KFOA', 'KIJX', 'KPIA', 'KSPI', 'KTAZ']
-    stalist['PAH'] = ['KCIR', 'KCGI', 'KCUL', 'KEHR', 'KEVV', 'KFWC', 'KHOP', 'KHSB', 'KM30', 'KMDH', 'KMVN', 'KMWA', 'KOWB', 'KPAH', 'KPOF']
     stalist['PAH_lite'] = ['KCGI', 'KEVV', 'KMDH', 'KMVN', 'KPAH', 'KPOF']
-    stalist['LOT'] = ['KARR', 'KC09', 'KDKB', 'KDPA', 'KGYY', 'KIGQ', 'KIKK', 'KJOT', 'KLOT', 'KMDW', 'KORD', 'KPNT', 'KPWK', 'KRFD', 'KRPJ', 'KUGN', 'KVPZ', 'KVYS']
-    stalist['DVN'] = ['KAWG', 'KBRL', 'KC75', 'KCID', 'KCWI', 'KDBQ', 'KDVN', 'KEOK', 'KFEP', 'KFFL', 'KFSW', 'KIIB', 'KIOW', 'KMLI', 'KMPZ', 'KMQB', 'KMUT', 'KMXO', 'KSFY', 'KSQI', 'KVTI']
     stalist['DVN_lite'] = ['KEOK', 'KDVN', 'KMQB', 'KFFL', 'KFEP']
-    stalist['DMX'] = ['KADU', 'KAIO', 'KALO', 'KAMW', 'KAXA', 'KBNW', 'KCAV', 'KCIN', 'KCNC', 'KCSQ', 'KDNS', 'KDSM', 'KEBS', 'KEST', 'KFOD', 'KIKV', 'KLWD', 'KMCW', 'KMIW', 'KOTM', 'KOXV', 'KPEA', 'KTNU']
-    stalist['MPX'] = ['KACQ', 'KAEL', 'KANE', 'KAQP', 'KAXN', 'KBBB', 'KCBG', 'KCFE', 'KDXX', 'KEAU', 'KFBL', 'KFCM', 'KFRM', 'KFSE', 'KGDB', 'KGHW', 'KGYL', 'KHCD', 'KJMR', 'KJYG', 'KLJF', 'KLUM', 'KLVN', 'KLXL', 'KMGG', 'KMIC', 'KMKT', 'KMOX', 'KMSP', 'KMVE', 'KOEO', 'KOVL', 'KOWA', 'KPNM', 'KRCX', 'KRGK', 'KRNH', 'KROS', 'KRPD', 'KRWF', 'KSGS', 'KSTC', 'KSTP', 'KSYN', 'KULM']
-
-    stalist['HNL'] = ['PHHI', 'PHIK', 'PHJH', 'PHJR', 'PHKO', 'PHLI', 'PHMK', 'PHNG', 'PHNL', 'PHNY', 'PHOG', 'PHSF', 'PHTO']
-    stalist['HUN'] = ['KHSV', 'KMSL', 'KDCU', 'KMDQ', 'K4A9']        
-
-    stalist['LIX'] = ['KASD', 'KBTR', 'KHDC', 'KHUM', 'KMSY', 'KNBG', 'KNEW', 'KBIX', 'KGPT', 'KMCB', 'KPQL']
     stalist['LIX_lite'] = ['KASD', 'KBTR', 'KMSY', 'KBIX', 'KGPT', 'KMCB']
-        
-    stalist['SJU'] = ['TJBQ', 'TJMZ', 'TJNR', 'TJPS', 'TJSJ']
+
     stalist['Caribbean'] = ['TIST', 'TISX', 'TKPK', 'TNCM', 'MUGM']
     stalist['Pacific'] = ['PMDY', 'NSTU']
 
@@ -371,9 +492,10 @@ def processFromSavedFiles(mostype, staname, forceReprocess = 'False'):
     rawfilelist = list(rawfiles)
     if (len(rawfilelist) > 0):
         for f in rawfilelist:
-            fullname = os.path.join(dictDirNames['raw'], f)
-            d = load_file(fullname)
-            parseStations(staname, d)
+            with runstats.stage('parse', key = f, station = staname) as st:
+                fullname = os.path.join(dictDirNames['raw'], f)
+                parseRawFile(staname, fullname)
+                st.nbytes = os.path.getsize(fullname)
 
     # original
     #rawfiles = listRawFiles(mostype)
@@ -384,12 +506,25 @@ def processFromSavedFiles(mostype, staname, forceReprocess = 'False'):
     #    parseStations(staname, d)
 
 
+# The background thread that writes the log (see setUpTheLogger), and the
+# queue it reads from. Worker processes log through the same queue (see
+# setUpWorkerLogger).
+logListener = None
+logQueue = None
+
+
 def setUpTheLogger():
     # someone set up us the logger?
     #
     # Even though logging does slow down the scripts, it's worth the
     # time penalty because a log facilitates troubleshooting, especially
     # if something breaks when I'm not on shift.
+    #
+    # To keep that penalty small, the file and console are written by a
+    # background thread. Logging a message only puts it on a queue, so a slow
+    # fileserver never holds anything up. Whatever is still on the queue is
+    # written out when the script exits (or by stopTheLogger).
+    global logListener, logQueue
     
     # Define a unique log file suffix based on the date/time and
     # output each log to a logs directory.
@@ -415,9 +550,18 @@ def setUpTheLogger():
     fh.setFormatter(logformatter)
     ch.setFormatter(logformatter)
     
-    # Add the handlers to the logger
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+    # Add the handlers to the logger, or to the background thread if there is one.
+    # A multiprocessing queue (rather than a plain one) lets worker processes
+    # put their messages on it too.
+    if QueueHandler is None:
+        logger.addHandler(fh)
+        logger.addHandler(ch)
+    else:
+        logQueue = multiprocessing.Queue(-1)
+        logListener = QueueListener(logQueue, fh, ch, respect_handler_level = True)
+        logListener.start()
+        atexit.register(stopTheLogger)
+        logger.addHandler(QueueHandler(logQueue))
 
     # Log some headers
     logger.info('-------------------------------------------')
@@ -425,3 +569,65 @@ def setUpTheLogger():
     logger.info('-------------------------------------------')
     
     return logger
+
+
+def stopTheLogger():
+    # Write out whatever is still on the log queue and stop the background
+    # thread. Called automatically when the script exits.
+    global logListener
+    if logListener is not None:
+        logListener.stop()
+        logListener = None
+
+
+def setUpWorkerLogger(queue):
+    # Call this at the start of a worker process (e.g., as a Pool
+    # initializer) to send its log messages to the main process's log.
+    #
+    # 'queue' is logQueue from the main process. If it is None (no queue
+    # there), the worker's messages are dropped.
+    logger = logging.getLogger('mosgraphics')
+    # Handlers copied from the main process when it forked can't be trusted
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.setLevel(logging.INFO)
+    if queue is not None:
+        logger.addHandler(QueueHandler(queue))
+    else:
+        logger.addHandler(logging.NullHandler())
+
+
+class logSummary(object):
+    # Batches the INFO messages logged while one station is processed into a
+    # single line at the end, instead of one line per step. Warnings and
+    # errors still go straight through. Use it as a context manager.
+    #
+    # 'label' starts the summary line (e.g., 'MAV KSTL').
+    # 'enabled': if False, do nothing and let every message through.
+
+    def __init__(self, label, enabled = True):
+        self.label = label
+        self.enabled = enabled
+        self.steps = []
+
+    def __enter__(self):
+        self.starttime = time.time()
+        if self.enabled:
+            for handler in logging.getLogger('mosgraphics').handlers:
+                handler.addFilter(self)
+        return self
+
+    def filter(self, record):
+        # Logging calls this for every message; False means hold it back.
+        if record.levelno > logging.INFO:
+            return True
+        self.steps.append(record.getMessage())
+        return False
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.enabled:
+            return False
+        for handler in logging.getLogger('mosgraphics').handlers:
+            handler.removeFilter(self)
+        logging.getLogger('mosgraphics').info('%s (%.2f s): %s', self.label, time.time() - self.starttime, '; '.join(self.steps))
+        return False
@@ -0,0 +1,453 @@
+import os, json, logging
+import datetime as dt
+import numpy as np
+import mosHelper
+
+# An archive of parsed MOS, so the text only has to be parsed once.
+#
+# Each MOS type has its own directory in the archive directory, with one file
+# per cycle in a folder per year, like the daily bundles (see mosbundle):
+# MAV/2014/20140202_12.mos. A cycle file starts with one line of JSON (its
+# index), then has one row per station: a small int16 array with one line per
+# wx element (see elementList). The first column of each line is the number of
+# values in it (0 if the element isn't in that station's MOS), and the rest are
+# the values as yoinkFromMOS finds them, padded with missingValue. 999 (missing)
+# is stored as missingValue too.
+#
+# The index lists the stations in row order, so a row is found without
+# reading any other cycle. It also has the forecast hour of each value, by
+# element: 'hours': {'XN': [forecast hour or None, ...], ...}. They come from
+# the HR (or FHR) line, matched to each value by the column it sits in, and
+# are the same for every station in a bulletin. None is a value with no hour
+# above it (e.g., the MEX's climatology at the end of the line).
+#
+# Archiving a raw file writes its cycle's file again from scratch and swaps it
+# in, so readers never see half a cycle, and the work doesn't grow with the
+# size of the archive. Stations that were in the old file but not in the new
+# raw file are kept. purge.cleanHouse deletes the cycles older than
+# purge.archiveDays.
+#
+# Readers memory-map the rows of the cycles they need, so reading a station's
+# history is a handful of small slices instead of opening and parsing a text
+# file per cycle, and the history isn't limited to the raw files that
+# purge.cleanHouse keeps. mosplots.loadElements looks here before it reads a
+# processed file.
+#
+# The first version of the archive kept every cycle in one values.i16 and one
+# index.json per MOS type. Those aren't read anymore and can be deleted.
+#
+# A row is handled as a StationCycle wherever it goes: parsed from the text,
+# written to and read from the archive, and kept in mosplots' history cache.
+
+# Wx elements in each row, in the same form as mosplots.loadElements returns them
+elementList = ['XN', 'P12', 'WSP', 'Q12']
+
+# Values per element. The MAV and MET have 21 columns, the MEX has 15 plus 2 climo.
+numColumns = 24
+
+# Stands in for 999 (missing) and for columns past the end of the line
+missingValue = np.iinfo(np.int16).min
+
+# Version of the archive layout. Bump this if the layout changes.
+archiveVersion = 2
+
+# MOS types by their number in a StationCycle key
+productList = ['MAV', 'MET', 'MEX', 'ECE', 'ECS']
+
+# Cycles in a StationCycle key are counted in hours from here
+keyEpoch = dt.datetime(1970, 1, 1)
+
+# Shape of one row of a cycle file
+rowShape = (len(elementList), numColumns + 1)
+
+# Index and memory map of the cycles read so far, so that repeated lookups
+# don't read the index again.
+# {(MOS type, 'YYYYMMDDHH'): ((size, mtime) of the cycle file, index, memmap)}
+openCycles = {}
+
+# Forget the cycles read so far once there are more than this many of them
+# (e.g., in a server that runs for weeks). Each one is a small index and an
+# open file.
+maxOpenCycles = 256
+
+
+def cyclePath(mostype, cycle):
+    # Full path of the file of one MOS type and cycle (a datetime object)
+    return os.path.join(mosHelper.getDirNames()['archive'], mostype.upper(), cycle.strftime('%Y'),
+                        cycle.strftime('%Y%m%d_%H') + '.mos')
+
+
+def newIndex(mostype, cycle):
+    # An empty index of one cycle
+    return {'version': archiveVersion, 'mos': mostype.upper(), 'cycle': cycle.strftime('%Y%m%d%H'),
+            'elements': elementList, 'columns': numColumns, 'stations': [], 'hours': {}}
+
+
+def readCycleFile(fullname):
+    # Returns (index, memory-mapped rows) of one cycle file. The rows are None
+    # if there are no stations in it.
+    fileobj = open(fullname, 'rb')
+    header = fileobj.readline()
+    fileobj.close()
+    index = json.loads(header.decode('ascii'))
+    if index.get('version') != archiveVersion:
+        raise ValueError('%s is version %s of the archive layout, not %s' % (fullname, index.get('version'), archiveVersion))
+    values = None
+    if index['stations']:
+        values = np.memmap(fullname, dtype = np.int16, mode = 'r', offset = len(header),
+                           shape = (len(index['stations']),) + rowShape)
+    return index, values
+
+
+def writeCycleFile(mostype, cycle, index, rows):
+    # Write one cycle to disk: the index as one line of JSON, then the rows.
+    # Write to a temporary file first and then swap it in (like
+    # scheduler.saveLedger), so readers never see half a cycle.
+    fullname = cyclePath(mostype, cycle)
+    dirname = os.path.dirname(fullname)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    header = json.dumps(index, separators = (',', ':'), sort_keys = True)
+    # Pad the header so the rows start on an even byte
+    if len(header) % 2 == 0:
+        header = header + ' '
+    tempname = fullname + '.tmp'
+    fileobj = open(tempname, 'wb')
+    fileobj.write((header + '\n').encode('ascii'))
+    for row in rows:
+        fileobj.write(np.asarray(row, dtype = np.int16).tobytes())
+    fileobj.close()
+    if os.path.exists(fullname):
+        os.remove(fullname)
+    os.rename(tempname, fullname)
+
+
+def valueColumns(line):
+    # Returns the character column where each value of a MOS line ends, in
+    # the order yoinkFromMOS and packElement see them (the label is left out).
+    ends = []
+    offset = 0
+    for token in line.replace('|', ' ').split(' '):
+        start = offset
+        offset = offset + len(token) + 1
+        if token == '':
+            continue
+        if (len(ends) > 0) and (len(token) > 3):
+            # A value run together with the climo 999999, as in yoinkFromMOS
+            token = token[:-7]
+        token = token.rstrip()
+        if (len(ends) > 0) and (token == ''):
+            continue
+        ends.append(start + len(token))
+    return ends[1:]
+
+
+def forecastHours(lines, cycle):
+    # Returns the forecast hour of each value of each element in elementList,
+    # as {element: [forecast hour or None, ...]}, for one station's MOS.
+    # Elements that aren't in the MOS are left out.
+    #
+    # 'lines' is the same as for StationCycle.fromLines. 'cycle' is a datetime object.
+    import mosplots
+    hourline = ''
+    for line in lines:
+        if line.split()[0:1] in (['HR'], ['FHR']):
+            hourline = line
+            break
+    if not hourline:
+        return {}
+
+    labels = hourline.replace('|', ' ').split()
+    if labels[0] == 'FHR':
+        # The MEX gives forecast hours
+        hours = [int(label) for label in labels[1:]]
+    else:
+        # The MAV and MET give the hour (UTC) of each valid time
+        hours = []
+        fhr = 0
+        previous = cycle.hour
+        for label in labels[1:]:
+            fhr = fhr + (int(label) - previous) % 24
+            previous = int(label)
+            hours.append(fhr)
+    dictColumns = dict(zip(valueColumns(hourline), hours))
+
+    dictHours = {}
+    for wxelement in elementList:
+        arr_element = mosplots.yoinkFromMOS(lines, wxelement)
+        if len(arr_element) == 0:
+            continue
+        # yoinkFromMOS found the line; find it again for the columns
+        for line in lines:
+            if line.split()[0:1] == [arr_element[0]]:
+                dictHours[wxelement] = [dictColumns.get(end) for end in valueColumns(line)][0:numColumns]
+                break
+    return dictHours
+
+
+def packElement(arr_element):
+    # Turn one array returned by yoinkFromMOS (label first) into one line of a row.
+    line = np.empty(numColumns + 1, dtype = np.int16)
+    line.fill(missingValue)
+    values = []
+    for item in arr_element[1:]:
+        item = item.strip()
+        if item == '':
+            # The newline at the end of a padded line
+            continue
+        try:
+            value = float(item)
+        except ValueError:
+            value = np.nan
+        values.append(value)
+    values = values[0:numColumns]
+    line[0] = len(values)
+    for x in range(0, len(values)):
+        if not np.isnan(values[x]):
+            line[x + 1] = int(values[x])
+    return line
+
+
+class StationCycle(object):
+    """ One station's parsed MOS for one cycle, in the same compact form as a row of the archive """
+
+    # No per-instance dictionary: a whole bulletin's history can be kept in memory
+    __slots__ = ('station', 'key', 'row')
+
+    def __init__(self, station, mostype, cycle, row):
+
+        # (string) station ID
+        self.station = station
+
+        # (int) MOS type and cycle in one small number: hours since keyEpoch
+        # times 8, plus the MOS type's place in productList
+        self.key = makeKey(mostype, cycle)
+
+        # (int16 array of shape rowShape) one line per wx element in
+        # elementList: the number of values, then the values padded with
+        # missingValue. Often a read-only view of the archive.
+        self.row = row
+
+
+    @classmethod
+    def fromLines(cls, station, mostype, cycle, lines):
+        # Parse one station's MOS. 'lines' is in the form returned by
+        # mosplots.load_file: keep the newlines, because yoinkFromMOS counts
+        # on them when it trims '999999'.
+        import mosplots
+        row = np.array([packElement(mosplots.yoinkFromMOS(lines, wxelement)) for wxelement in elementList])
+        return cls(station, mostype, cycle, row)
+
+
+    def mostype(self):
+        # MAV, MET, MEX, etc.
+        return productList[self.key % 8]
+
+
+    def cycle(self):
+        # Model cycle as a datetime object
+        return keyEpoch + dt.timedelta(hours = self.key // 8)
+
+
+    def counts(self):
+        # Number of values in each wx element (0 if it isn't in the MOS)
+        return self.row[:, 0]
+
+
+    def missing(self):
+        # Mask of values that are missing (999) or past the end of their line
+        return self.row[:, 1:] == missingValue
+
+
+    def values(self):
+        # Float array of shape (number of elements, numColumns) with nan for missing
+        return np.where(self.missing(), np.nan, self.row[:, 1:])
+
+
+    def elements(self):
+        # Returns the same dictionary as mosplots.loadElements: arrays with
+        # keys 'XN', 'P12', 'WSP', 'Q12'. Each array has a placeholder where
+        # the label would be, then the values as floats with nan for missing,
+        # or is empty if the element isn't in the MOS.
+        dictElements = {}
+        values = self.values()
+        counts = self.counts()
+        for x in range(0, len(elementList)):
+            if counts[x] == 0:
+                dictElements[elementList[x]] = np.array([])
+            else:
+                dictElements[elementList[x]] = np.insert(values[x, 0:counts[x]], 0, np.nan)
+        return dictElements
+
+
+    def __str__(self):
+        return '%s %s %s' % (self.station, self.mostype(), self.cycle().strftime('%Y%m%d_%H'))
+
+
+def makeKey(mostype, cycle):
+    # Returns the StationCycle key of a MOS type and cycle (a datetime object)
+    hours = (cycle - keyEpoch).days * 24 + (cycle - keyEpoch).seconds // 3600
+    return hours * 8 + productList.index(mostype.upper())
+
+
+def archiveStations(mostype, records):
+    # Add stations to the archive as they are parsed.
+    # Returns the number of stations archived.
+    #
+    # 'mostype' is MAV, MET, or MEX. 'records' gives one station at a time,
+    # as yielded by mosHelper.iterStations. A raw file has one cycle, but
+    # 'records' can have any number of them.
+    cycles = {}
+    count = 0
+    for staname, recordtype, cycle, text in records:
+        lines = text.splitlines(True)
+        record = StationCycle.fromLines(staname, mostype, cycle, lines)
+        index, rows = cycles.setdefault(cycle, (newIndex(mostype, cycle), {}))
+        rows[staname.upper()] = record.row
+        # Every station has the same hours, but not every station has every element
+        cyclehours = index['hours']
+        if len(cyclehours) < len(elementList):
+            for wxelement, hours in forecastHours(lines, cycle).items():
+                cyclehours.setdefault(wxelement, hours)
+        count = count + 1
+
+    for cycle in sorted(cycles.keys()):
+        index, rows = cycles[cycle]
+        fullname = cyclePath(mostype, cycle)
+        if os.path.exists(fullname):
+            # Keep the stations of the old file that aren't in this one
+            oldindex, oldvalues = readCycleFile(fullname)
+            for x in range(0, len(oldindex['stations'])):
+                if oldindex['stations'][x] not in rows:
+                    rows[oldindex['stations'][x]] = np.array(oldvalues[x])
+            for wxelement, hours in oldindex['hours'].items():
+                index['hours'].setdefault(wxelement, hours)
+            del oldvalues
+        index['stations'] = sorted(rows.keys())
+        writeCycleFile(mostype, cycle, index, [rows[staname] for staname in index['stations']])
+
+    return count
+
+
+def archiveRawFile(rawfile):
+    # Archive one raw file from the raw files directory, reading it one
+    # station at a time.
+    # Returns the number of stations archived.
+    mostype = mosHelper.transformFilename(rawfile)['mostype'].upper()
+    fullname = os.path.join(mosHelper.getDirNames()['raw'], rawfile)
+    count = archiveStations(mostype, mosHelper.readStations(fullname))
+    logging.getLogger('mosgraphics.mosarchive').info('Archived %d stations from %s', count, rawfile)
+    return count
+
+
+def openCycle(mostype, cycle):
+    # Returns (index, memory-mapped rows) of one MOS type and cycle (a
+    # datetime object), or (None, None) if that cycle isn't archived. Both are
+    # reused until the cycle file changes.
+    fullname = cyclePath(mostype, cycle)
+    try:
+        filestat = os.stat(fullname)
+    except OSError:
+        return None, None
+    stamp = (filestat.st_size, filestat.st_mtime)
+
+    key = (mostype.upper(), cycle.strftime('%Y%m%d%H'))
+    cached = openCycles.get(key)
+    if (cached is not None) and (cached[0] == stamp):
+        return cached[1], cached[2]
+
+    index, values = readCycleFile(fullname)
+    # Row of each station
+    index['rows'] = dict((index['stations'][x], x) for x in range(0, len(index['stations'])))
+    if len(openCycles) >= maxOpenCycles:
+        openCycles.clear()
+    openCycles[key] = (stamp, index, values)
+    return index, values
+
+
+def clearCycles(before):
+    # Delete the cycles of every MOS type from before 'before' (a datetime
+    # object). Returns the number of cycles deleted.
+    dirname = mosHelper.getDirNames()['archive']
+    if not os.path.isdir(dirname):
+        return 0
+    count = 0
+    for mostype in os.listdir(dirname):
+        mosdir = os.path.join(dirname, mostype)
+        if not os.path.isdir(mosdir):
+            continue
+        for year in os.listdir(mosdir):
+            yeardir = os.path.join(mosdir, year)
+            if not os.path.isdir(yeardir):
+                # e.g., values.i16 and index.json of the first version
+                continue
+            for item in os.listdir(yeardir):
+                # YYYYMMDD_HH.mos
+                try:
+                    cycle = dt.datetime.strptime(item, '%Y%m%d_%H.mos')
+                except ValueError:
+                    continue
+                if cycle < before:
+                    os.remove(os.path.join(yeardir, item))
+                    openCycles.pop((mostype, cycle.strftime('%Y%m%d%H')), None)
+                    count = count + 1
+            if not os.listdir(yeardir):
+                os.rmdir(yeardir)
+    return count
+
+
+def readRecord(mostype, staname, cycle):
+    # Returns a StationCycle for one station and cycle (a datetime object)
+    # whose row is a read-only view of the archive, or None if it isn't archived.
+    mostype = mostype.upper()
+    index, values = openCycle(mostype, cycle)
+    if values is None:
+        return None
+    row = index['rows'].get(staname.upper())
+    if row is None:
+        return None
+    return StationCycle(staname, mostype, cycle, values[row])
+
+
+def readElements(mostype, staname, cycle):
+    # Returns one station and cycle from the archive in the same form as
+    # mosplots.loadElements (see StationCycle.elements), or None if it isn't archived.
+    record = readRecord(mostype, staname, cycle)
+    if record is None:
+        return None
+    return record.elements()
+
+
+def readHistory(mostype, staname, cycles):
+    # Returns the archived values for one station over many cycles as a float
+    # array of shape (number of cycles, number of elements, numColumns), with
+    # nan for missing values and for cycles that aren't archived.
+    #
+    # 'cycles' is a list of datetime objects (e.g., the last 30 MAV cycles).
+    history = np.empty((len(cycles), len(elementList), numColumns))
+    history.fill(np.nan)
+    for x in range(0, len(cycles)):
+        record = readRecord(mostype, staname, cycles[x])
+        if record is not None:
+            history[x] = record.values()
+    return history
+
+
+def readCycle(mostype, cycle):
+    # Returns every archived station for one cycle (a datetime object) as a
+    # sorted list of station IDs and an int16 array of their rows, with shape
+    # (number of stations,) + rowShape. Both are empty if nothing is archived.
+    index, values = openCycle(mostype, cycle)
+    if values is None:
+        return [], np.empty((0,) + rowShape, dtype = np.int16)
+    # The stations are already sorted in the file
+    return list(index['stations']), np.array(values)
+
+
+def readHours(mostype, cycle):
+    # Returns the forecast hours of one MOS type and cycle (a datetime object)
+    # as {element: [forecast hour or None, ...]}, or {} if they aren't archived.
+    index, values = openCycle(mostype, cycle)
+    if index is None:
+        return {}
+    return index['hours']
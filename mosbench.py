@@ -0,0 +1,318 @@
+import os, sys, time, json, shutil, platform, tempfile, argparse
+import datetime as dt
+import mosHelper, synthmos
+
+# tracemalloc is new in Python 3.4. Without it, peak memory isn't measured.
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Benchmarks for the parts of a run that grow with the number of stations:
+# mosHelper.parseRawFile and getLatestFilename, and mosplots.yoinkFromMOS,
+# makeDisplayArrays, makePlots, and exportJSON. Each benchmark records its
+# best time and its peak memory (the most memory allocated at once while it ran).
+#
+# Each size gets its own scratch directory with made-up bulletins from synthmos
+# (enough cycles for a full history of each MOS type), so nothing in the real
+# raw files, processed files, or images directories is touched.
+#
+# Example:
+#     python mosbench.py --sizes 10 100 --mos MAV
+#
+# Rendering takes ~0.3 s per image no matter how many stations there are, so
+# only the first few stations of each size are rendered (see --render-limit).
+# Each wx element of the first station is also rendered on its own, named for
+# the size of its display array (e.g., render_mex_p12_15x15).
+#
+# To guard against slowdowns (e.g., before taking changes from upstream), save
+# a baseline on a known good version, then compare against it:
+#     python mosbench.py --save mosbench_baseline.json
+#     python mosbench.py --compare mosbench_baseline.json
+# The comparison lists every benchmark that got slower or bigger by more than
+# --threshold percent and exits with status 1 if there are any. Baselines are
+# only comparable on the same machine and Python version.
+
+# Version of the results file format. Bump this if the format changes.
+resultsVersion = 1
+
+# Benchmarks faster than this many seconds are too noisy to call a regression
+noiseFloor = 0.005
+
+# Number of stations in each run of the suite
+benchSizes = [10, 100, 2000]
+
+# The last cycle of made-up data. Any cycle works; a fixed one keeps the
+# results comparable from one run to the next.
+lastCycle = dt.datetime(2014, 2, 2, 12)
+
+# How many cycles each MOS type needs for a full history (see mosplots.calc_dates)
+dictHistory = {'MAV': 13, 'MET': 6, 'MEX': 16}
+
+
+def timeIt(func, repeat):
+    # Call 'func' (no arguments) 'repeat' times and return the best wall time
+    # in seconds. The best time is the least noisy measure of how fast the
+    # code can go.
+    best = None
+    for x in range(0, repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    return best
+
+
+def peakMemory(func):
+    # Call 'func' (no arguments) once and return the most memory, in KiB, that
+    # it had allocated at any one time. Returns None if tracemalloc isn't
+    # available. Tracing slows everything down, so this is kept separate from
+    # the timing.
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak / 1024.0
+
+
+def setUpData(numstations):
+    # Write the made-up bulletins for 'numstations' stations to the raw files
+    # directory under the current directory, and process all of them.
+    # Returns the list of stations.
+    dictDirNames = mosHelper.getDirNames()
+    for key in ['raw', 'proc', 'img', 'logs']:
+        if not os.path.isdir(dictDirNames[key]):
+            os.makedirs(dictDirNames[key])
+
+    stations = synthmos.makeStationIDs(numstations)
+    # A set makes the setup go faster than the list the benchmark uses
+    staset = set(stations)
+    for mostype in sorted(dictHistory.keys()):
+        for filename in synthmos.writeBulletins([mostype], stations, lastCycle, dictHistory[mostype]):
+            mosHelper.parseRawFile(staset, os.path.join(dictDirNames['raw'], filename))
+
+    return stations
+
+
+def runSize(numstations, mostypes, repeat = 3, renderlimit = 5, sizes = None):
+    # Run every benchmark for one number of stations, in the current directory.
+    # 'sizes' is the list of all the numbers of stations in the suite; the
+    # per-element render benchmarks only run for the smallest one.
+    # Returns a list of dictionaries, one per benchmark, with keys
+    # 'name', 'seconds' (best time), 'items', 'per_item' (seconds), and
+    # 'peak_kib' (peak memory in KiB, or None).
+    import mosplots
+
+    dictDirNames = mosHelper.getDirNames()
+    stations = setUpData(numstations)
+    results = []
+
+    def addResult(name, func, items, repeat):
+        seconds = timeIt(func, repeat)
+        results.append({'name': name, 'seconds': seconds, 'items': items, 'per_item': seconds / items,
+                        'peak_kib': peakMemory(func)})
+
+    for mostype in mostypes:
+        mos = mostype.lower()
+        cycle = synthmos.listCycles(mostype, lastCycle, 1)[0]
+        rawname = mosHelper.makeFilenames(mostype, '', cycle.year, cycle.month, cycle.day, '%02d' % cycle.hour)['raw']
+        procnames = [mosHelper.makeFilenames(mostype, staname, cycle.year, cycle.month, cycle.day, '%02d' % cycle.hour)['proc'] for staname in stations]
+
+        # Split the latest bulletin into station files
+        rawpath = os.path.join(dictDirNames['raw'], rawname)
+        addResult('parse_%s_%d_stations' % (mos, numstations), lambda: mosHelper.parseRawFile(stations, rawpath), numstations, repeat)
+
+        # Find each station's latest file among all of the processed files
+        def latestAll():
+            for staname in stations:
+                mosHelper.getLatestFilename(mostype, staname)
+        addResult('latest_%s_%d_stations' % (mos, numstations), latestAll, numstations, repeat)
+
+        # Pull the elements out of each station file
+        stationlines = [mosplots.load_file(os.path.join(dictDirNames['proc'], fn)) for fn in procnames]
+        def yoinkAll():
+            for lines in stationlines:
+                for wxelement in ['XN', 'P12', 'WSP', 'Q12']:
+                    mosplots.yoinkFromMOS(lines, wxelement)
+        addResult('yoink_%s_%d_stations' % (mos, numstations), yoinkAll, numstations, repeat)
+
+        # Build the display arrays (reads each station's full history)
+        def arraysAll():
+            for fn in procnames:
+                mosplots.makeDisplayArrays(fn)
+        addResult('arrays_%s_%d_stations' % (mos, numstations), arraysAll, numstations, repeat)
+
+        # Write the JSON for the viewer
+        displayed = [mosplots.makeDisplayArrays(fn) for fn in procnames]
+        def exportAll():
+            for plotme, xdt, info, prev in displayed:
+                mosplots.exportJSON(plotme, xdt, info, prev)
+        addResult('export_%s_%d_stations' % (mos, numstations), exportAll, numstations, repeat)
+
+        # Render the images for the first few stations. Once is plenty.
+        if renderlimit > 0:
+            displayed = displayed[0:renderlimit]
+        def renderAll():
+            for plotme, xdt, info, prev in displayed:
+                mosplots.makePlots(plotme, xdt, info, prev)
+        addResult('render_%s_%d_stations' % (mos, numstations), renderAll, len(displayed), 1)
+
+        # Render each wx element of the first station by itself. The size of
+        # the display array doesn't depend on the number of stations, so only
+        # do this once.
+        if (sizes is None) or (numstations == min(sizes)):
+            plotme, xdt, info, prev = displayed[0]
+            for wx in sorted(plotme.keys()):
+                rows, cols = plotme[wx].shape
+                name = 'render_%s_%s_%dx%d' % (mos, wx.lower(), rows, cols)
+                addResult(name, lambda: mosplots.makePlots({wx: plotme[wx]}, xdt, info, prev), 1, 1)
+
+    return results
+
+
+def runSuite(sizes = None, mostypes = None, repeat = 3, renderlimit = 5, keep = False):
+    # Run the benchmarks for each number of stations in 'sizes', each in its
+    # own scratch directory (deleted afterwards unless 'keep' is True).
+    # Returns the combined list of results from runSize.
+    if sizes is None:
+        sizes = benchSizes
+    if mostypes is None:
+        mostypes = sorted(dictHistory.keys())
+
+    results = []
+    startdir = os.getcwd()
+    for numstations in sizes:
+        workdir = tempfile.mkdtemp(prefix = 'mosbench_%d_' % numstations)
+        try:
+            os.chdir(workdir)
+            results.extend(runSize(numstations, mostypes, repeat, renderlimit, sizes))
+        finally:
+            os.chdir(startdir)
+            if keep:
+                print('Kept %s' % workdir)
+            else:
+                shutil.rmtree(workdir)
+
+    return results
+
+
+def printResults(results):
+    # A table of the results, one line per benchmark
+    print('%-30s %7s %10s %13s %11s' % ('benchmark', 'items', 'best (s)', 'per item (ms)', 'peak (KiB)'))
+    for result in results:
+        if result['peak_kib'] is None:
+            peak = '-'
+        else:
+            peak = '%.0f' % result['peak_kib']
+        print('%-30s %7d %10.3f %13.3f %11s' % (result['name'], result['items'], result['seconds'], 1000 * result['per_item'], peak))
+
+
+def saveResults(results, filename):
+    # Save the results (e.g., as a baseline) to a JSON file, along with what
+    # they were measured on.
+    dictSaved = {'version': resultsVersion,
+                 'created': dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                 'python': platform.python_version(),
+                 'platform': platform.platform(),
+                 'benchmarks': {}
+                 }
+    for result in results:
+        dictSaved['benchmarks'][result['name']] = result
+
+    fileobj = open(filename, 'w')
+    json.dump(dictSaved, fileobj, indent = 1, sort_keys = True)
+    fileobj.close()
+
+
+def loadResults(filename):
+    # Load results saved by saveResults.
+    # Returns the dictionary that was saved.
+    fileobj = open(filename, 'r')
+    dictSaved = json.load(fileobj)
+    fileobj.close()
+
+    if dictSaved.get('version') != resultsVersion:
+        raise ValueError('%s is version %s of the results format, not %s' % (filename, dictSaved.get('version'), resultsVersion))
+
+    return dictSaved
+
+
+def compareResults(baseline, results, threshold = 20):
+    # Compare 'results' (a list from runSuite) with 'baseline' (a dictionary
+    # from loadResults).
+    # Returns a list of regressions, each a tuple of (benchmark name, what
+    # ('time' or 'memory'), baseline value, new value, percent change).
+    #
+    # Time is compared per item, so a different --render-limit still compares
+    # fairly. Benchmarks that aren't in the baseline are skipped.
+    regressions = []
+    for result in results:
+        base = baseline['benchmarks'].get(result['name'])
+        if base is None:
+            continue
+
+        if max(base['seconds'], result['seconds']) >= noiseFloor:
+            change = 100.0 * (result['per_item'] - base['per_item']) / base['per_item']
+            if change > threshold:
+                regressions.append((result['name'], 'time', base['per_item'], result['per_item'], change))
+
+        if (base['peak_kib'] is not None) and (result['peak_kib'] is not None) and (base['peak_kib'] > 0):
+            change = 100.0 * (result['peak_kib'] - base['peak_kib']) / base['peak_kib']
+            if change > threshold:
+                regressions.append((result['name'], 'memory', base['peak_kib'], result['peak_kib'], change))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Time parsing, display arrays, and rendering on made-up bulletins.')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = benchSizes,
+                        help = 'numbers of stations (default: %s)' % ' '.join([str(n) for n in benchSizes]))
+    parser.add_argument('--mos', nargs = '+', default = ['MAV', 'MET', 'MEX'],
+                        help = 'MOS types (default: MAV MET MEX)')
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'times to run each benchmark, keeping the best (default: 3)')
+    parser.add_argument('--render-limit', dest = 'renderlimit', type = int, default = 5,
+                        help = 'stations to render for each size, 0 for all of them (default: 5)')
+    parser.add_argument('--keep', action = 'store_true',
+                        help = 'keep the scratch directories')
+    parser.add_argument('--save', metavar = 'FILE', default = None,
+                        help = 'save the results to FILE (e.g., as a baseline)')
+    parser.add_argument('--compare', metavar = 'FILE', default = None,
+                        help = 'compare the results with a baseline saved in FILE')
+    parser.add_argument('--threshold', type = float, default = 20,
+                        help = 'percent slower or bigger than the baseline that counts as a regression (default: 20)')
+    args = parser.parse_args()
+
+    # Load the baseline first so that a bad file doesn't waste a whole run
+    baseline = None
+    if args.compare is not None:
+        baseline = loadResults(args.compare)
+
+    results = runSuite(args.sizes, [m.upper() for m in args.mos], args.repeat, args.renderlimit, args.keep)
+    printResults(results)
+
+    if args.save is not None:
+        saveResults(results, args.save)
+        print('Saved the results to %s' % args.save)
+
+    if baseline is not None:
+        names = set([result['name'] for result in results])
+        missing = sorted(set(baseline['benchmarks'].keys()) - names)
+        if missing:
+            print('Not run this time: %s' % ', '.join(missing))
+        regressions = compareResults(baseline, results, args.threshold)
+        if regressions:
+            print('Regressions of more than %g%% compared to %s (%s):' % (args.threshold, args.compare, baseline['created']))
+            for name, what, before, after, change in regressions:
+                if what == 'time':
+                    print('  %-30s time   %10.3f -> %10.3f ms per item (+%.0f%%)' % (name, 1000 * before, 1000 * after, change))
+                else:
+                    print('  %-30s memory %10.0f -> %10.0f KiB (+%.0f%%)' % (name, before, after, change))
+            sys.exit(1)
+        print('No regressions of more than %g%% compared to %s' % (args.threshold, args.compare))
@@ -0,0 +1,271 @@
+import os, json, zlib, logging, argparse
+import datetime as dt
+import mosHelper, scheduler
+
+# Keep raw files past the time purge.cleanHouse would delete them, in one
+# compressed bundle per MOS type and day:
+#
+#     raw_bundles/MAV/2014/mav-2014-02-02.txt.gz
+#     raw_bundles/MAV/2014/mav-2014-02-02.json
+#
+# The .gz file is a series of gzip members, one per station (plus whatever is
+# between them) of each cycle, so 'zcat' gives back the raw files of that day
+# one after the other, byte for byte. The .json file is its index: for each
+# cycle, the raw filename, its signature (scheduler.rawSignature) when it was
+# bundled, and where each member starts and how long it is. One station of one
+# cycle is one seek and one small decompress, no matter how big the bundle is.
+#
+# Members are only ever appended; if a raw file is bundled again, the index
+# points to the new members and the old ones are just dead weight (like
+# mosarchive).
+#
+# backfill.py reads the cycles here as if their raw files were still on disk.
+# To put a cycle's raw file back in the raw files directory:
+#     python mosbundle.py --mos MAV --cycle 2014020212 --restore
+# or print one station:
+#     python mosbundle.py --mos MAV --cycle 2014020212 --station KSTL
+
+# Version of the bundle layout. Bump this if the layout changes.
+bundleVersion = 1
+
+# zlib compression level, from 1 (fastest) to 9 (smallest)
+compressLevel = 9
+
+# The station separator (see mosHelper.stationSeparator) without its newline,
+# which may be \r\n in a raw file written on Windows
+separatorBytes = mosHelper.stationSeparator.rstrip('\n').encode('ascii')
+
+
+def bundlePath(mostype, day, ext):
+    # Full path of the bundle ('.txt.gz') or its index ('.json') for one MOS
+    # type and day (a datetime object). One directory per MOS type and year
+    # keeps the directories small. Creates the directory if needed.
+    dirname = os.path.join(mosHelper.getDirNames()['bundles'], mostype.upper(), day.strftime('%Y'))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    return os.path.join(dirname, '%s-%s%s' % (mostype.lower(), day.strftime('%Y-%m-%d'), ext))
+
+
+def rawCycle(rawfile):
+    # Returns the model cycle of a raw file as a datetime object.
+    dictParms = mosHelper.transformFilename(rawfile)
+    return dt.datetime(int(dictParms['year']), int(dictParms['month']), int(dictParms['day']), int(dictParms['cycle']))
+
+
+def loadIndex(mostype, day):
+    # Returns the index of one bundle, or an empty one if there is no bundle yet.
+    #     'size': bytes of the bundle that the index accounts for
+    #     'cycles': {'HH': {'raw': raw filename, 'signature': [size, mtime],
+    #                       'members': [[station ID or '', offset, length], ...]}}
+    fullname = bundlePath(mostype, day, '.json')
+    if not os.path.exists(fullname):
+        return {'version': bundleVersion, 'size': 0, 'cycles': {}}
+    fileobj = open(fullname, 'r')
+    index = json.load(fileobj)
+    fileobj.close()
+    if index.get('version') != bundleVersion:
+        raise ValueError('%s is version %s of the bundle layout, not %s' % (fullname, index.get('version'), bundleVersion))
+    return index
+
+
+def saveIndex(mostype, day, index):
+    # Write the index to disk. Write to a temporary file first and then swap
+    # it in (like scheduler.saveLedger), so readers never see half an index.
+    fullname = bundlePath(mostype, day, '.json')
+    tempname = fullname + '.tmp'
+    fileobj = open(tempname, 'w')
+    json.dump(index, fileobj, separators = (',', ':'), sort_keys = True)
+    fileobj.close()
+    if os.path.exists(fullname):
+        os.remove(fullname)
+    os.rename(tempname, fullname)
+
+
+def iterMembers(fileobj):
+    # Split a raw file (opened in binary mode) into the pieces that become
+    # gzip members: each station's lines through the separator after them.
+    # Yields (station ID or '' if the piece isn't a station, bytes).
+    piece = []
+    for line in fileobj:
+        piece.append(line)
+        if line.rstrip(b'\r\n') == separatorBytes:
+            yield memberStation(piece), b''.join(piece)
+            piece = []
+    if piece:
+        yield memberStation(piece), b''.join(piece)
+
+
+def memberStation(piece):
+    # Station ID of a piece of a raw file, or '' if it doesn't start with a
+    # station header
+    record = mosHelper.stationRecord([piece[0].decode('latin-1')])
+    if record is None:
+        return ''
+    return record[0]
+
+
+def compress(data):
+    # One gzip member
+    compressor = zlib.compressobj(compressLevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def bundleRawFile(rawfile):
+    # Add one raw file from the raw files directory to the bundle of its day.
+    # Returns the number of stations bundled.
+    mostype = mosHelper.transformFilename(rawfile)['mostype'].upper()
+    cycle = rawCycle(rawfile)
+    index = loadIndex(mostype, cycle)
+    fullname = os.path.join(mosHelper.getDirNames()['raw'], rawfile)
+    signature = scheduler.rawSignature(rawfile)
+
+    bundlename = bundlePath(mostype, cycle, '.txt.gz')
+    if os.path.exists(bundlename):
+        bundle = open(bundlename, 'r+b')
+    else:
+        bundle = open(bundlename, 'wb')
+    # Anything past the size in the index is left over from an append that
+    # never made it into the index. Write over it.
+    bundle.seek(index['size'])
+    bundle.truncate()
+
+    members = []
+    offset = index['size']
+    rawobj = open(fullname, 'rb')
+    try:
+        for staname, data in iterMembers(rawobj):
+            member = compress(data)
+            bundle.write(member)
+            members.append([staname, offset, len(member)])
+            offset = offset + len(member)
+    finally:
+        rawobj.close()
+        bundle.close()
+
+    # The new members only count once they are in the index
+    index['size'] = offset
+    index['cycles'][cycle.strftime('%H')] = {'raw': rawfile, 'signature': signature, 'members': members}
+    saveIndex(mostype, cycle, index)
+
+    count = len([member for member in members if member[0]])
+    logging.getLogger('mosgraphics.mosbundle').info('Bundled %d stations from %s (%d bytes to %d)', count, rawfile, signature[0], sum(member[2] for member in members))
+    return count
+
+
+def cycleEntry(mostype, cycle):
+    # Returns the index entry of one MOS type and cycle (a datetime object),
+    # or None if it isn't bundled.
+    if not os.path.exists(bundlePath(mostype, cycle, '.json')):
+        return None
+    return loadIndex(mostype, cycle)['cycles'].get(cycle.strftime('%H'))
+
+
+def readMembers(mostype, cycle, members):
+    # Returns the decompressed text of some members of one bundle, as a list
+    # of strings. 'members' is a list from the bundle's index.
+    fileobj = open(bundlePath(mostype, cycle, '.txt.gz'), 'rb')
+    texts = []
+    try:
+        for staname, offset, length in members:
+            fileobj.seek(offset)
+            texts.append(zlib.decompress(fileobj.read(length), 16 + zlib.MAX_WBITS).decode('latin-1'))
+    finally:
+        fileobj.close()
+    return texts
+
+
+def readStation(mostype, cycle, staname):
+    # Returns one station's MOS for one cycle (a datetime object) as it was in
+    # the raw file (through the separator after it), or None if it isn't bundled.
+    entry = cycleEntry(mostype, cycle)
+    if entry is None:
+        return None
+    members = [member for member in entry['members'] if member[0] == staname.upper()]
+    if not members:
+        return None
+    return readMembers(mostype, cycle, members[-1:])[0]
+
+
+def listBundled(mostype):
+    # Returns the names of the raw files of one MOS type that are bundled
+    dirname = os.path.join(mosHelper.getDirNames()['bundles'], mostype.upper())
+    rawfiles = []
+    if not os.path.isdir(dirname):
+        return rawfiles
+    for year in sorted(os.listdir(dirname)):
+        for item in sorted(os.listdir(os.path.join(dirname, year))):
+            if item.endswith('.json'):
+                fileobj = open(os.path.join(dirname, year, item), 'r')
+                index = json.load(fileobj)
+                fileobj.close()
+                rawfiles.extend(entry['raw'] for entry in index['cycles'].values())
+    return sorted(rawfiles)
+
+
+def bundledSignature(rawfile):
+    # Returns the signature a bundled raw file had on disk, or None if it
+    # isn't bundled
+    entry = cycleEntry(mosHelper.transformFilename(rawfile)['mostype'], rawCycle(rawfile))
+    if entry is None:
+        return None
+    return entry['signature']
+
+
+def parseBundled(stalist, rawfile):
+    # Same as mosHelper.parseRawFile, for a raw file that is bundled. Only the
+    # stations in 'stalist' are read.
+    # Returns the number of processed files written.
+    mostype = mosHelper.transformFilename(rawfile)['mostype']
+    cycle = rawCycle(rawfile)
+    entry = cycleEntry(mostype, cycle)
+    if entry is None:
+        return 0
+    members = [member for member in entry['members'] if member[0] and (member[0] in stalist)]
+    count = 0
+    for text in readMembers(mostype, cycle, members):
+        # The same lines that mosHelper.iterStations would have read
+        lines = [line for line in text.replace('\r\n', '\n').splitlines(True) if line != mosHelper.stationSeparator]
+        record = mosHelper.stationRecord(lines)
+        if record is not None:
+            mosHelper.writeStation(record[0], record[1], record[2], record[3])
+            count = count + 1
+    return count
+
+
+def restoreRawFile(mostype, cycle):
+    # Write a bundled raw file back to the raw files directory, exactly as it
+    # was. Returns its name, or None if it isn't bundled.
+    entry = cycleEntry(mostype, cycle)
+    if entry is None:
+        return None
+    fullname = os.path.join(mosHelper.getDirNames()['raw'], entry['raw'])
+    fileobj = open(fullname, 'wb')
+    for text in readMembers(mostype, cycle, entry['members']):
+        fileobj.write(text.encode('latin-1'))
+    fileobj.close()
+    return entry['raw']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Read raw files back out of the daily bundles.')
+    parser.add_argument('--mos', required = True,
+                        help = 'MOS type (MAV, MEX, MET)')
+    parser.add_argument('--cycle', required = True,
+                        help = 'cycle as YYYYMMDDHH')
+    parser.add_argument('--station', default = None,
+                        help = 'print this station\'s MOS')
+    parser.add_argument('--restore', action = 'store_true',
+                        help = 'put the raw file back in the raw files directory')
+    args = parser.parse_args()
+
+    cycle = dt.datetime.strptime(args.cycle, '%Y%m%d%H')
+    if args.station is not None:
+        text = readStation(args.mos, cycle, args.station)
+        if text is None:
+            parser.error('%s %s %s isn\'t bundled' % (args.station, args.mos, args.cycle))
+        print(text.rstrip())
+    if args.restore:
+        rawfile = restoreRawFile(args.mos, cycle)
+        if rawfile is None:
+            parser.error('%s %s isn\'t bundled' % (args.mos, args.cycle))
+        print('Restored %s' % rawfile)
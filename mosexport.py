@@ -0,0 +1,169 @@
+import os, logging, argparse
+import datetime as dt
+import numpy as np
+import mosHelper, mosarchive, scheduler
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # pyarrow is optional. Without it, nothing is exported.
+    pa = None
+    pq = None
+
+# Export the parsed MOS in the archive (see mosarchive) as Arrow IPC and/or
+# Parquet files, so other tools can read it without parsing any text. There
+# is one file per format, MOS type, and cycle, partitioned by MOS type and date
+# (Hive style, so pyarrow.dataset can read a whole tree at once):
+#
+#     export/arrow/mos=MAV/date=20140202/MAV-20140202_12.arrow
+#
+# Each file is a table with one row per station, wx element, and value:
+#     cycle: model cycle (UTC timestamp)
+#     station: station ID (dictionary encoded)
+#     element: XN, P12, WSP, or Q12 (dictionary encoded), as in mosarchive.elementList
+#     column: position of the value in the element's line, counting from 0 after
+#             the label (the same positions makeDisplayArrays picks from)
+#     hour: forecast hour of the value (from the HR or FHR line), or null if
+#           there is none (the MEX's climatology) or the cycle was archived
+#           without hours (see mosarchive)
+#     valid: valid time of the value (UTC timestamp), cycle + hour
+#     value: the value, or null if it is 999 (missing)
+# The MOS type and cycle are also in the schema metadata and the file name.
+#
+# The Arrow files can be memory-mapped (pyarrow.memory_map and
+# pyarrow.ipc.open_file) without reading them in; the Parquet files are
+# smaller. mosGraphicsTask exports every cycle it archives. To export cycles
+# that were archived earlier:
+#     python mosexport.py --start 2014020100 --end 2014020712 --mos MAV MEX --format arrow parquet
+
+# File extension of each export format
+dictFormats = {'arrow': '.arrow', 'parquet': '.parquet'}
+
+# Warn only once per process that pyarrow is missing
+warnedMissing = []
+
+
+def exportPath(mostype, cycle, fmt):
+    # Full path of the exported file for one MOS type, cycle (a datetime
+    # object), and format. Creates the directory if needed.
+    dirname = os.path.join(mosHelper.getDirNames()['export'], fmt, 'mos=%s' % mostype.upper(), 'date=%s' % cycle.strftime('%Y%m%d'))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    filename = '%s-%s%s' % (mostype.upper(), cycle.strftime('%Y%m%d_%H'), dictFormats[fmt])
+    return os.path.join(dirname, filename)
+
+
+def cycleTable(mostype, cycle):
+    # Returns a pyarrow Table of every archived station for one MOS type and
+    # cycle (a datetime object), or None if nothing is archived for it.
+    stations, rows = mosarchive.readCycle(mostype, cycle)
+    if not stations:
+        return None
+
+    # Pick out the values that are really there (column 0 of each line is the count)
+    counts = rows[:, :, 0]
+    present = np.arange(mosarchive.numColumns) < counts[:, :, np.newaxis]
+    staindex, elindex, colindex = np.nonzero(present)
+    values = rows[:, :, 1:][staindex, elindex, colindex]
+
+    # Forecast hour of each element and column, -1 where there is none
+    hourTable = np.empty((len(mosarchive.elementList), mosarchive.numColumns), dtype = np.int16)
+    hourTable.fill(-1)
+    for wxelement, hours in mosarchive.readHours(mostype, cycle).items():
+        for x in range(0, len(hours)):
+            if hours[x] is not None:
+                hourTable[mosarchive.elementList.index(wxelement), x] = hours[x]
+    hours = hourTable[elindex, colindex]
+    nohour = (hours < 0)
+    cycleseconds = (cycle - dt.datetime(1970, 1, 1)).days * 86400 + (cycle - dt.datetime(1970, 1, 1)).seconds
+    validseconds = cycleseconds + hours.astype(np.int64) * 3600
+
+    table = pa.Table.from_arrays([
+        pa.array([cycle] * len(values), type = pa.timestamp('s', tz = 'UTC')),
+        pa.DictionaryArray.from_arrays(pa.array(staindex.astype(np.int32)), pa.array(stations)),
+        pa.DictionaryArray.from_arrays(pa.array(elindex.astype(np.int8)), pa.array(mosarchive.elementList)),
+        pa.array(colindex.astype(np.int8)),
+        pa.array(hours, mask = nohour),
+        pa.array(validseconds, mask = nohour, type = pa.timestamp('s', tz = 'UTC')),
+        pa.array(values, mask = (values == mosarchive.missingValue)),
+        ], names = ['cycle', 'station', 'element', 'column', 'hour', 'valid', 'value'])
+    return table.replace_schema_metadata({'mos': mostype.upper(), 'cycle': cycle.strftime('%Y-%m-%dT%H:00Z')})
+
+
+def exportCycle(mostype, cycle, formats):
+    # Export one MOS type and cycle (a datetime object) from the archive in
+    # each of 'formats' (keys of dictFormats).
+    # Returns a list of the files written.
+    module_logger = logging.getLogger('mosgraphics.mosexport')
+    if pa is None:
+        if not warnedMissing:
+            module_logger.warning('pyarrow isn\'t installed, so nothing will be exported')
+            warnedMissing.append(True)
+        return []
+
+    table = cycleTable(mostype, cycle)
+    if table is None:
+        module_logger.info('Nothing archived for %s %s', mostype, cycle.strftime('%Y%m%d_%H'))
+        return []
+
+    written = []
+    for fmt in formats:
+        # Write to a temporary file first and then swap it in, so a reader
+        # never maps half a file
+        fullname = exportPath(mostype, cycle, fmt)
+        tempname = fullname + '.tmp'
+        if fmt == 'arrow':
+            sink = pa.OSFile(tempname, 'wb')
+            writer = pa.ipc.new_file(sink, table.schema)
+            writer.write_table(table)
+            writer.close()
+            sink.close()
+        else:
+            pq.write_table(table, tempname)
+        if os.path.exists(fullname):
+            os.remove(fullname)
+        os.rename(tempname, fullname)
+        written.append(fullname)
+
+    module_logger.info('Exported %d rows of %s %s as %s', table.num_rows, mostype, cycle.strftime('%Y%m%d_%H'), ', '.join(formats))
+    return written
+
+
+def exportRawFile(rawfile, formats):
+    # Export the cycle of one raw file, which must already be archived.
+    # Returns a list of the files written.
+    dictParms = mosHelper.transformFilename(rawfile)
+    cycle = dt.datetime(int(dictParms['year']), int(dictParms['month']), int(dictParms['day']), int(dictParms['cycle']))
+    return exportCycle(dictParms['mostype'].upper(), cycle, formats)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Export archived MOS cycles as Arrow IPC and/or Parquet files.')
+    parser.add_argument('--start', required = True,
+                        help = 'first cycle as YYYYMMDDHH')
+    parser.add_argument('--end', default = None,
+                        help = 'last cycle as YYYYMMDDHH (default: same as --start)')
+    parser.add_argument('--mos', nargs = '+', default = scheduler.moslist,
+                        help = 'MOS types (default: %s)' % ' '.join(scheduler.moslist))
+    parser.add_argument('--format', nargs = '+', default = ['arrow'], choices = sorted(dictFormats.keys()),
+                        help = 'export formats (default: arrow)')
+    args = parser.parse_args()
+
+    logger = mosHelper.setUpTheLogger()
+    if pa is None:
+        parser.error('pyarrow isn\'t installed')
+
+    start = dt.datetime.strptime(args.start, '%Y%m%d%H')
+    if args.end is None:
+        end = start
+    else:
+        end = dt.datetime.strptime(args.end, '%Y%m%d%H')
+
+    # Every cycle of every MOS type falls on a multiple of 6 hours
+    cycle = start
+    while cycle <= end:
+        for mostype in args.mos:
+            exportCycle(mostype.upper(), cycle, args.format)
+        cycle = cycle + dt.timedelta(hours = 6)
+    logging.shutdown()
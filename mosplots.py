@@ -1,9 +1,27 @@
+import matplotlib
+# The images are only ever saved to files, so skip the GUI backend. Importing
+# pyplot with the default (Tk) backend is noticeably slower.
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+# Set the font size once, before any figure exists. It used to be set inside
+# the makePlots loop, after the first figure was built, so the first image a
+# process drew came out with the default font size and every later one with 12.
+plt.rcParams['font.size'] = 12
 import matplotlib.colors as mcolors
+import matplotlib.image as mpimg
 import numpy as np
 import datetime as dt
 import matplotlib.dates as mpd
-import string, re, os, logging, mosHelper
+# use AxesGrid1 toolkit to explicitly create an axes for the colorbar so tight_layout will work
+from mpl_toolkits.axes_grid1 import make_axes_locatable
+import string, re, os, json, hashlib, logging, mosHelper, mosarchive, runstats
+
+try:
+    from PIL import Image
+except ImportError:
+    # PIL (Pillow) is optional. Without it, images are written by matplotlib
+    # as full RGBA PNGs and most of mosHelper.getImageSettings is ignored.
+    Image = None
 
 # written: Dec 2012 (LMK)
 #
@@ -14,6 +32,25 @@ import string, re, os, logging, mosHelper
 # Take as input: MOS type, station name, and model run date/time
 # Keep a rolling archive of text files to create these graphics
 
+# Names of the wx elements as they appear in plot titles and output filenames.
+# MosGraphicsViewer.html builds its filenames from these, so keep them in sync.
+dictWxNames = {'X':'MaxT', 'N':'MinT', 'P12':'PoP12', 'WSP': 'WindSpd', 'Q12': 'Q12'}
+
+# Colormaps that take some work to build are built once and kept here.
+colormapCache = {}
+
+# Caches that only pay off in a long-running process (see the daemon mode in
+# mosGraphicsTask). They stay off (None) unless enableWarmCaches is called.
+# historyCache: {full path of a processed file: ((size, mtime), mosarchive.StationCycle)}
+# figureCache: {figsize: figure to clear and reuse}
+historyCache = None
+figureCache = None
+
+# Look for station histories in the archive of parsed MOS (see mosarchive)
+# before reading and parsing the processed files. Anything not in the archive
+# is still read from the processed files.
+useArchive = True
+
 def load_file(filename):
     # Load a text file of a single station for processing.
     # Returns the file contents as a list of strings (one line per string).
@@ -192,6 +229,89 @@ def yoinkFromMOS(data, wxelement):
     return np.array(arr_element)
 
 
+def loadElements(fullname):
+    # Load a single station's processed file and pull out the wx elements that
+    # makeDisplayArrays needs.
+    # Returns a dictionary of arrays with keys 'XN', 'P12', 'WSP', 'Q12' (see
+    # mosarchive.StationCycle.elements). Like the arrays returned by
+    # yoinkFromMOS, each one starts with a placeholder for the label, but
+    # the values are floats with nan for missing.
+    #
+    # 'fullname' is the full path of the processed file. If the file doesn't
+    # exist, the error is passed along to the caller.
+    #
+    # If the station and cycle are in the archive, the file isn't read at
+    # all. If the history cache is on, a file that hasn't changed since the
+    # last time it was loaded is not read or parsed again. Either way, the
+    # station and cycle are held as a compact mosarchive.StationCycle.
+    dictParms = mosHelper.transformFilename(os.path.basename(fullname))
+    mostype = dictParms['mostype']
+    staname = dictParms['staname']
+    cycle = dt.datetime(int(dictParms['year']), int(dictParms['month']), int(dictParms['day']), int(dictParms['cycle']))
+
+    if useArchive:
+        record = mosarchive.readRecord(mostype, staname, cycle)
+        if record is not None:
+            return record.elements()
+
+    if historyCache is not None:
+        filestat = os.stat(fullname)
+        key = (filestat.st_size, filestat.st_mtime)
+        cached = historyCache.get(fullname)
+        if (cached is not None) and (cached[0] == key):
+            return cached[1].elements()
+
+    record = mosarchive.StationCycle.fromLines(staname, mostype, cycle, load_file(fullname))
+
+    if historyCache is not None:
+        historyCache[fullname] = (key, record)
+
+    return record.elements()
+
+
+def enableWarmCaches():
+    # Keep parsed station histories and figures around between calls. This is
+    # only worth it in a process that makes graphics over and over (the daemon
+    # mode in mosGraphicsTask); a single run would just use more memory.
+    global historyCache, figureCache
+    if historyCache is None:
+        historyCache = {}
+    if figureCache is None:
+        figureCache = {}
+
+
+def pruneWarmCaches():
+    # Drop cached station histories whose processed files have been deleted.
+    if historyCache is None:
+        return
+    for fullname in list(historyCache.keys()):
+        if not os.path.exists(fullname):
+            del historyCache[fullname]
+
+
+def newFigure(figsize):
+    # Returns a blank figure of the given size and makes it the current figure.
+    # With the figure cache on, one figure per size is cleared and reused
+    # instead of being built from scratch every time.
+    if figureCache is None:
+        return plt.figure(figsize = figsize)
+
+    fig = figureCache.get(figsize)
+    if fig is None:
+        fig = plt.figure(figsize = figsize)
+        figureCache[figsize] = fig
+    else:
+        fig.clf()
+        plt.figure(fig.number)
+    return fig
+
+
+def closeFigure(fig):
+    # Counterpart of newFigure. Figures in the figure cache stay open for reuse.
+    if figureCache is None:
+        plt.close(fig)
+
+
 def makeDisplayArrays(filename):
     # Given a filename of the expected form, figure out which previous
     # files are needed to construct complete arrays of all data needed
@@ -221,12 +341,12 @@ def makeDisplayArrays(filename):
     for fn in prevfiles:
         try:
             fullname2 = os.path.join(dictDirNames['proc'], fn)
-            dd = load_file(fullname2)
+            dictElements = loadElements(fullname2)
             #fhr = yoinkFromMOS(dd, 'FHR')
-            xn = yoinkFromMOS(dd, 'XN')
-            p12 = yoinkFromMOS(dd, 'P12')
-            wsp = yoinkFromMOS(dd, 'WSP')
-            q12 = yoinkFromMOS(dd, 'Q12')
+            xn = dictElements['XN']
+            p12 = dictElements['P12']
+            wsp = dictElements['WSP']
+            q12 = dictElements['Q12']
             # As a side note, fhr, xn, p12 will have length 0 if the
             # wxelement was not found in MOS. This matters later.
             #allf.append(fhr)
@@ -459,7 +579,7 @@ def makeDisplayArrays(filename):
         for row in range(0, len(varResult)):
             validline = varData[row][1:] #toss leading 'X/N' or 'N/X'
             inds = np.arange(jumpindex, dictSize[modelKey][wx]['stop'], dictSize[modelKey][wx]['step'])
-            if validline != []:
+            if len(validline) > 0:
                 varResult[row, 0:len(inds)] = validline[inds]
             # dictSize[modelKey][wx]['jump'] is a single number unless MOSTYPE is the MAV.
             # For the MAV, need to alternate between the two jump indices.
@@ -512,57 +632,24 @@ def makeDisplayArrays(filename):
     return dispArr, dtXaxis, infoDict, prevruns
 
 
-def makePlots(displayArrays, dtXaxis, info, prevRuns):
-    # Step 3: Profit. Make the plots and save them as files.
-    # Returns nothing (except profit).
+def colorSettings(wx, values):
+    # Choose the colormap, value range, and colorbar ticks for a wx element.
+    # Returns a dictionary with keys 'cmap', 'vmin', 'vmax', 'cbarticks', and 'extend'.
     #
-    # 'displayArrays' is a dictionary of arrays returned by makeDisplayArrays
-    # 'dtXaxis' is a dictionary of datetime objects, returned by makeDisplayArrays, from which to create x-axis labels
-    # 'info' is a dictionary of information returned by find_info
-    # 'prevRuns' is a list of datetime objects (including the current run)
-
-    # Grab a reference to the existing logger.
-    # This only works if the script calling this function has
-    # already called mosHelper.setUpTheLogger().
-    module_logger = logging.getLogger('mosgraphics.makePlots')
-
-    def determineFigureSize(wxkey, mostype):
-        # wxkey: (string) X, N, P12, WSP, etc.
-        # mostype: (string) info['MOSTYPE'].replace('MOS GUIDANCE', '').strip()
-        
-        # Figure size depends on both MOS type and wx element.
-        figgy = (0, 0)
-
-        dictFigSize = {
-            'X': (7, 10),
-            'N': (7, 10),
-            'P12': (14, 10),
-            'WSP': {
-                'GFSX': (14, 10),
-                'NAM': (12, 6),
-                'GFS': (14, 7),
-            },
-            'Q12': (14, 10)
-        }
+    # 'wx' is a key of the dictionary returned by makeDisplayArrays (X, N, P12, etc.)
+    # 'values' is an array of the values to be plotted (nan for missing). Only the
+    # elements that autoscale (X, N) care what's in it.
 
-        if wxkey in ['X', 'N', 'P12', 'Q12']:
-            figgy = dictFigSize[wxkey]
-        else:
-            figgy = dictFigSize[wxkey][mostype]
-
-        return figgy
+    # Default is to extend neither side of the colorbar, but some wx elements
+    # will alter this.
+    extend = 'neither'
     
-
-    for wx in displayArrays.keys():
-
-        # Default is to extend neither side of the colorbar, but some wx elements
-        # will alter this.
-        extend = 'neither'
+    if wx == 'P12':
+        # Pop12 spans from 0 to 100. No matter what values are actually present,
+        # always use the same color curve for displaying those values.
         
-        if wx == 'P12':
-            # Pop12 spans from 0 to 100. No matter what values are actually present,
-            # always use the same color curve for displaying those values.
-            
+        # Building the color curve is fiddly, so only do it once per process.
+        if 'P12' not in colormapCache:
             # Define a special color curve for PoP12. RGB values:
             BrBu = np.array([
                 [191, 129, 45],
@@ -595,55 +682,53 @@ def makePlots(displayArrays, dtXaxis, info, prevRuns):
                 'blue': tuple(tempB)
                 }
             p12map = mcolors.LinearSegmentedColormap('some_map', cdict, 256)
-            cmap = p12map
-            vmin = 0
-            vmax = 100
-            #figsize = (14,10)
-            figsize = determineFigureSize(wx, info['MOSTYPE'].replace('MOS GUIDANCE', '').strip())
-            cbarticks = np.arange(0, 110, 10)
-            
-        elif ((wx == 'X') or (wx == 'N')):
-            # For MaxT and MinT, let matplotlib autoscale based on the values in the data.
-            # That way, it's easy to see hot/cold trends at a glance.
-            cmap = plt.cm.RdYlBu_r
-            vmin = np.nanmin(displayArrays[wx])
-            vmax = np.nanmax(displayArrays[wx])
-            #figsize = (7,10)
-            figsize = determineFigureSize(wx, info['MOSTYPE'].replace('MOS GUIDANCE', '').strip())
-            # For large temp ranges, the color bar scale can get pretty crowded. For small
-            # temp ranges, the default algorithm creates decimal degrees which aren't
-            # meaningful. To address this, declare that if the range is big (20 degrees),
-            # only show ticks every 5 degrees and be clever about picking the upper
-            # and lower bounds. Otherwise, show ticks every 2 degrees, and massage vmax/vmin
-            # to prevent the upper and lower bounds from being left off.
-            #if (abs(vmax - vmin) >= 20):
-            #    cbarstep = 5
-            #else:
-            #    cbarstep = 2
-            #vmin = vmin - (vmin % cbarstep)
-            #vmax = vmax + cbarstep - (vmax % cbarstep)
-            #cbarticks = np.arange(vmin, vmax + cbarstep, cbarstep)
-            
-            # On second thought, let's just do it every 5 degrees no matter what. This will
-            # help address the problem of large color differences between numerically similar
-            # values, especially when abs(vmax - vmin) is small.
-            cbarstep = 5
-            vmin = vmin - (vmin % cbarstep)
-            vmax = vmax + cbarstep - (vmax % cbarstep)
-            cbarticks = np.arange(vmin, vmax + cbarstep, cbarstep)
-                
-            #if vmin % 2 == 1:
-            #    vmin = vmin + 1
-            #if vmax % 2 == 1:
-            #    vmax = vmax - 1   
-            #cbarticks = np.arange(vmin, vmax+1, cbarstep)
+            colormapCache['P12'] = p12map
+        cmap = colormapCache['P12']
+        vmin = 0
+        vmax = 100
+        cbarticks = np.arange(0, 110, 10)
+        
+    elif ((wx == 'X') or (wx == 'N')):
+        # For MaxT and MinT, let matplotlib autoscale based on the values in the data.
+        # That way, it's easy to see hot/cold trends at a glance.
+        cmap = plt.cm.RdYlBu_r
+        vmin = np.nanmin(values)
+        vmax = np.nanmax(values)
+        # For large temp ranges, the color bar scale can get pretty crowded. For small
+        # temp ranges, the default algorithm creates decimal degrees which aren't
+        # meaningful. To address this, declare that if the range is big (20 degrees),
+        # only show ticks every 5 degrees and be clever about picking the upper
+        # and lower bounds. Otherwise, show ticks every 2 degrees, and massage vmax/vmin
+        # to prevent the upper and lower bounds from being left off.
+        #if (abs(vmax - vmin) >= 20):
+        #    cbarstep = 5
+        #else:
+        #    cbarstep = 2
+        #vmin = vmin - (vmin % cbarstep)
+        #vmax = vmax + cbarstep - (vmax % cbarstep)
+        #cbarticks = np.arange(vmin, vmax + cbarstep, cbarstep)
+        
+        # On second thought, let's just do it every 5 degrees no matter what. This will
+        # help address the problem of large color differences between numerically similar
+        # values, especially when abs(vmax - vmin) is small.
+        cbarstep = 5
+        vmin = vmin - (vmin % cbarstep)
+        vmax = vmax + cbarstep - (vmax % cbarstep)
+        cbarticks = np.arange(vmin, vmax + cbarstep, cbarstep)
             
-        elif wx == 'WSP':
+        #if vmin % 2 == 1:
+        #    vmin = vmin + 1
+        #if vmax % 2 == 1:
+        #    vmax = vmax - 1   
+        #cbarticks = np.arange(vmin, vmax+1, cbarstep)
+        
+    elif wx == 'WSP':
 
-            cbarstep = 10
-            vmin = 0
-            vmax = 30
-            
+        cbarstep = 10
+        vmin = 0
+        vmax = 30
+        
+        if 'WSP' not in colormapCache:
             # Create a new colormap based on a subset of an existing colormap. Thanks,
             # StackOverflow!
             cmap = plt.get_cmap('YlOrBr')
@@ -654,102 +739,545 @@ def makePlots(displayArrays, dtXaxis, info, prevRuns):
 
             # Set the "over" color so it stands out like a beacon
             new_cmap.set_over('blueviolet')
-            extend = 'max'
-            
-            cmap = new_cmap
+            colormapCache['WSP'] = new_cmap
 
-            #figsize = (14,10)
-            figsize = determineFigureSize(wx, info['MOSTYPE'].replace('MOS GUIDANCE', '').strip())
-            cbarticks = np.arange(vmin, vmax + cbarstep, cbarstep)
+        cmap = colormapCache['WSP']
+        extend = 'max'
 
-        elif wx == 'Q12':
-            cbarstep = 1
-            vmin = 0
-            vmax = 7 # the max value is 6, but use 7 here to make the colorbar look better.
+        cbarticks = np.arange(vmin, vmax + cbarstep, cbarstep)
 
-            # There are 7 categories for QPF, numbered 0-6. Extract 7 discrete colors from
-            # the colormap.
-            cmap = plt.get_cmap('YlGn', 7)
+    elif wx == 'Q12':
+        cbarstep = 1
+        vmin = 0
+        vmax = 7 # the max value is 6, but use 7 here to make the colorbar look better.
 
-            figsize = determineFigureSize(wx, info['MOSTYPE'].replace('MOS GUIDANCE', '').strip())
-            cbarticks = np.arange(vmin, vmax + cbarstep, cbarstep) + 0.5
+        # There are 7 categories for QPF, numbered 0-6. Extract 7 discrete colors from
+        # the colormap.
+        cmap = plt.get_cmap('YlGn', 7)
+
+        # One tick in the middle of each category's color, labeled by
+        # makePlots and makeOverview with the category number.
+        cbarticks = np.arange(vmin, vmax, cbarstep) + 0.5
+    
+    else:
+        # good luck
+        cmap = plt.cm.Blues
+        vmin = np.nanmin(values)
+        vmax = np.nanmax(values)
+        cbarticks = np.arange(vmin, vmax, 5)
+
+    dictColor = {'cmap': cmap, 'vmin': vmin, 'vmax': vmax, 'cbarticks': cbarticks, 'extend': extend}
+    return dictColor
+
+
+def makePlots(displayArrays, dtXaxis, info, prevRuns, imgdir = None, images = True, sprite = False):
+    # Step 3: Profit. Make the plots and save them as files.
+    # Returns nothing (except profit).
+    #
+    # 'displayArrays' is a dictionary of arrays returned by makeDisplayArrays
+    # 'dtXaxis' is a dictionary of datetime objects, returned by makeDisplayArrays, from which to create x-axis labels
+    # 'info' is a dictionary of information returned by find_info
+    # 'prevRuns' is a list of datetime objects (including the current run)
+    # 'imgdir' is the directory to save the images in (default: the images directory)
+    # 'images' saves one image (and its thumbnails) per wx element
+    # 'sprite' also puts every wx element into one sprite sheet (see writeSprite)
+
+    if imgdir is None:
+        imgdir = mosHelper.getDirNames()['img']
+
+    # Grab a reference to the existing logger.
+    # This only works if the script calling this function has
+    # already called mosHelper.setUpTheLogger().
+    module_logger = logging.getLogger('mosgraphics.makePlots')
+
+    # Every file written, for the manifest
+    written = []
+
+    # (wx element name, raster) of each plot, for the sprite sheet
+    panels = []
+
+    def determineFigureSize(wxkey, mostype):
+        # wxkey: (string) X, N, P12, WSP, etc.
+        # mostype: (string) info['MOSTYPE'].replace('MOS GUIDANCE', '').strip()
         
+        # Figure size depends on both MOS type and wx element.
+        figgy = (0, 0)
+
+        dictFigSize = {
+            'X': (7, 10),
+            'N': (7, 10),
+            'P12': (14, 10),
+            'WSP': {
+                'GFSX': (14, 10),
+                'NAM': (12, 6),
+                'GFS': (14, 7),
+            },
+            'Q12': (14, 10)
+        }
+
+        if wxkey in ['X', 'N', 'P12', 'Q12']:
+            figgy = dictFigSize[wxkey]
+        elif wxkey in dictFigSize:
+            figgy = dictFigSize[wxkey][mostype]
         else:
             # good luck
-            cmap = plt.cm.Blues
-            vmin = np.nanmin(displayArrays[wx])
-            vmax = np.nanmax(displayArrays[wx])
-            figsize = (10,10)
-            cbarticks = np.arange(vmin, vmax, 5)
-        
-        plotthis = displayArrays[wx]
-        fig = plt.figure(figsize = figsize)
-        ax = fig.add_subplot(1,1,1)
-        im = ax.imshow(plotthis, origin = 'upper', interpolation = 'nearest', cmap = cmap, vmin = vmin, vmax = vmax)
-
-        # Getting the figures to look right is a balance between figsize,
-        # rcParams font size, and the font size of the text labels in the boxes.
-        # If the figure size is too small, the x-axis labels overlap severely. If
-        # the font size of the x-axis labels is too small, the figure is hard to read.
-
-        # Plot the numbers centered in the boxes
-        for r in np.arange(0, len(plotthis)):
-            for c in np.arange(0, len(plotthis[0])):
-                if not(np.isnan(plotthis[r,c])):
-                    plt.text(c, r, int(plotthis[r,c]), fontsize = 20, horizontalalignment = 'center', verticalalignment = 'center')
-
-        # Add a descriptive title
-        wxnames = {'X':'MaxT', 'N':'MinT', 'P12':'PoP12', 'WSP': 'WindSpd', 'Q12': 'Q12'}
-        strTitle = info['STANAME'] + ' ' + info['MOSTYPE'] + '\n' + info['RUNDATE'] + ' ' + info['RUNTIME'] + ' ' + wxnames[wx]
-        plt.title(strTitle)
-
-        # y-axis settings: previous model runs date/time
-        yticks = np.arange(0, len(plotthis))
-        ylabels = []
-        for item in prevRuns:
-            ylabels.append(item.strftime('%m/%d %HZ'))
-        ax.set_yticks(yticks)
-        ax.set_yticklabels(ylabels)
-        ax.set_ylabel('Model cycle')
-
-        # x-axis settings: fcst valid date/time
-        xticks = np.arange(0, len(plotthis[0]))
-        ax.set_xticks(xticks)
-        xlabels = []
-        for item in dtXaxis[wx]:
-            xlabels.append(item.strftime('%a\n%m/%d\n%HZ'))
-        ax.set_xticklabels(xlabels)
-        ax.set_xlabel('Fcst valid date/time')
-
-        # use AxesGrid1 toolkit to explicitly create an axes for the colorbar so tight_layout will work
-        from mpl_toolkits.axes_grid1 import make_axes_locatable
-        divider = make_axes_locatable(plt.gca())
-        #cax = divider.append_axes('right', '5%', pad = '3%')
-        # use a constant size and padding (units are inches) for a uniform look among plots
-        cax = divider.append_axes('right', size = 0.25, pad = 0.2)
-        cbar = plt.colorbar(im, cax = cax, extend = extend, ticks = cbarticks)
-
-        # Set colorbar tick labels for the special case of the discrete colorbar (Q12)
-        if wx == 'Q12':
-            ticklabels = [0, 1, 2, 3, 4, 5, 6]
-            cbar.set_ticklabels(ticklabels)
-
-        plt.rcParams['font.size'] = 12
-        plt.tight_layout()
-
-        # A good file name for daily use (overwriting) should include station, MOS type, and weather element.
-        mosname = info['MOSTYPE'].split(' ')[0] # GFSX -> MEX, NAM -> MET, GFS -> MAV
-        imgfilename = '%s_%s_%s.png' % (info['STANAME'], mosname, wxnames[wx])
-        imgpath = os.path.join('images', imgfilename)
-        plt.savefig(imgpath)
-        module_logger.info('Saved %s', imgfilename)
-
-        # Clean up the memory to avoid crashing during large loops
-        plt.close(fig)
+            figgy = (10, 10)
+
+        return figgy
+    
+
+    for wx in displayArrays.keys():
+
+        with runstats.stage('render', station = info['STANAME']) as st:
+
+            dictColor = colorSettings(wx, displayArrays[wx])
+            cmap = dictColor['cmap']
+            vmin = dictColor['vmin']
+            vmax = dictColor['vmax']
+            cbarticks = dictColor['cbarticks']
+            extend = dictColor['extend']
+            figsize = determineFigureSize(wx, info['MOSTYPE'].replace('MOS GUIDANCE', '').strip())
+
+            plotthis = displayArrays[wx]
+            fig = newFigure(figsize)
+            ax = fig.add_subplot(1,1,1)
+            im = ax.imshow(plotthis, origin = 'upper', interpolation = 'nearest', cmap = cmap, vmin = vmin, vmax = vmax)
+
+            # Getting the figures to look right is a balance between figsize,
+            # rcParams font size, and the font size of the text labels in the boxes.
+            # If the figure size is too small, the x-axis labels overlap severely. If
+            # the font size of the x-axis labels is too small, the figure is hard to read.
+
+            # Plot the numbers centered in the boxes
+            for r in np.arange(0, len(plotthis)):
+                for c in np.arange(0, len(plotthis[0])):
+                    if not(np.isnan(plotthis[r,c])):
+                        plt.text(c, r, int(plotthis[r,c]), fontsize = 20, horizontalalignment = 'center', verticalalignment = 'center')
+
+            # Add a descriptive title
+            strTitle = info['STANAME'] + ' ' + info['MOSTYPE'] + '\n' + info['RUNDATE'] + ' ' + info['RUNTIME'] + ' ' + dictWxNames[wx]
+            plt.title(strTitle)
+
+            # y-axis settings: previous model runs date/time
+            yticks = np.arange(0, len(plotthis))
+            ylabels = []
+            for item in prevRuns:
+                ylabels.append(item.strftime('%m/%d %HZ'))
+            ax.set_yticks(yticks)
+            # One label per tick: matplotlib 3.5 and newer won't take extras
+            ax.set_yticklabels(ylabels[0:len(yticks)])
+            ax.set_ylabel('Model cycle')
+
+            # x-axis settings: fcst valid date/time
+            xticks = np.arange(0, len(plotthis[0]))
+            ax.set_xticks(xticks)
+            xlabels = []
+            for item in dtXaxis[wx]:
+                xlabels.append(item.strftime('%a\n%m/%d\n%HZ'))
+            ax.set_xticklabels(xlabels[0:len(xticks)])
+            ax.set_xlabel('Fcst valid date/time')
+
+            # Explicitly create an axes for the colorbar so tight_layout will work
+            divider = make_axes_locatable(plt.gca())
+            #cax = divider.append_axes('right', '5%', pad = '3%')
+            # use a constant size and padding (units are inches) for a uniform look among plots
+            cax = divider.append_axes('right', size = 0.25, pad = 0.2)
+            cbar = plt.colorbar(im, cax = cax, extend = extend, ticks = cbarticks)
+
+            # Set colorbar tick labels for the special case of the discrete colorbar (Q12)
+            if wx == 'Q12':
+                ticklabels = [int(tick) for tick in cbarticks]
+                cbar.set_ticklabels(ticklabels)
+
+            plt.tight_layout()
+
+            # A good file name for daily use (overwriting) should include station, MOS type, and weather element.
+            mosname = info['MOSTYPE'].split(' ')[0] # GFSX -> MEX, NAM -> MET, GFS -> MAV
+            imgfilename = '%s_%s_%s.png' % (info['STANAME'], mosname, dictWxNames[wx])
+            imgpath = os.path.join(imgdir, imgfilename)
+            rgba = drawFigure(fig)
+            st.key = imgfilename
+            if images:
+                written.extend(writeImages(rgba, imgpath))
+                module_logger.info('Saved %s', imgfilename)
+                st.nbytes = os.path.getsize(imgpath)
+            if sprite:
+                # The raster belongs to the figure, which may be reused for the next plot
+                panels.append((dictWxNames[wx], rgba.copy()))
+
+            # Clean up the memory to avoid crashing during large loops
+            closeFigure(fig)
         
         
     #plt.show()
 
+    if panels:
+        with runstats.stage('sprite', station = info['STANAME'], items = len(panels)) as st:
+            spritepath = writeSprite(info['STANAME'], mosname, imgdir, panels)
+            st.key = os.path.basename(spritepath)
+            st.nbytes = os.path.getsize(spritepath)
+        written.append(spritepath)
+        module_logger.info('Saved %s', os.path.basename(spritepath))
+
+    if mosHelper.getImageSettings()['manifest'] and written:
+        writeManifest(info['STANAME'], info['MOSTYPE'].split(' ')[0], info, imgdir, written)
+
+
+def makeOverview(groupname, stationResults):
+    # Draw every station in a group (e.g., a CWA from mosHelper.setStations) as
+    # small multiples, one figure per wx element, so a whole CWA can be scanned
+    # at a glance from a single image. All panels share one colormap and one
+    # colorbar, and each figure is laid out and saved once.
+    # Returns nothing.
+    #
+    # 'groupname' is the name of the station group (LSX, EAX_lite, etc.). It
+    # becomes the first part of the filename: GROUP_MOS_Elem.png
+    # 'stationResults' is a list with one entry per station, all for the same
+    # MOS type. Each entry is the tuple returned by makeDisplayArrays.
+
+    # Grab a reference to the existing logger.
+    # This only works if the script calling this function has
+    # already called mosHelper.setUpTheLogger().
+    module_logger = logging.getLogger('mosgraphics.makeOverview')
+
+    if len(stationResults) == 0:
+        return
+
+    # Every station has the same MOS type and (hopefully) the same run, so take
+    # the title information from the first one.
+    info = stationResults[0][2]
+    mosname = info['MOSTYPE'].split(' ')[0] # GFSX -> MEX, NAM -> MET, GFS -> MAV
+    imgdir = mosHelper.getDirNames()['img']
+    written = []
+
+    for wx in dictWxNames.keys():
+        # Some stations don't have every element (e.g., NSTU has no X/N)
+        panels = [(result[2]['STANAME'], result[0][wx]) for result in stationResults if wx in result[0]]
+        if len(panels) == 0:
+            continue
+
+        # Use the same color scale for every station so the panels can be compared.
+        allvalues = np.concatenate([np.ravel(arr) for staname, arr in panels])
+        dictColor = colorSettings(wx, allvalues)
+
+        # Lay the panels out in a roughly square grid. Each panel is small, so skip
+        # the numbers and axis labels; the individual station images have those.
+        ncols = int(np.ceil(np.sqrt(len(panels))))
+        nrows = int(np.ceil(len(panels) / float(ncols)))
+        with runstats.stage('render', items = len(panels)) as st:
+            fig = newFigure((3 * ncols + 1, 2.5 * nrows + 1))
+            for p in range(0, len(panels)):
+                staname, plotthis = panels[p]
+                ax = fig.add_subplot(nrows, ncols, p + 1)
+                im = ax.imshow(plotthis, origin = 'upper', interpolation = 'nearest', aspect = 'auto',
+                               cmap = dictColor['cmap'], vmin = dictColor['vmin'], vmax = dictColor['vmax'])
+                ax.set_title(staname)
+                ax.set_xticks([])
+                ax.set_yticks([])
+
+            strTitle = groupname + ' ' + info['MOSTYPE'] + ' ' + info['RUNDATE'] + ' ' + info['RUNTIME'] + ' ' + dictWxNames[wx]
+            fig.suptitle(strTitle)
+            fig.subplots_adjust(left = 0.03, right = 0.88, bottom = 0.03, top = 0.9, wspace = 0.1, hspace = 0.25)
+            # One colorbar for all of the panels
+            cax = fig.add_axes([0.91, 0.1, 0.02, 0.75])
+            cbar = fig.colorbar(im, cax = cax, extend = dictColor['extend'], ticks = dictColor['cbarticks'])
+            if wx == 'Q12':
+                cbar.set_ticklabels([int(tick) for tick in dictColor['cbarticks']])
+
+            imgfilename = '%s_%s_%s.png' % (groupname, mosname, dictWxNames[wx])
+            imgpath = os.path.join(imgdir, imgfilename)
+            written.extend(saveFigure(fig, imgpath))
+            module_logger.info('Saved %s', imgfilename)
+
+            # Clean up the memory to avoid crashing during large loops
+            closeFigure(fig)
+
+            st.key = imgfilename
+            st.nbytes = os.path.getsize(imgpath)
+
+    if mosHelper.getImageSettings()['manifest'] and written:
+        writeManifest(groupname, mosname, info, imgdir, written)
+
+
+def saveFigure(fig, imgpath):
+    # Save a figure as a PNG using the settings from mosHelper.getImageSettings.
+    # Returns the full paths of the files written: the image, then its thumbnails.
+    #
+    # 'fig' is a matplotlib figure, ready to be drawn.
+    # 'imgpath' is the full path of the PNG to write.
+    return writeImages(drawFigure(fig), imgpath)
+
+
+def drawFigure(fig):
+    # Draw a figure into the Agg canvas, once.
+    # Returns the raster as a [rows, cols, 4] array of uint8. It's a view of
+    # the canvas, so it's only good until the figure is drawn again.
+    fig.canvas.draw()
+    width, height = fig.canvas.get_width_height()
+    return np.frombuffer(fig.canvas.buffer_rgba(), dtype = np.uint8).reshape(height, width, 4)
+
+
+def writeImages(rgba, imgpath):
+    # Write the raster of a figure (from drawFigure) as a PNG and its thumbnails.
+    # Returns the full paths of the files written: the image, then its thumbnails.
+    #
+    # The one raster is written as the full-size image, then shrunk in memory
+    # for each of the thumbnail sizes, so the thumbnails don't cost another
+    # matplotlib draw. A thumbnail of KSTL_GFS_MaxT.png is named
+    # KSTL_GFS_MaxT_thumb.png, and so on.
+    writeRaster(rgba, imgpath)
+    written = [imgpath]
+
+    dictImgSettings = mosHelper.getImageSettings()
+    base, ext = os.path.splitext(imgpath)
+    for suffix, factor in dictImgSettings['thumbnails'].items():
+        thumbpath = '%s_%s%s' % (base, suffix, ext)
+        writeRaster(shrinkRaster(rgba, factor), thumbpath)
+        written.append(thumbpath)
+
+    return written
+
+
+def shrinkRaster(rgba, factor):
+    # Shrink an RGBA raster (a [rows, cols, 4] array of uint8) by an integer
+    # factor by averaging each factor x factor block of pixels. Leftover rows
+    # and columns at the edges are dropped.
+    # Returns the smaller raster.
+    rows = rgba.shape[0] // factor
+    cols = rgba.shape[1] // factor
+    blocks = rgba[0:rows * factor, 0:cols * factor].reshape(rows, factor, cols, factor, 4)
+    return blocks.mean(axis = 3).mean(axis = 1).astype(np.uint8)
+
+
+def writeRaster(rgba, imgpath, colors = None):
+    # Write an RGBA raster (a [rows, cols, 4] array of uint8) as a PNG using
+    # the settings from mosHelper.getImageSettings.
+    # Returns nothing.
+    #
+    # PIL quantizes the raster to a palette of 'colors' colors (default: the
+    # 'colors' setting) and compresses it. If PIL isn't available, matplotlib
+    # writes it as a plain RGBA PNG.
+    if Image is None:
+        mpimg.imsave(imgpath, rgba)
+        return
+
+    dictImgSettings = mosHelper.getImageSettings()
+
+    # The plots are opaque, so the alpha channel is dead weight.
+    img = Image.fromarray(np.ascontiguousarray(rgba[:, :, 0:3]))
+
+    if dictImgSettings['fast']:
+        quantizer = Image.FASTOCTREE
+        compress_level = 1
+    else:
+        quantizer = Image.MEDIANCUT
+        compress_level = dictImgSettings['compress_level']
+
+    if colors is None:
+        colors = dictImgSettings['colors']
+
+    if dictImgSettings['palette']:
+        img = img.quantize(colors = colors, method = quantizer)
+
+    img.save(imgpath, 'PNG', compress_level = compress_level)
+
+
+def spriteLayout(sizes):
+    # Lay out the panels of a sprite sheet in rows, narrowest first, each row
+    # no wider than the widest panel (so MaxT and MinT share a row).
+    # Returns (width, height, offsets) of the sheet, where offsets is
+    # {name: {'x', 'y', 'w', 'h'}} in pixels.
+    #
+    # 'sizes' is a list of (name, width, height) of the panels.
+    sheetwidth = max(width for name, width, height in sizes)
+    offsets = {}
+    x = 0
+    y = 0
+    rowheight = 0
+    # sorted() is stable, so panels of the same width stay in the order given
+    for name, width, height in sorted(sizes, key = lambda size: size[1]):
+        if x + width > sheetwidth:
+            x = 0
+            y = y + rowheight
+            rowheight = 0
+        offsets[name] = {'x': x, 'y': y, 'w': width, 'h': height}
+        x = x + width
+        rowheight = max(rowheight, height)
+    return sheetwidth, y + rowheight, offsets
+
+
+def writeSprite(name, mosname, imgdir, panels):
+    # Put the plots of one station and MOS type into one sprite sheet,
+    # NAME_MOS_sprite.png (e.g., KSTL_GFS_sprite.png), and write where each
+    # panel is in NAME_MOS_sprite.json, next to the images.
+    # Returns the full path of the sprite sheet.
+    #
+    # 'name' is the station ID, and 'mosname' is GFS, GFSX, or NAM.
+    # 'panels' is a list of (wx element name, raster from drawFigure).
+    #
+    # MosGraphicsViewer.html reads the JSON and shows each panel as a window
+    # onto the sheet (CSS background-position), so a station takes one image
+    # request per MOS type instead of one per wx element. The JSON has the
+    # content hash of the sheet, so the viewer can ask for it the same way as
+    # the images in a manifest (see writeManifest).
+    dictImgSettings = mosHelper.getImageSettings()
+    sizes = [(wxname, rgba.shape[1], rgba.shape[0]) for wxname, rgba in panels]
+    width, height, offsets = spriteLayout(sizes)
+
+    # Blank space (next to a narrow panel) is white, like the plots
+    sheet = np.empty((height, width, 4), dtype = np.uint8)
+    sheet.fill(255)
+    for wxname, rgba in panels:
+        box = offsets[wxname]
+        sheet[box['y']:box['y'] + box['h'], box['x']:box['x'] + box['w']] = rgba
+
+    spritename = '%s_%s_sprite.png' % (name, mosname)
+    spritepath = os.path.join(imgdir, spritename)
+    # One palette has to cover every wx element's colormap
+    writeRaster(sheet, spritepath, dictImgSettings['sprite_colors'])
+
+    dictOut = {
+        'name': name,
+        'mos': mosname,
+        'image': spritename,
+        'hash': contentHash(spritepath),
+        'width': width,
+        'height': height,
+        'panels': offsets
+        }
+    jsonpath = os.path.join(imgdir, '%s_%s_sprite.json' % (name, mosname))
+    # Write to a temporary file first and then swap it in, like writeManifest
+    tempname = jsonpath + '.tmp'
+    fileobj = open(tempname, 'w')
+    json.dump(dictOut, fileobj, separators = (',', ':'), sort_keys = True)
+    fileobj.close()
+    if os.path.exists(jsonpath):
+        os.remove(jsonpath)
+    os.rename(tempname, jsonpath)
+
+    return spritepath
+
+
+def contentHash(fullname):
+    # Returns a short hash of a file's contents (the first 12 hex digits of
+    # its SHA-1). It only has to tell one version of an image from the next.
+    fileobj = open(fullname, 'rb')
+    digest = hashlib.sha1(fileobj.read()).hexdigest()
+    fileobj.close()
+    return digest[0:12]
+
+
+def writeManifest(name, mosname, info, imgdir, imgpaths, merge = False):
+    # Write the manifest of one station (or group) and MOS type: a small JSON
+    # file, NAME_MOS_manifest.json (e.g., KSTL_GFS_manifest.json), next to the
+    # images, with the content hash of each image (and of STAID_MOS.json).
+    # Returns the name of the file that was written.
+    #
+    # 'name' is the station ID or group name, and 'mosname' is GFS, GFSX, or NAM.
+    # 'info' is the dictionary returned by find_info, for the cycle.
+    # 'imgpaths' is a list of the full paths of the files, as returned by saveFigure.
+    # 'merge' keeps what is already in the manifest for the same cycle and
+    # adds these files to it (exportJSON, after makePlots). Otherwise, the
+    # manifest lists only these files.
+    #
+    # MosGraphicsViewer.html reads the manifest and asks for
+    # images/KSTL_GFS_MaxT.png?v=<hash>. The URL only changes when the file
+    # does, so the browser (told by the web server to keep anything with a
+    # ?v= for a year; see mosserver) only downloads the files that changed
+    # since the last visit. The filenames themselves stay the same.
+    manifestname = '%s_%s_manifest.json' % (name, mosname)
+    manifestpath = os.path.join(imgdir, manifestname)
+    cycle = '%s %s' % (info['RUNDATE'], info['RUNTIME'])
+
+    dictOut = {
+        'name': name,
+        'mos': mosname,
+        'cycle': cycle,
+        'files': {}
+        }
+    if merge and os.path.exists(manifestpath):
+        try:
+            fileobj = open(manifestpath, 'r')
+            dictOld = json.load(fileobj)
+            fileobj.close()
+        except ValueError:
+            dictOld = {}
+        # Files from an older cycle are out of date (e.g., images from before
+        # outputModes dropped 'png'), so leave them out
+        if dictOld.get('cycle') == cycle:
+            dictOut['files'].update(dictOld.get('files', {}))
+    for imgpath in imgpaths:
+        dictOut['files'][os.path.basename(imgpath)] = contentHash(imgpath)
+
+    # Write to a temporary file first and then swap it in (like
+    # scheduler.saveLedger), so the viewer never reads half a manifest.
+    tempname = manifestpath + '.tmp'
+    fileobj = open(tempname, 'w')
+    json.dump(dictOut, fileobj, separators = (',', ':'), sort_keys = True)
+    fileobj.close()
+    if os.path.exists(manifestpath):
+        os.remove(manifestpath)
+    os.rename(tempname, manifestpath)
+    logging.getLogger('mosgraphics.writeManifest').debug('Saved %s', manifestname)
+
+    return manifestname
+
+
+def exportJSON(displayArrays, dtXaxis, info, prevRuns, imgdir = None):
+    # Write the display arrays for one station and MOS type to a compact JSON
+    # file so that MosGraphicsViewer.html can draw the grids in the browser
+    # instead of loading one PNG per wx element. A few KB of numbers replaces
+    # hundreds of KB of images, and no matplotlib rendering is needed.
+    # Returns the name of the file that was written.
+    #
+    # The arguments are the same as for makePlots. The file is named
+    # STAID_MOS.json (e.g., KSTL_GFS.json) and lives next to the images
+    # (in 'imgdir', if given).
+    #
+    # JSON has no representation for nan, so missing values are written as null.
+    # Datetimes are written as 'YYYY-MM-DDTHH:MMZ' strings.
+
+    # Grab a reference to the existing logger.
+    # This only works if the script calling this function has
+    # already called mosHelper.setUpTheLogger().
+    module_logger = logging.getLogger('mosgraphics.exportJSON')
+
+    dictOut = {
+        'station': info['STANAME'],
+        'mos': info['MOSTYPE'].split(' ')[0],
+        'rundate': info['RUNDATE'],
+        'runtime': info['RUNTIME'],
+        'runs': [item.strftime('%m/%d %HZ') for item in prevRuns],
+        'valid': {},
+        'data': {}
+        }
+
+    for wx in displayArrays.keys():
+        rows = []
+        for row in displayArrays[wx]:
+            rows.append([None if np.isnan(val) else int(val) for val in row])
+        dictOut['data'][dictWxNames[wx]] = rows
+        # dtXaxis runs out to 216 hours; only keep the labels for columns that exist
+        ncols = np.shape(displayArrays[wx])[1]
+        dictOut['valid'][dictWxNames[wx]] = [item.strftime('%Y-%m-%dT%H:%MZ') for item in dtXaxis[wx][0:ncols]]
+
+    jsonfilename = '%s_%s.json' % (dictOut['station'], dictOut['mos'])
+    if imgdir is None:
+        imgdir = mosHelper.getDirNames()['img']
+    jsonpath = os.path.join(imgdir, jsonfilename)
+    with runstats.stage('export', key = jsonfilename, station = dictOut['station']) as st:
+        fileobj = open(jsonpath, 'w')
+        # No whitespace between separators to keep the payload small.
+        json.dump(dictOut, fileobj, separators = (',', ':'))
+        fileobj.close()
+        st.nbytes = os.path.getsize(jsonpath)
+    module_logger.info('Saved %s', jsonfilename)
+
+    if mosHelper.getImageSettings()['manifest']:
+        writeManifest(dictOut['station'], dictOut['mos'], info, imgdir, [jsonpath], merge = True)
+
+    return jsonfilename
+
 #################################
 # test cases that pass with flying colors
 #testfn = 'ECESTL20121207_00'
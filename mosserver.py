@@ -0,0 +1,411 @@
+import os, shutil, posixpath, threading, logging, argparse
+from collections import OrderedDict
+import mosHelper, scheduler, coordinator, runstats, stationcatalog
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, unquote, parse_qs
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+
+# A small web server that makes the graphics when someone asks for them,
+# instead of making every station's graphics on every run.
+#
+# Example: serve MosGraphicsViewer.html and the graphics at http://localhost:8080/
+#     python mosserver.py --port 8080
+#
+# Requests for images/STAID_MOS_Elem.png (and the _thumb images, the sprite
+# sheet, STAID_MOS.json, and the manifest) are made from the latest processed
+# data for that station, the same way mosGraphicsTask would make them, the
+# first time they're asked for. Everything made for a station and MOS type is kept in an LRU cache,
+# both in memory and on disk (in the cache directory), until either limit
+# below is reached or a new cycle of that MOS type arrives in the raw files
+# directory. The viewer and anything else in the images directory (overview
+# images, etc.) are served as is from the current directory (see servedFiles).
+#
+# Images asked for with the content hash from their manifest (?v=<hash>, see
+# mosplots.writeManifest) are sent with far-future cache headers, and
+# everything else with no-cache. Any other web server serving the images
+# directory should do the same for URLs with a 'v' query parameter.
+#
+# Run mosGraphicsTask (or GoGetFiles) on its usual schedule to fetch new raw
+# files. Set its outputModes to [] (or just ['overview']) to stop it from
+# making every station's graphics.
+
+# Address and port to listen on. The default only takes requests from this
+# machine; use '' (or --bind '') to take them from anywhere.
+bind = '127.0.0.1'
+port = 8080
+
+# What's served from the current directory besides the graphics made on
+# demand: the viewer, the local copy of jQuery it loads, and anything in the
+# images directory. Everything else there (raw and processed files, logs,
+# state) is a 404.
+servedFiles = ['MosGraphicsViewer.html']
+servedDirs = [mosHelper.getDirNames()['img'], 'jquery-ui-1.10.3.custom']
+
+# Most bytes of images and JSON to keep in memory
+memoryLimit = 64 * 1024 * 1024
+
+# Most bytes of images and JSON to keep in the cache directory
+diskLimit = 512 * 1024 * 1024
+
+# Seconds that browsers may keep an image asked for with a content hash
+# (images/KSTL_GFS_MaxT.png?v=<hash>) without asking again. A year is the
+# longest HTTP/1.1 allows.
+versionedMaxAge = 365 * 24 * 3600
+
+# Content type of each file extension served
+dictContentTypes = {'.png': 'image/png',
+                    '.json': 'application/json',
+                    '.html': 'text/html',
+                    '.js': 'application/javascript',
+                    '.css': 'text/css',
+                    }
+
+
+def parseImageName(filename):
+    # Returns (MOS type, station ID) for the name of a file that makePlots or
+    # exportJSON writes (e.g., KSTL_GFS_MaxT.png, KSTL_GFSX_PoP12_thumb.png,
+    # KSTL_NAM.json, KSTL_GFS_manifest.json, KSTL_GFS_sprite.png and .json),
+    # or None if it isn't one. The overviews that makeOverview writes
+    # (LSX_GFS_MaxT.png, TEST_GFSX_Q12.png) look the same, so the station has
+    # to be in the station table or the MOS type's latest raw file, and can't
+    # be the name of a group in mosHelper.setStations.
+    import mosplots
+    base, ext = os.path.splitext(filename)
+    parts = base.split('_')
+    if (len(parts) < 2) or (parts[1] not in mosHelper.modelNames):
+        return None
+    if parts[2:] == ['sprite']:
+        if ext not in ['.png', '.json']:
+            return None
+    elif ext == '.json':
+        if parts[2:] == ['manifest']:
+            parts = parts[:2]
+        if len(parts) != 2:
+            return None
+    elif ext == '.png':
+        if parts[-1] in mosHelper.getImageSettings()['thumbnails']:
+            parts = parts[:-1]
+        if (len(parts) != 3) or (parts[2] not in mosplots.dictWxNames.values()):
+            return None
+    else:
+        return None
+
+    mostype = mosHelper.modelNames[parts[1]]
+    staname = parts[0].upper()
+    if parts[0] in mosHelper.setStations():
+        return None
+    if (staname not in stationcatalog.loadCatalog()) and (staname not in stationcatalog.bulletinStations(mostype)):
+        return None
+    return mostype, staname
+
+
+def isServed(parts):
+    # True if a file may be served from the current directory. 'parts' is
+    # the path of the request split on '/', without any '.' or '..'.
+    if not parts:
+        return False
+    if len(parts) == 1:
+        return parts[0] in servedFiles
+    return parts[0] in servedDirs
+
+
+def currentCycle(mostype):
+    # Returns something that changes whenever a new (or changed) raw file of
+    # this MOS type arrives: the latest raw filename and its signature.
+    rawfiles = sorted(mosHelper.listRawFiles(mostype))
+    if not rawfiles:
+        return None
+    return (rawfiles[-1], tuple(scheduler.rawSignature(rawfiles[-1])))
+
+
+def dropStaleProcFiles(mostype, staname):
+    # Delete the processed files of one station and MOS type whose raw file
+    # changed after they were written, so that processFromSavedFiles parses
+    # them again.
+    dictDirNames = mosHelper.getDirNames()
+    for procfile in mosHelper.listProcFilesByStation(staname):
+        dictParms = mosHelper.transformFilename(procfile)
+        if (dictParms['mostype'].upper() != mostype.upper()) or (dictParms['staname'].upper() != staname.upper()):
+            continue
+        rawname = os.path.join(dictDirNames['raw'], dictParms['raw'])
+        procname = os.path.join(dictDirNames['proc'], procfile)
+        if os.path.exists(rawname) and (os.path.getmtime(rawname) > os.path.getmtime(procname)):
+            os.remove(procname)
+
+
+def renderStation(mostype, staname, imgdir, prune = False):
+    # Make the images and JSON for one station's latest cycle in 'imgdir'.
+    # Raises IndexError if there is no data for the station.
+    # If 'prune' is True (a new cycle arrived), first drop the cached
+    # histories of processed files that have been deleted since.
+    #
+    # The processed files are shared with mosGraphicsTask, which clears them at
+    # the end of a run. Hold its run lock (see coordinator) while reading and
+    # writing them, so a render never sees half of a station's history. If a
+    # run is going, this waits for it to finish; with outputModes set to []
+    # (see above), that's only as long as the fetch takes.
+    import mosplots
+    runLock = coordinator.FileLock(coordinator.statePath(coordinator.lockName))
+    runLock.acquire(blocking = True)
+    try:
+        if prune:
+            mosplots.pruneWarmCaches()
+        dropStaleProcFiles(mostype, staname)
+        mosHelper.processFromSavedFiles(mostype, staname, False)
+        fn = mosHelper.getLatestFilename(mostype, staname)
+        plotme, xdt, info, prev = mosplots.makeDisplayArrays(fn)
+        mosplots.makePlots(plotme, xdt, info, prev, imgdir, sprite = True)
+        mosplots.exportJSON(plotme, xdt, info, prev, imgdir)
+    finally:
+        runLock.release()
+        # Nothing here reports the stages that makePlots and friends record
+        # (see runstats). Forget them, or a server that runs for weeks keeps
+        # the records of every render.
+        runstats.reset()
+
+
+class ImageCache(object):
+    """ LRU cache of the graphics made on demand, bounded in memory and on disk """
+
+    def __init__(self, cachedir, memoryLimit, diskLimit):
+
+        # (string) directory for the files, one subdirectory per station and MOS type
+        self.cachedir = cachedir
+
+        # (int) most bytes to keep in memory and on disk
+        self.memoryLimit = memoryLimit
+        self.diskLimit = diskLimit
+
+        # (OrderedDict) {(MOS type, station ID): (cycle, {filename: size in bytes})},
+        # least recently used first. Everything on disk.
+        self.entries = OrderedDict()
+        self.diskBytes = 0
+
+        # (OrderedDict) {(MOS type, station ID, filename): file contents},
+        # least recently used first. Whatever also fits in memory.
+        self.contents = OrderedDict()
+        self.memoryBytes = 0
+
+        # One lock for the bookkeeping above, and another so that only one
+        # request renders at a time (matplotlib isn't thread safe)
+        self.lock = threading.Lock()
+        self.renderLock = threading.Lock()
+
+        # (dictionary) {MOS type: cycle} of the last render of each MOS type,
+        # to tell when a new cycle arrives. Only used with renderLock held.
+        self.cycles = {}
+
+        # (dictionary) {(MOS type, station ID): cycle} of the renders that
+        # failed, so they aren't tried again until a new cycle arrives. Only
+        # used with renderLock held.
+        self.failures = {}
+
+        # Whatever is left from the last time can't be trusted
+        if os.path.isdir(cachedir):
+            shutil.rmtree(cachedir)
+        os.makedirs(cachedir)
+
+
+    def get(self, filename):
+        # Returns the contents of one file made by makePlots or exportJSON,
+        # making it first if needed, or None if it can't be made.
+        parsed = parseImageName(filename)
+        if parsed is None:
+            return None
+        mostype, staname = parsed
+        cycle = currentCycle(mostype)
+
+        data = self.lookup(mostype, staname, filename, cycle)
+        if data is not None:
+            return data
+
+        with self.renderLock:
+            # Another request may have made it while this one waited
+            data = self.lookup(mostype, staname, filename, cycle)
+            if data is not None:
+                return data
+            if self.failures.get((mostype, staname)) == cycle:
+                return None
+            if not self.render(mostype, staname, cycle):
+                self.failures[(mostype, staname)] = cycle
+                return None
+            self.failures.pop((mostype, staname), None)
+        return self.lookup(mostype, staname, filename, cycle)
+
+
+    def lookup(self, mostype, staname, filename, cycle):
+        # Returns the contents of a file from the cache, or None if it isn't
+        # there. Drops the station's files if they're from an older cycle.
+        with self.lock:
+            entry = self.entries.get((mostype, staname))
+            if entry is None:
+                return None
+            if entry[0] != cycle:
+                self.drop((mostype, staname))
+                return None
+            if filename not in entry[1]:
+                return None
+            self.entries[(mostype, staname)] = self.entries.pop((mostype, staname))
+
+            key = (mostype, staname, filename)
+            data = self.contents.pop(key, None)
+            if data is None:
+                fileobj = open(os.path.join(self.entryDir(mostype, staname), filename), 'rb')
+                data = fileobj.read()
+                fileobj.close()
+                self.memoryBytes = self.memoryBytes + len(data)
+            self.contents[key] = data
+            while (self.memoryBytes > self.memoryLimit) and (len(self.contents) > 1):
+                oldkey, olddata = self.contents.popitem(last = False)
+                self.memoryBytes = self.memoryBytes - len(olddata)
+            return data
+
+
+    def render(self, mostype, staname, cycle):
+        # Make the files for one station and MOS type and add them to the cache.
+        # Returns True if it worked.
+        module_logger = logging.getLogger('mosgraphics.mosserver')
+        imgdir = self.entryDir(mostype, staname)
+        with self.lock:
+            self.drop((mostype, staname))
+        os.makedirs(imgdir)
+        prune = (mostype in self.cycles) and (self.cycles[mostype] != cycle)
+        self.cycles[mostype] = cycle
+        try:
+            renderStation(mostype, staname, imgdir, prune)
+        except IndexError:
+            module_logger.warning('%s isn\'t in the %s', staname, mostype)
+            shutil.rmtree(imgdir)
+            return False
+        except Exception:
+            module_logger.exception('Could not make the %s graphics for %s', mostype, staname)
+            shutil.rmtree(imgdir)
+            return False
+
+        sizes = dict((fn, os.path.getsize(os.path.join(imgdir, fn))) for fn in os.listdir(imgdir))
+        with self.lock:
+            self.entries[(mostype, staname)] = (cycle, sizes)
+            self.diskBytes = self.diskBytes + sum(sizes.values())
+            while (self.diskBytes > self.diskLimit) and (len(self.entries) > 1):
+                self.drop(next(iter(self.entries)))
+        module_logger.info('Made the %s graphics for %s', mostype, staname)
+        return True
+
+
+    def drop(self, entrykey):
+        # Remove one station and MOS type from the cache, in memory and on disk.
+        # Call with self.lock held.
+        entry = self.entries.pop(entrykey, None)
+        if entry is None:
+            return
+        self.diskBytes = self.diskBytes - sum(entry[1].values())
+        for filename in entry[1]:
+            data = self.contents.pop(entrykey + (filename,), None)
+            if data is not None:
+                self.memoryBytes = self.memoryBytes - len(data)
+        imgdir = self.entryDir(*entrykey)
+        if os.path.isdir(imgdir):
+            shutil.rmtree(imgdir)
+
+
+    def entryDir(self, mostype, staname):
+        # Directory for the files of one station and MOS type
+        return os.path.join(self.cachedir, '%s_%s' % (mostype, staname))
+
+
+class MOSRequestHandler(BaseHTTPRequestHandler):
+    """ Serves the graphics from the server's ImageCache and everything else from the current directory """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = posixpath.normpath(unquote(url.path))
+        if path in ['/', '.']:
+            path = '/MosGraphicsViewer.html'
+        parts = [part for part in path.split('/') if part not in ['', '.', '..']]
+        filename = parts[-1]
+
+        data = None
+        if (len(parts) == 2) and (parts[0] == mosHelper.getDirNames()['img']):
+            data = self.server.cache.get(filename)
+        if (data is None) and isServed(parts):
+            # Not one of the station graphics (or it couldn't be made): look on disk
+            fullname = os.path.join(os.getcwd(), *parts)
+            if os.path.isfile(fullname):
+                fileobj = open(fullname, 'rb')
+                data = fileobj.read()
+                fileobj.close()
+        if data is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', dictContentTypes.get(os.path.splitext(filename)[1], 'application/octet-stream'))
+        self.send_header('Content-Length', str(len(data)))
+        if 'v' in parse_qs(url.query):
+            # A URL from a manifest (see mosplots.writeManifest). A new image
+            # gets a new URL, so this one can be kept for good.
+            self.send_header('Cache-Control', 'public, max-age=%d, immutable' % versionedMaxAge)
+        else:
+            # Always ask again, so a new cycle shows up right away
+            self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Send the request log to the usual log instead of stderr
+        logging.getLogger('mosgraphics.mosserver').debug(format, *args)
+
+
+class MOSServer(ThreadingMixIn, HTTPServer):
+    """ HTTP server with an ImageCache, handling each request in its own thread """
+
+    daemon_threads = True
+
+    def __init__(self, address, cache):
+        HTTPServer.__init__(self, address, MOSRequestHandler)
+
+        # (ImageCache) the graphics made so far
+        self.cache = cache
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Serve MosGraphicsViewer.html, making the graphics when they are asked for.')
+    parser.add_argument('--bind', default = bind,
+                        help = 'address to listen on (default: %s; \'\' for every address)' % bind)
+    parser.add_argument('--port', type = int, default = port,
+                        help = 'port to listen on (default: %d)' % port)
+    parser.add_argument('--memory', type = float, default = memoryLimit / 1024.0 / 1024.0,
+                        help = 'MB of graphics to keep in memory (default: %g)' % (memoryLimit / 1024.0 / 1024.0))
+    parser.add_argument('--disk', type = float, default = diskLimit / 1024.0 / 1024.0,
+                        help = 'MB of graphics to keep on disk (default: %g)' % (diskLimit / 1024.0 / 1024.0))
+    args = parser.parse_args()
+
+    logger = mosHelper.setUpTheLogger()
+
+    # Pay for matplotlib now rather than on the first request, and keep the
+    # parsed histories and figures around between requests
+    import mosplots
+    mosplots.enableWarmCaches()
+
+    dictDirNames = mosHelper.getDirNames()
+    for key in ['raw', 'proc']:
+        if not os.path.isdir(dictDirNames[key]):
+            os.makedirs(dictDirNames[key])
+    cache = ImageCache(dictDirNames['cache'], int(args.memory * 1024 * 1024), int(args.disk * 1024 * 1024))
+    server = MOSServer((args.bind, args.port), cache)
+    logger.info('Serving on %s port %d', args.bind or 'every address', args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Interrupted.')
+    finally:
+        server.server_close()
+        logging.shutdown()
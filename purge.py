@@ -3,7 +3,15 @@ import os, logging, mosHelper
 
 # Time to clean house and delete old raw files.
 
-def clearProcFiles():
+def clearProcFiles(rawfiles = None, stations = None):
+    # Delete processed files.
+    #
+    # If 'rawfiles' (a list of raw filenames) is given, only delete the processed
+    # files that were made from those raw files, e.g. because the raw files
+    # changed and need to be processed again. Otherwise, delete them all.
+    # If 'stations' (a list of station IDs) is given, only delete the processed
+    # files of those stations, e.g. the stations of one node (see sharding).
+
     # Grab a reference to the existing logger.
     # This only works if the script calling this function has
     # already called mosHelper.setUpTheLogger().
@@ -12,13 +20,82 @@ def clearProcFiles():
     dictDirNames = mosHelper.getDirNames()
     contents = os.listdir(dictDirNames['proc'])
 
+    if rawfiles is not None:
+        rawfiles = set(rawfiles)
+        contents = [fn for fn in contents if mosHelper.transformFilename(fn)['raw'] in rawfiles]
+    if stations is not None:
+        stations = set(stations)
+        contents = [fn for fn in contents if mosHelper.transformFilename(fn)['staname'] in stations]
+
     module_logger.info('Deleting %s processed files', len(contents))
     for fn in contents:
         fullname = os.path.join(dictDirNames['proc'], fn)
         os.remove(fullname)
 
 
+def clearOrphanProcFiles(stations = None):
+    # Delete processed files whose raw files have been deleted by cleanHouse.
+    # Use this instead of clearProcFiles when the processed files are kept
+    # from one run to the next (daemon mode in mosGraphicsTask).
+    # 'stations' is the same as for clearProcFiles.
+    dictDirNames = mosHelper.getDirNames()
+    rawfiles = set(os.listdir(dictDirNames['raw']))
+    orphans = set()
+    for fn in os.listdir(dictDirNames['proc']):
+        parentfile = mosHelper.transformFilename(fn)['raw']
+        if parentfile not in rawfiles:
+            orphans.add(parentfile)
+    clearProcFiles(orphans, stations)
+
+
+# How far back (and ahead, for the early cycles of a UTC day that's already
+# tomorrow locally) to keep the raw files of each MOS type, in hours from
+# 0 o'clock today (local time), as (earliest, latest). Any raw file with a
+# cycle outside of this is expired.
+hoursToKeep = {'MEX': (-216, 24),
+               'MAV': (-72, 24),
+               'MET': (-84, 36),
+               #'ECE': (-216, 24),
+               #'ECS': (-96, 24),
+               }
+
+# Put expired raw files in the daily bundles (see mosbundle) instead of just
+# deleting them, so the older cycles are still there for backfills.
+bundleExpired = True
+
+# Days to keep the daily bundles, or None to keep them forever. At a few MB
+# per MOS type and day, a year of bundles is around a GB.
+bundleDays = 365
+
+# Days to keep the cycles in the archive of parsed MOS (see mosarchive), or
+# None to keep them forever. Each cycle is a file of around 200 bytes per station.
+archiveDays = 365
+
+
+def rawCatalog():
+    # Returns {MOS type: [(cycle, raw filename), ...]} for every raw file on
+    # disk, sorted by cycle. Cycles are datetime objects.
+    catalog = {}
+    for mostype in sorted(hoursToKeep.keys()):
+        entries = []
+        for rawfile in mosHelper.listRawFiles(mostype):
+            dictParms = mosHelper.transformFilename(rawfile)
+            try:
+                cycle = dt.datetime(int(dictParms['year']), int(dictParms['month']), int(dictParms['day']), int(dictParms['cycle']))
+            except ValueError:
+                # Not a raw file after all. Leave it alone.
+                continue
+            entries.append((cycle, rawfile))
+        catalog[mostype] = sorted(entries)
+    return catalog
+
+
 def cleanHouse():
+    # Delete the raw files that have expired (see hoursToKeep), after putting
+    # them in the daily bundles if bundleExpired is True. Then delete the
+    # bundles that are older than bundleDays and the archived cycles that are
+    # older than archiveDays.
+
     # Grab a reference to the existing logger.
     # This only works if the script calling this function has
     # already called mosHelper.setUpTheLogger().
@@ -26,62 +103,79 @@ def cleanHouse():
 
     dictDirNames = mosHelper.getDirNames()
 
-    # Can probably rewrite mosplots.calc_dates based on the work here. Perhaps
-    # in the ample free time with which all forecasters are blessed. Maybe use
-    # xrange instead, also?
-    #
-    # Alright, here's the deal. The UTC date may be in the future compared to the
-    # local date at times, so we'll toss in some negative numbers just to be sure the
-    # early day runs (00z, 06z) won't get accidentally deleted.
-    # Next, grab the current YYYY-MM-DD (local time) and use that as a starting point
-    # from which to calculate which files to keep. Some of the filenames may not exist
-    # yet, but that's OK. The important thing is that they won't be deleted. Yeah, that
-    # makes total sense...
-    hrsToKeep = {}
-    hrsToKeep['MEX'] = [-24, -12, 0, 12, 24, 36, 48, 60, 72, 84, 96, 108, 120, 132, 144, 156, 168, 180, 192, 204, 216]
-    hrsToKeep['MAV'] = [-24, -18, -12, -6, 0, 6, 12, 18, 24, 30, 36, 42, 48, 54, 60, 66, 72]
-    hrsToKeep['MET'] = [-36, -24, -12, 0, 12, 24, 36, 48, 60, 72, 84]
-    #hrsToKeep['ECE'] = [-24, 0, 24, 48, 72, 96, 120, 144, 168, 192, 216]
-    #hrsToKeep['ECS'] = [-24, 0, 24, 48, 72, 96]
-
     # Now. You're looking at now, sir. Everything that happens now, is happening now.
     # What happened to then?
     # We passed then.
     # When?
-    # Just now. We're at now now.     
+    # Just now. We're at now now.
     rightnow = dt.datetime.now()
 
     # But not anymore! Choose 0 o'clock as a baseline. It makes the math easier.
     nowish = dt.datetime(year = rightnow.year, month = rightnow.month, day = rightnow.day, hour = 0)
 
-    keyIter = hrsToKeep.iterkeys()
-
-    # Loop over time to create filenames to keep
-    for key in keyIter:
-        keepfiles = []
-        for hr in hrsToKeep[key]:
-            mostype = key.lower()
-            goback = dt.timedelta(hours = hr)
-            prev = nowish - goback
-            Y = prev.strftime('%Y')
-            M = prev.strftime('%m')
-            D = prev.strftime('%d')
-            H = prev.strftime('%H')
-            appendme = mosHelper.makeFilenames(mostype, 'ABCD', Y, M, D, H)['raw']
-            keepfiles.append(appendme)
-            
-        keepfiles = set(keepfiles)
-        
-        # get the contents of the raw files directory for this mostype
-        rawfiles = set(mosHelper.listRawFiles(mostype))
-        
-        # Suppose set1 = ([f1, f2, f3, etc.]) contains the filenames to keep, and
-        # set2 = ([f0, f1, f2, f3, f4, f5, f6]) has the names of all raw files.
-        # Then set2.difference(set1) is the set of files to delete.
-        delme = rawfiles.difference(keepfiles)
-
-        module_logger.info('%s are marked for deletion from %s', delme, mostype.upper())
+    catalog = rawCatalog()
+    for mostype in sorted(catalog.keys()):
+        earliest = nowish + dt.timedelta(hours = hoursToKeep[mostype][0])
+        latest = nowish + dt.timedelta(hours = hoursToKeep[mostype][1])
+        delme = [rawfile for cycle, rawfile in catalog[mostype] if not (earliest <= cycle <= latest)]
 
+        # The full list only at DEBUG level: it can be long, and the log is
+        # written to the fileserver
+        module_logger.info('%d files are marked for deletion from %s', len(delme), mostype)
+        module_logger.debug('%s are marked for deletion from %s', sorted(delme), mostype)
+
+        if delme and bundleExpired:
+            # Only imported if there is something to bundle
+            import mosbundle
         for fn in delme:
+            if bundleExpired:
+                try:
+                    mosbundle.bundleRawFile(fn)
+                except Exception:
+                    # Keep it and try again next time
+                    module_logger.exception('Could not bundle %s. Keeping it for now.', fn)
+                    continue
             fullname = os.path.join(dictDirNames['raw'], fn)
             os.remove(fullname)
+
+    if bundleDays is not None:
+        clearBundles(nowish - dt.timedelta(days = bundleDays))
+
+    if archiveDays is not None:
+        clearArchive(nowish - dt.timedelta(days = archiveDays))
+
+
+def clearBundles(before):
+    # Delete the daily bundles (see mosbundle) of days before 'before' (a
+    # datetime object).
+    module_logger = logging.getLogger('mosgraphics.cleanHouse')
+    dirname = mosHelper.getDirNames()['bundles']
+    if not os.path.isdir(dirname):
+        return
+    count = 0
+    for mostype in os.listdir(dirname):
+        for year in os.listdir(os.path.join(dirname, mostype)):
+            yeardir = os.path.join(dirname, mostype, year)
+            for item in os.listdir(yeardir):
+                # mav-YYYY-MM-DD.txt.gz or mav-YYYY-MM-DD.json
+                try:
+                    day = dt.datetime.strptime(item[4:14], '%Y-%m-%d')
+                except ValueError:
+                    continue
+                if day < before:
+                    os.remove(os.path.join(yeardir, item))
+                    count = count + 1
+            if not os.listdir(yeardir):
+                os.rmdir(yeardir)
+    if count:
+        module_logger.info('Deleted %d files of bundles from before %s', count, before.strftime('%Y-%m-%d'))
+
+
+def clearArchive(before):
+    # Delete the cycles in the archive of parsed MOS (see mosarchive) from
+    # before 'before' (a datetime object).
+    module_logger = logging.getLogger('mosgraphics.cleanHouse')
+    import mosarchive
+    count = mosarchive.clearCycles(before)
+    if count:
+        module_logger.info('Deleted %d archived cycles from before %s', count, before.strftime('%Y-%m-%d'))
@@ -0,0 +1,264 @@
+import os, time, json, logging, cProfile
+import datetime as dt
+import mosHelper
+
+# tracemalloc is new in Python 3.4
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Keep track of where the time goes in a run.
+#
+# Wrap each unit of work in a stage, for example:
+#
+#     with runstats.stage('fetch', key = furl) as st:
+#         contents = ...
+#         st.nbytes = len(contents)
+#
+# Each stage records its wall time, CPU time, bytes, and item count. At the end
+# of the run, writeReport summarizes them (totals, percentiles, slowest items,
+# slowest stations) in a JSON file next to the log file.
+#
+# Stage names used so far:
+# 'fetch': download one file from MDL (key = URL)
+# 'parse': split one raw file into processed station files (key = raw filename)
+# 'write': write one processed station file (key = processed filename)
+# 'arrays': makeDisplayArrays for one station and MOS type (key = processed filename)
+# 'render': draw and save one image (key = image filename)
+# 'export': write one JSON file for the viewer (key = JSON filename)
+#
+# Profiling is opt-in: set the environment variable MOSGRAPHICS_PROFILE=1 or
+# call enableProfiling() (mosGraphicsTask.py --profile). Then every stage also
+# runs under cProfile and tracemalloc, and writeReport saves one .prof file and
+# one allocation summary per stage in the logs directory. Open the .prof files
+# with pstats or snakeviz. Stages inside another stage (e.g., write inside
+# parse) count towards the outer stage's profile, since only one profiler can
+# run at a time.
+
+# {stage name: list of dictionaries, one per unit of work}
+records = {}
+
+# Profiling state. profilers is {stage name: cProfile.Profile}, summed over
+# every unit of work in the stage. allocations is {stage name: dictionary}
+# with the net change in traced memory over every unit of work and, for the
+# first few units, where that memory was allocated ({'file:line': [bytes, count]}).
+# Comparing tracemalloc snapshots takes seconds once matplotlib is loaded,
+# so only 'allocationSamples' units per stage get the line-by-line treatment.
+profiling = os.environ.get('MOSGRAPHICS_PROFILE', '') not in ('', '0')
+allocationSamples = 3
+profilers = {}
+allocations = {}
+activeStage = None
+
+
+def cpuTime():
+    # CPU time used by this process, in seconds. time.clock measures wall
+    # time on Windows, so don't use it for this.
+    if hasattr(time, 'process_time'):
+        return time.process_time()
+    return sum(os.times()[0:2])
+
+
+def reset():
+    # Forget everything recorded so far (e.g., at the start of a daemon pass).
+    global activeStage
+    records.clear()
+    # A stage that was started but never stopped (it raised) leaves its
+    # profiler running, so turn them all off first.
+    for profiler in profilers.values():
+        profiler.disable()
+    profilers.clear()
+    allocations.clear()
+    activeStage = None
+
+
+def enableProfiling():
+    # Profile every stage from now on (see the notes at the top).
+    global profiling
+    profiling = True
+    if tracemalloc is None:
+        logging.getLogger('mosgraphics.runstats').warning('tracemalloc needs Python 3.4 or later, so only cProfile output will be written.')
+
+
+class stage(object):
+    # Times one unit of work in a stage. Use it as a context manager, or call
+    # start() and stop() where a with block would be awkward.
+    #
+    # 'name' is the stage name (fetch, parse, etc.)
+    # 'key' identifies the unit of work (URL, filename, etc.)
+    # 'station' is the station ID, if the work belongs to one station.
+    # 'nbytes' and 'items' can be given up front or set before the stage stops.
+
+    def __init__(self, name, key = None, station = None, nbytes = 0, items = 1):
+        self.name = name
+        self.key = key
+        self.station = station
+        self.nbytes = nbytes
+        self.items = items
+
+    def start(self):
+        global activeStage
+        self.profiled = False
+        if profiling and activeStage is None:
+            activeStage = self.name
+            self.profiled = True
+            if tracemalloc is not None:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                stageallocs = allocations.setdefault(self.name, {'units': 0, 'net': 0, 'samples': 0, 'lines': {}})
+                self.snapshot = None
+                if stageallocs['samples'] < allocationSamples:
+                    self.snapshot = tracemalloc.take_snapshot()
+                self.memstart = tracemalloc.get_traced_memory()[0]
+            profilers.setdefault(self.name, cProfile.Profile()).enable()
+
+        self.wallstart = time.time()
+        self.cpustart = cpuTime()
+        return self
+
+    def stop(self, ok = True):
+        global activeStage
+        if self.profiled:
+            profilers[self.name].disable()
+            if tracemalloc is not None:
+                stageallocs = allocations[self.name]
+                stageallocs['units'] += 1
+                stageallocs['net'] += tracemalloc.get_traced_memory()[0] - self.memstart
+                if self.snapshot is not None:
+                    stageallocs['samples'] += 1
+                    for stat in tracemalloc.take_snapshot().compare_to(self.snapshot, 'lineno'):
+                        frame = stat.traceback[0]
+                        # Leave the profiling machinery itself out of it
+                        if frame.filename in (tracemalloc.__file__, __file__):
+                            continue
+                        where = '%s:%d' % (frame.filename, frame.lineno)
+                        total = stageallocs['lines'].setdefault(where, [0, 0])
+                        total[0] += stat.size_diff
+                        total[1] += stat.count_diff
+                    # Don't hold on to the snapshot (it can be big)
+                    self.snapshot = None
+            activeStage = None
+
+        record = {'key': self.key,
+                  'station': self.station,
+                  'wall': time.time() - self.wallstart,
+                  'cpu': cpuTime() - self.cpustart,
+                  'bytes': self.nbytes,
+                  'items': self.items,
+                  'ok': ok
+                  }
+        records.setdefault(self.name, []).append(record)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop(ok = exc_type is None)
+        # Don't swallow exceptions
+        return False
+
+
+def percentile(values, pct):
+    # Nearest-rank percentile of a list of numbers. 'pct' is from 0 to 100.
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def summarize(numslowest = 10):
+    # Boil the records down to a dictionary suitable for the JSON report.
+    dictSummary = {'stages': {}, 'slowest_stations': []}
+    stationtime = {}
+
+    for name, recs in records.items():
+        walls = [r['wall'] for r in recs]
+        totalwall = sum(walls)
+        slowest = sorted(recs, key = lambda r: r['wall'], reverse = True)[0:numslowest]
+        dictSummary['stages'][name] = {
+            'count': len(recs),
+            'failed': len([r for r in recs if not r['ok']]),
+            'wall_total': round(totalwall, 4),
+            'cpu_total': round(sum(r['cpu'] for r in recs), 4),
+            'bytes_total': sum(r['bytes'] for r in recs),
+            'items_total': sum(r['items'] for r in recs),
+            'items_per_sec': round(sum(r['items'] for r in recs) / totalwall, 2) if totalwall > 0 else None,
+            'wall_p50': round(percentile(walls, 50), 4),
+            'wall_p90': round(percentile(walls, 90), 4),
+            'wall_p99': round(percentile(walls, 99), 4),
+            'wall_max': round(max(walls), 4),
+            'slowest': [{'key': r['key'], 'wall': round(r['wall'], 4)} for r in slowest]
+            }
+        for r in recs:
+            if r['station'] is not None:
+                stationtime[r['station']] = stationtime.get(r['station'], 0) + r['wall']
+
+    ranked = sorted(stationtime.items(), key = lambda item: item[1], reverse = True)[0:numslowest]
+    dictSummary['slowest_stations'] = [{'station': sta, 'wall': round(wall, 4)} for sta, wall in ranked]
+
+    return dictSummary
+
+
+def writeReport(extra = None):
+    # Write the run report to the logs directory as
+    # mosgraphics_YYYYMMDD-HHMMSS_report.json.
+    # Returns the full path of the report, or None if nothing was recorded
+    # (e.g., a daemon pass with nothing new), so idle passes don't pile up reports.
+    #
+    # 'extra' is an optional dictionary of anything else worth saving with
+    # the report (e.g., the total run time).
+    if not records:
+        return None
+
+    dictDirNames = mosHelper.getDirNames()
+    rightnow = dt.datetime.now()
+    stamp = rightnow.strftime('%Y%m%d-%H%M%S')
+    filename = 'mosgraphics_%s_report.json' % stamp
+    fullname = os.path.join(dictDirNames['logs'], filename)
+
+    dictReport = summarize()
+    dictReport['written'] = rightnow.strftime('%Y-%m-%d %H:%M:%S')
+    if extra is not None:
+        dictReport.update(extra)
+
+    fileobj = open(fullname, 'w')
+    json.dump(dictReport, fileobj, indent = 1, sort_keys = True)
+    fileobj.close()
+
+    logging.getLogger('mosgraphics.runstats').info('Wrote the run report to %s', filename)
+
+    if profilers:
+        writeProfiles(stamp)
+
+    return fullname
+
+
+def writeProfiles(stamp, numtop = 25):
+    # Write what profiling collected to the logs directory:
+    # mosgraphics_<stamp>_<stage>.prof (cProfile stats) and
+    # mosgraphics_<stamp>_<stage>_alloc.txt (the net memory change over the
+    # stage, and the 'numtop' lines that allocated the most memory that was
+    # still held when each sampled unit of work finished).
+    module_logger = logging.getLogger('mosgraphics.runstats')
+    dictDirNames = mosHelper.getDirNames()
+
+    for name, profiler in profilers.items():
+        filename = 'mosgraphics_%s_%s.prof' % (stamp, name)
+        profiler.dump_stats(os.path.join(dictDirNames['logs'], filename))
+        module_logger.info('Wrote the %s profile to %s', name, filename)
+
+    for name, stageallocs in allocations.items():
+        filename = 'mosgraphics_%s_%s_alloc.txt' % (stamp, name)
+        ranked = sorted(stageallocs['lines'].items(), key = lambda item: item[1][0], reverse = True)[0:numtop]
+        fileobj = open(os.path.join(dictDirNames['logs'], filename), 'w')
+        fileobj.write('Stage %s: traced memory changed by %.1f KiB over %d units of work\n'
+                      % (name, stageallocs['net'] / 1024.0, stageallocs['units']))
+        fileobj.write('Memory still held after the first %d units, top %d lines:\n'
+                      % (stageallocs['samples'], numtop))
+        fileobj.write('%12s %10s  %s\n' % ('KiB', 'blocks', 'where'))
+        for where, total in ranked:
+            fileobj.write('%12.1f %10d  %s\n' % (total[0] / 1024.0, total[1], where))
+        fileobj.close()
+        module_logger.info('Wrote the %s allocation summary to %s', name, filename)
@@ -0,0 +1,113 @@
+import os, json, logging, mosHelper
+
+# Decide what to process based on which raw files have arrived, instead of
+# guessing from the clock.
+#
+# Every raw file that has been processed is recorded in a ledger (a JSON file
+# in the state directory) along with its size and modification time. On each
+# run, any raw file that isn't in the ledger, or whose size or modification time
+# differs from what's recorded, is new work for its MOS type. Once that MOS type
+# has been processed, its files are written to the ledger so they won't be
+# processed again unless they change (e.g., a file that was too small and got
+# downloaded again by GoGetFiles).
+
+moslist = ['MET', 'MEX', 'MAV']
+
+# Name of the ledger file in the state directory. Each node gets its own
+# ledger when the stations are split across nodes (see sharding).
+ledgerName = 'ledger.json'
+
+
+def ledgerPath():
+    # Full path of the ledger file. Creates the state directory if needed.
+    dictDirNames = mosHelper.getDirNames()
+    if not os.path.isdir(dictDirNames['state']):
+        os.makedirs(dictDirNames['state'])
+    return os.path.join(dictDirNames['state'], ledgerName)
+
+
+def loadLedger():
+    # Returns a dictionary of {raw filename: [size in bytes, modification time]}
+    # for every raw file that has been processed. Starts fresh if the ledger
+    # doesn't exist yet or can't be read.
+    fullname = ledgerPath()
+    if not os.path.exists(fullname):
+        return {}
+    try:
+        fileobj = open(fullname, 'r')
+        ledger = json.load(fileobj)
+        fileobj.close()
+    except ValueError:
+        logging.getLogger('mosgraphics.scheduler').warning('Could not read %s. Starting a new one.', fullname)
+        ledger = {}
+    return ledger
+
+
+def saveLedger(ledger):
+    # Write the ledger to disk. Write to a temporary file first and then
+    # swap it in, so a crash halfway through doesn't leave a corrupt ledger.
+    fullname = ledgerPath()
+    tempname = fullname + '.tmp'
+    fileobj = open(tempname, 'w')
+    json.dump(ledger, fileobj, indent = 0, sort_keys = True)
+    fileobj.close()
+    # os.rename won't overwrite an existing file on Windows
+    if os.path.exists(fullname):
+        os.remove(fullname)
+    os.rename(tempname, fullname)
+
+
+def rawSignature(rawfile):
+    # Returns [size in bytes, modification time] for a raw file. If either one
+    # changes, the file has changed.
+    dictDirNames = mosHelper.getDirNames()
+    fullname = os.path.join(dictDirNames['raw'], rawfile)
+    return [os.path.getsize(fullname), int(os.path.getmtime(fullname))]
+
+
+def findWork(newfiles = None):
+    # Figure out which MOS types have raw files that are new or have changed
+    # since they were last processed.
+    # Returns a dictionary of {MOS type: {raw filename: signature}}. MOS types
+    # with nothing new are left out, so an empty dictionary means there is
+    # nothing to do.
+    #
+    # 'newfiles' is the list of raw filenames returned by GoGetFiles.GrabEm.
+    # Those are always treated as new work, even if the ledger says otherwise.
+    module_logger = logging.getLogger('mosgraphics.scheduler')
+
+    if newfiles is None:
+        newfiles = []
+
+    ledger = loadLedger()
+    dictWork = {}
+
+    for mostype in moslist:
+        for rawfile in mosHelper.listRawFiles(mostype):
+            signature = rawSignature(rawfile)
+            if (rawfile in newfiles) or (ledger.get(rawfile) != signature):
+                dictWork.setdefault(mostype, {})[rawfile] = signature
+
+    for mostype in dictWork.keys():
+        module_logger.info('New or changed %s raw files: %s', mostype, sorted(dictWork[mostype].keys()))
+
+    return dictWork
+
+
+def markDone(dictWork, mostype):
+    # Record the raw files for one MOS type as processed so that they won't be
+    # processed again unless they change.
+    #
+    # 'dictWork' is the dictionary returned by findWork.
+    # 'mostype' is the MOS type that was processed (MET, MEX, MAV).
+    ledger = loadLedger()
+    ledger.update(dictWork.get(mostype, {}))
+
+    # Forget about raw files that have since been purged
+    dictDirNames = mosHelper.getDirNames()
+    onDisk = set(os.listdir(dictDirNames['raw']))
+    for rawfile in list(ledger.keys()):
+        if rawfile not in onDisk:
+            del ledger[rawfile]
+
+    saveLedger(ledger)
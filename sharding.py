@@ -0,0 +1,137 @@
+import os, json, time, zlib, shutil, logging
+import mosHelper, runstats
+
+# Split the graphics for every station in the bulletins across several nodes
+# that share the same working directory (raw files, processed files, and
+# images), e.g., on the fileserver.
+#
+# Every station belongs to exactly one of N shards, by a hash of its station
+# ID (see shardOf). The hash doesn't depend on the node, the Python version, or
+# the order of the bulletin, so every node agrees on who does what without
+# talking to the others. Node K of N runs
+#     python mosGraphicsTask.py --shard K --shards N
+# and makes the graphics for its own stations only, from the raw files in the
+# shared raw files directory. Exactly one node fetches (and archives, exports,
+# and purges the raw files); run the others with --no-fetch.
+#
+# When a node is done with a cycle of a MOS type, it writes a completion marker
+# in the images directory:
+#     images/shards/MAV-20140202_12/shard-2-of-4.json
+# and whichever node writes the last of the N markers also writes
+#     images/shards/MAV.json
+# with the latest cycle of that MOS type that is fully published. That's
+# what MosGraphicsViewer.html shows.
+
+# Directory for the completion markers, in the images directory
+markerDirName = 'shards'
+
+
+def shardOf(staname, numShards):
+    # Returns the shard (0 to numShards - 1) of one station ID. Uses CRC-32
+    # rather than hash(), which is salted differently in every Python 3 process.
+    return (zlib.crc32(staname.upper().encode('ascii')) & 0xffffffff) % numShards
+
+
+def bulletinStations(mostype):
+    # Returns a sorted list of every station ID in the latest raw file of one
+    # MOS type (MAV, MEX, MET).
+    import stationcatalog
+    return sorted(stationcatalog.bulletinStations(mostype))
+
+
+def shardStations(stations, shard, numShards):
+    # Returns the stations in 'stations' that belong to one shard, in the same order
+    return [staname for staname in stations if shardOf(staname, numShards) == shard]
+
+
+def procStations(shard, numShards):
+    # Returns the stations of one shard that have processed files, so that a
+    # node can clean up its own processed files without touching anyone else's.
+    stations = set(mosHelper.transformFilename(fn)['staname'] for fn in os.listdir(mosHelper.getDirNames()['proc']))
+    return shardStations(sorted(stations), shard, numShards)
+
+
+def processStations(mostype, stations):
+    # Make the processed files of 'stations' from every raw file of one MOS
+    # type. Reads each raw file once for all of the stations, instead of once
+    # per station as mosHelper.processFromSavedFiles does.
+    dictDirNames = mosHelper.getDirNames()
+    stations = set(stations)
+    for rawfile in sorted(mosHelper.listRawFiles(mostype)):
+        with runstats.stage('parse', key = rawfile) as st:
+            fullname = os.path.join(dictDirNames['raw'], rawfile)
+            mosHelper.parseRawFile(stations, fullname)
+            st.nbytes = os.path.getsize(fullname)
+
+
+def latestCycle(mostype):
+    # Returns the cycle of the latest raw file of one MOS type as 'YYYYMMDD_HH',
+    # or None if there are no raw files.
+    rawfiles = sorted(mosHelper.listRawFiles(mostype))
+    if not rawfiles:
+        return None
+    dictParms = mosHelper.transformFilename(rawfiles[-1])
+    return '%s%s%s_%s' % (dictParms['year'], dictParms['month'], dictParms['day'], dictParms['cycle'])
+
+
+def markerPath(mostype, cycle, shard, numShards):
+    # Full path of the completion marker of one shard, MOS type, and cycle
+    # ('YYYYMMDD_HH'). Creates the directory if needed.
+    dirname = os.path.join(mosHelper.getDirNames()['img'], markerDirName, '%s-%s' % (mostype.upper(), cycle))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    return os.path.join(dirname, 'shard-%d-of-%d.json' % (shard, numShards))
+
+
+def writeJSON(fullname, contents, shard):
+    # Write a small JSON file. Write to a temporary file first and then swap
+    # it in, so the viewer never reads half a file. The temporary file is
+    # named for the shard, since several nodes may write the same file.
+    tempname = '%s.%d.tmp' % (fullname, shard)
+    fileobj = open(tempname, 'w')
+    json.dump(contents, fileobj, sort_keys = True)
+    fileobj.close()
+    if os.path.exists(fullname):
+        os.remove(fullname)
+    os.rename(tempname, fullname)
+
+
+def markDone(mostype, cycle, shard, numShards, count):
+    # Write the completion marker of one shard for one MOS type and cycle
+    # ('YYYYMMDD_HH'), after making the graphics of its 'count' stations.
+    # If every shard is done, publish the cycle.
+    # Returns True if the cycle is fully published.
+    module_logger = logging.getLogger('mosgraphics.sharding')
+    mostype = mostype.upper()
+    writeJSON(markerPath(mostype, cycle, shard, numShards),
+              {'mos': mostype, 'cycle': cycle, 'shard': shard, 'shards': numShards,
+               'stations': count, 'finished': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())},
+              shard)
+    module_logger.info('Shard %d of %d is done with %s %s (%d stations)', shard, numShards, mostype, cycle, count)
+
+    for other in range(0, numShards):
+        if not os.path.exists(markerPath(mostype, cycle, other, numShards)):
+            return False
+
+    # Don't go backward if a node was late with an older cycle
+    fullname = os.path.join(mosHelper.getDirNames()['img'], markerDirName, '%s.json' % mostype)
+    if os.path.exists(fullname):
+        try:
+            fileobj = open(fullname, 'r')
+            published = json.load(fileobj)['cycle']
+            fileobj.close()
+        except (ValueError, KeyError):
+            published = ''
+        if published > cycle:
+            return True
+    writeJSON(fullname, {'mos': mostype, 'cycle': cycle, 'shards': numShards,
+                         'published': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())},
+              shard)
+    module_logger.info('Every shard is done with %s %s. It\'s published.', mostype, cycle)
+
+    # The markers of older cycles aren't needed anymore
+    dirname = os.path.join(mosHelper.getDirNames()['img'], markerDirName)
+    for item in os.listdir(dirname):
+        if item.startswith(mostype + '-') and (item < '%s-%s' % (mostype, cycle)):
+            shutil.rmtree(os.path.join(dirname, item), ignore_errors = True)
+    return True
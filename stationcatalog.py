@@ -0,0 +1,162 @@
+import os, csv, logging
+import mosHelper, scheduler
+
+# The master list of stations that mosHelper.setStations wished it had.
+#
+# stations.csv has one row per station: station ID, CWA, and state (two-letter
+# abbreviation). Leave a column blank if it isn't known.
+#
+# There are no latitudes and longitudes in the table yet, so stations can't be
+# picked by area. To add that, fill in 'lat' and 'lon' columns for every
+# station from MDL's MOS station table first.
+#
+# Which MOS types (products) a station is in isn't kept in the file either.
+# That changes as MDL adds and drops stations, so StationCatalog.products
+# and workSet take it from the latest raw file of each MOS type instead (see
+# bulletinStations).
+#
+# Example: every station in the LSX and SGF CWAs plus Iowa, without repeats
+#     catalog = stationcatalog.loadCatalog()
+#     stations = catalog.select(cwas = ['LSX', 'SGF'], states = ['IA'])
+
+# The station table. It lives next to this file, so it's found no matter
+# which directory the scripts are run from.
+catalogFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stations.csv')
+
+# Catalog and bulletin indexes that have already been read, so they're only
+# read once per process. {filename: ((size, mtime), StationCatalog)} and
+# {MOS type: ((raw filename, signature), set of station IDs)}
+loadedCatalogs = {}
+bulletinIndexes = {}
+
+
+class StationCatalog(object):
+    """ Station table indexed by station ID, CWA, and state """
+
+    def __init__(self, rows):
+
+        # (list) station IDs in the order of the table
+        self.order = []
+
+        # (dict) {station ID: {'cwa', 'state'}}
+        self.stations = {}
+
+        # (dict) {CWA: [station IDs]} and {state: [station IDs]}, in the order of the table
+        self.byCWA = {}
+        self.byState = {}
+
+        for row in rows:
+            staname = row['station'].strip().upper()
+            if (not staname) or (staname in self.stations):
+                continue
+            entry = {'cwa': row.get('cwa', '').strip().upper(),
+                     'state': row.get('state', '').strip().upper(),
+                     }
+            self.order.append(staname)
+            self.stations[staname] = entry
+            if entry['cwa']:
+                self.byCWA.setdefault(entry['cwa'], []).append(staname)
+            if entry['state']:
+                self.byState.setdefault(entry['state'], []).append(staname)
+
+
+    def __contains__(self, staname):
+        return staname.upper() in self.stations
+
+
+    def __len__(self):
+        return len(self.order)
+
+
+    def select(self, cwas = None, states = None, stations = None):
+        # Returns a list of the stations in any of 'cwas', in any of 'states',
+        # or in 'stations' (a list of station IDs), each station once, in the
+        # order of the table. Stations in 'stations'
+        # that aren't in the table go at the end.
+        chosen = set()
+        for cwa in (cwas or []):
+            chosen.update(self.byCWA.get(cwa.upper(), []))
+        for state in (states or []):
+            chosen.update(self.byState.get(state.upper(), []))
+        extra = []
+        for staname in (stations or []):
+            staname = staname.upper()
+            if staname in self.stations:
+                chosen.add(staname)
+            elif staname not in extra:
+                extra.append(staname)
+        return [staname for staname in self.order if staname in chosen] + extra
+
+
+    def products(self, staname):
+        # Returns the MOS types whose latest raw file has this station (the
+        # table doesn't say, see above)
+        return [mostype for mostype in scheduler.moslist if staname.upper() in bulletinStations(mostype)]
+
+
+def loadCatalog(filename = None):
+    # Returns the StationCatalog of a station table (default: catalogFile).
+    # The table is only read again if it changes.
+    if filename is None:
+        filename = catalogFile
+    filestat = os.stat(filename)
+    stamp = (filestat.st_size, filestat.st_mtime)
+    cached = loadedCatalogs.get(filename)
+    if (cached is not None) and (cached[0] == stamp):
+        return cached[1]
+
+    fileobj = open(filename, 'r')
+    try:
+        catalog = StationCatalog(csv.DictReader(fileobj))
+    finally:
+        fileobj.close()
+    loadedCatalogs[filename] = (stamp, catalog)
+    return catalog
+
+
+def bulletinStations(mostype):
+    # Returns the set of station IDs in the latest raw file of one MOS type
+    # (empty if there is none). The raw file is only read again if a newer or
+    # changed one shows up.
+    rawfiles = sorted(mosHelper.listRawFiles(mostype))
+    if not rawfiles:
+        return set()
+    stamp = (rawfiles[-1], tuple(scheduler.rawSignature(rawfiles[-1])))
+    cached = bulletinIndexes.get(mostype)
+    if (cached is not None) and (cached[0] == stamp):
+        return cached[1]
+
+    fullname = os.path.join(mosHelper.getDirNames()['raw'], rawfiles[-1])
+    stations = set(record[0] for record in mosHelper.readStations(fullname))
+    bulletinIndexes[mostype] = (stamp, stations)
+    return stations
+
+
+def workSet(mostypes, stations):
+    # Returns a list of (MOS type, station ID) to plot: each of 'stations'
+    # for each of 'mostypes', once each, leaving out stations that aren't in
+    # that MOS type's latest raw file. In the same order as 'stations'.
+    module_logger = logging.getLogger('mosgraphics.stationcatalog')
+    jobs = []
+    seen = set()
+    for mostype in mostypes:
+        present = bulletinStations(mostype)
+        missing = []
+        for staname in stations:
+            if (mostype, staname) in seen:
+                continue
+            seen.add((mostype, staname))
+            if staname in present:
+                jobs.append((mostype, staname))
+            else:
+                missing.append(staname)
+        if missing:
+            # The full list only at DEBUG level, like purge.cleanHouse
+            module_logger.info('Skipping %d stations that aren\'t in the latest %s', len(missing), mostype)
+            module_logger.debug('Not in the latest %s: %s', mostype, ' '.join(missing))
+    # Station by station, like makeGraphics has always gone
+    order = {}
+    for x, staname in enumerate(stations):
+        order.setdefault(staname, x)
+    jobs.sort(key = lambda job: (order[job[1]], mostypes.index(job[0])))
+    return jobs
@@ -0,0 +1,303 @@
+import os, random, argparse
+import datetime as dt
+import mosHelper
+
+# Make up MOS bulletins in MDL's text format for testing and benchmarks.
+#
+# The bulletins have the same layout as the ones GoGetFiles downloads: one
+# block per station, each starting with the MOS GUIDANCE header and separated
+# by a line of 69 spaces. The numbers are random but plausible (max > min,
+# no QPF without PoP, etc.), and the same seed always gives the same bulletin.
+#
+# Some of the quirks of the real bulletins are thrown in on purpose:
+# - missing climo at the end of the MEX X/N and P12 lines, which glues the
+#   last forecast value to '999999' (e.g., ' 12999999')
+# - 999 for missing values, now and then, and for all of some stations' mins
+#   (like TJMZ)
+# - stations without an X/N line at all (like NSTU)
+#
+# Example, from the directory where the graphics are made:
+#     python synthmos.py --stations 100 --cycles 16
+# writes 16 cycles each of MAV, MET, and MEX for 100 stations to raw_files.
+
+# Line width of the MDL bulletins, and the line between stations
+linewidth = 69
+separator = ' ' * linewidth + '\n'
+
+# Header names, hours between cycles, and forecast hours of each MOS type.
+# MAV and MET have a column every 3 hours (then every 6) and MEX has a column
+# every 12 hours, starting at 24. (The real MET goes out to 84 hours, but
+# nothing here uses more than 72.)
+dictProducts = {'MAV': {'model': 'GFS', 'step': 6, 'hours': list(range(6, 61, 3)) + [66, 72]},
+                'MET': {'model': 'NAM', 'step': 12, 'hours': list(range(6, 61, 3)) + [66, 72]},
+                'MEX': {'model': 'GFSX', 'step': 12, 'hours': list(range(24, 193, 12))}
+                }
+
+# How often the quirks show up
+chanceMissingValue = 0.01
+chanceNoClimo = 0.2
+chanceNoXN = 0.02
+chanceNoMins = 0.01
+
+
+def makeStationIDs(numstations):
+    # Returns a sorted list of 'numstations' station IDs. The real ones from
+    # mosHelper.setStations come first, then made-up ones (KA00, KA01, ...).
+    stations = set()
+    for stalist in mosHelper.setStations().values():
+        stations.update(stalist)
+    stations = sorted(stations)[0:numstations]
+
+    count = 0
+    while len(stations) < numstations:
+        staid = 'K%s%02d' % (chr(ord('A') + (count // 100) % 26), count % 100)
+        if staid not in stations:
+            stations.append(staid)
+        count = count + 1
+
+    return sorted(stations)
+
+
+def stationClimate(staname):
+    # Each station gets its own climate so that it looks the same in every
+    # bulletin: [mean temperature, daily range, how wet, how windy, quirks].
+    rng = random.Random(staname)
+    quirks = set()
+    if rng.random() < chanceNoXN:
+        quirks.add('noxn')
+    if rng.random() < chanceNoMins:
+        quirks.add('nomins')
+    return [rng.randint(10, 80), rng.randint(10, 25), rng.random(), rng.randint(3, 15), quirks]
+
+
+def pad(line):
+    # Pad a line with spaces to the width of the bulletin, like MDL does.
+    return line.ljust(linewidth) + '\n'
+
+
+def fmt(value):
+    # A single 3-character column. None is a blank column.
+    if value is None:
+        return '   '
+    return '%3d' % value
+
+
+def makeHeader(staname, mostype, cycle):
+    # ' KSTL   GFS MOS GUIDANCE    2/02/2014  1200 UTC'
+    left = ' %s   %s MOS GUIDANCE' % (staname, dictProducts[mostype]['model'])
+    rundate = '%d/%02d/%04d' % (cycle.month, cycle.day, cycle.year)
+    return pad('%s%s  %02d00 UTC' % (left.ljust(26), rundate.rjust(10), cycle.hour))
+
+
+def makeValues(rng, climate, mostype, cycle):
+    # Make up the forecast for one station and one cycle.
+    # Returns a dictionary of lists with one entry per forecast hour (None
+    # where the element isn't forecast) with keys 'XN', 'TMP', 'DPT', 'WSP',
+    # 'WDR', 'P12', 'Q12'.
+    meantemp, temprange, wetness, windiness, quirks = climate
+    hours = dictProducts[mostype]['hours']
+    dictValues = {'XN': [], 'TMP': [], 'DPT': [], 'WSP': [], 'WDR': [], 'P12': [], 'Q12': []}
+
+    # A front comes through at some point, and it gets wet and windy around then
+    fronthr = rng.randint(0, hours[-1])
+    for hr in hours:
+        valid = cycle + dt.timedelta(hours = hr)
+        # Warmest around 21Z, coolest around 12Z (central US)
+        diurnal = temprange / 2.0 * [-1, -0.5, 0.5, 1][valid.hour // 6 % 4]
+        trend = -8 if hr > fronthr else 0
+        temp = int(round(meantemp + diurnal + trend + rng.gauss(0, 2)))
+        dictValues['TMP'].append(temp)
+        dictValues['DPT'].append(temp - rng.randint(2, 15))
+        nearfront = max(0, 1 - abs(hr - fronthr) / 24.0)
+        dictValues['WSP'].append(max(0, int(round(windiness * (1 + nearfront) + rng.gauss(0, 2)))))
+        dictValues['WDR'].append(rng.randint(0, 36))
+
+        # X/N, P12, and Q12 are valid at 00Z and 12Z, starting with the first
+        # full 12-hour period (18 or 24 hours out). The MEX has them in every column.
+        if valid.hour in (0, 12) and hr >= 18:
+            # Max at 00Z, min at 12Z
+            if valid.hour == 0:
+                dictValues['XN'].append(temp + temprange // 3)
+            elif 'nomins' in quirks:
+                dictValues['XN'].append(999)
+            else:
+                dictValues['XN'].append(temp - temprange // 3)
+            pop = int(min(100, max(0, 100 * (wetness * 0.4 + nearfront * 0.8) + rng.gauss(0, 10))))
+            dictValues['P12'].append(pop)
+            if pop < 20:
+                dictValues['Q12'].append(0)
+            else:
+                dictValues['Q12'].append(min(6, int(pop / 100.0 * rng.randint(1, 6))))
+        else:
+            for wxelement in ['XN', 'P12', 'Q12']:
+                dictValues[wxelement].append(None)
+
+    # Sprinkle in missing values. In the MAV and MET, the 3-hourly columns
+    # run together, so a 999 there would be glued to the value before it.
+    sprinkle = ['XN', 'P12']
+    if mostype == 'MEX':
+        sprinkle = sprinkle + ['TMP', 'WSP']
+    for wxelement in sprinkle:
+        values = dictValues[wxelement]
+        for x in range(0, len(values)):
+            if (values[x] is not None) and (rng.random() < chanceMissingValue):
+                values[x] = 999
+
+    return dictValues
+
+
+def makeStationMAV(rng, staname, mostype, cycle):
+    # One station block of a MAV or MET bulletin.
+    climate = stationClimate(staname)
+    dictValues = makeValues(rng, climate, mostype, cycle)
+    hours = dictProducts[mostype]['hours']
+
+    def row(label, values):
+        return pad(' %s ' % label.ljust(3) + ''.join([fmt(v) for v in values]))
+
+    lines = [makeHeader(staname, mostype, cycle)]
+    # The date line has the month and day over the first column of each day,
+    # where there is room for it
+    dateline = ' DT '
+    for x in range(0, len(hours)):
+        valid = cycle + dt.timedelta(hours = hours[x])
+        if ((valid.hour < 3) or (x == 0)) and (len(dateline) <= 4 + 3 * x):
+            dateline = dateline.ljust(4 + 3 * x) + '/%s %3d' % (valid.strftime('%b').upper(), valid.day)
+    lines.append(pad(dateline[0:linewidth]))
+    lines.append(pad(' HR  ' + ''.join([' %02d' % (cycle + dt.timedelta(hours = hr)).hour for hr in hours])))
+    if 'noxn' not in climate[4]:
+        # The first extreme is a max for the 00Z and 06Z cycles, a min otherwise.
+        if cycle.hour in (0, 6):
+            lines.append(row('X/N', dictValues['XN']))
+        else:
+            lines.append(row('N/X', dictValues['XN']))
+    lines.append(row('TMP', dictValues['TMP']))
+    lines.append(row('DPT', dictValues['DPT']))
+    lines.append(pad(' CLD ' + ''.join([rng.choice([' CL', ' FW', ' SC', ' BK', ' OV']) for hr in hours])))
+    lines.append(row('WDR', dictValues['WDR']))
+    lines.append(row('WSP', dictValues['WSP']))
+    lines.append(row('P12', dictValues['P12']))
+    lines.append(row('Q12', dictValues['Q12']))
+    lines.append(row('CIG', [8 for hr in hours]))
+    lines.append(row('VIS', [7 for hr in hours]))
+    lines.append(pad(' OBV ' + ''.join(['  N' for hr in hours])))
+
+    return ''.join(lines)
+
+
+def makeStationMEX(rng, staname, mostype, cycle):
+    # One station block of a MEX bulletin. The columns come in pairs split by
+    # pipes, and X/N and P12 end with two climo values (999 999 if unknown,
+    # which prints as 999999 glued to the last forecast value).
+    climate = stationClimate(staname)
+    dictValues = makeValues(rng, climate, mostype, cycle)
+    hours = dictProducts[mostype]['hours']
+
+    def row(label, values, climo = None):
+        line = ' %s ' % label.ljust(3) + fmt(values[0]) + '|'
+        line = line + '|'.join(['%s %s' % (fmt(values[x]), fmt(values[x + 1])) for x in range(1, len(values), 2)])
+        if climo is None:
+            return pad(line)
+        # Not padded: the climo values run right up to the newline
+        return line + '%3d%3d\n' % climo
+
+    def climo(values):
+        if rng.random() < chanceNoClimo:
+            # yoinkFromMOS trims glued values by length, so keep the last
+            # forecast value to 2 digits when it is glued to 999999.
+            values[-1] = min(values[-1], 99)
+            return (999, 999)
+        return (rng.randint(10, 60), rng.randint(10, 60))
+
+    lines = [makeHeader(staname, mostype, cycle)]
+    lines.append(row('FHR', hours))
+    # Day of week and date of each day
+    days = [cycle + dt.timedelta(hours = hr) for hr in hours if (cycle.hour + hr) % 24 == 0]
+    dayline = '      ' + '| '.join(['%s %02d' % (day.strftime('%a').upper(), day.day) for day in days])
+    lines.append(pad(dayline[0:linewidth]))
+    if 'noxn' not in climate[4]:
+        # The first extreme is a max for the 00Z cycle, a min for the 12Z.
+        if cycle.hour == 0:
+            lines.append(row('X/N', dictValues['XN'], climo(dictValues['XN'])))
+        else:
+            lines.append(row('N/X', dictValues['XN'], climo(dictValues['XN'])))
+    lines.append(row('TMP', dictValues['TMP']))
+    lines.append(row('DPT', dictValues['DPT']))
+    lines.append(row('WND', dictValues['WSP']))
+    lines.append(row('P12', dictValues['P12'], climo(dictValues['P12'])))
+    # Q12 is only forecast out to 156 hours
+    lines.append(row('Q12', dictValues['Q12'][0:12] + [None, None, None]))
+
+    return ''.join(lines)
+
+
+def makeBulletin(mostype, stations, cycle, seed = 0):
+    # Returns one cycle of a MOS bulletin, as a really big string like the
+    # ones load_file returns.
+    #
+    # 'mostype' is MAV, MET, or MEX
+    # 'stations' is a list of station IDs
+    # 'cycle' is a datetime object (the model run)
+    # 'seed' picks a different (but repeatable) set of random numbers
+    mostype = mostype.upper()
+    rng = random.Random('%s %s %s' % (seed, mostype, cycle.strftime('%Y%m%d%H')))
+    if mostype == 'MEX':
+        makeStation = makeStationMEX
+    else:
+        makeStation = makeStationMAV
+
+    blocks = [makeStation(rng, staname, mostype, cycle) for staname in stations]
+    return separator.join(blocks) + separator
+
+
+def listCycles(mostype, lastcycle, numcycles):
+    # Returns the datetime objects of the last 'numcycles' cycles of 'mostype'
+    # up to and including 'lastcycle', oldest first. 'lastcycle' is rounded
+    # down to a cycle of that MOS type.
+    step = dictProducts[mostype.upper()]['step']
+    lastcycle = lastcycle.replace(hour = lastcycle.hour - lastcycle.hour % step, minute = 0, second = 0, microsecond = 0)
+    return [lastcycle - dt.timedelta(hours = step * x) for x in range(numcycles - 1, -1, -1)]
+
+
+def writeBulletins(mostypes, stations, lastcycle, numcycles, seed = 0):
+    # Write 'numcycles' cycles of each MOS type in 'mostypes' to the raw files
+    # directory, named the way GoGetFiles names them.
+    # Returns a list of the raw filenames.
+    dictDirNames = mosHelper.getDirNames()
+    if not os.path.isdir(dictDirNames['raw']):
+        os.makedirs(dictDirNames['raw'])
+
+    rawfiles = []
+    for mostype in mostypes:
+        for cycle in listCycles(mostype, lastcycle, numcycles):
+            filename = mosHelper.makeFilenames(mostype, '', cycle.year, cycle.month, cycle.day, '%02d' % cycle.hour)['raw']
+            fileobj = open(os.path.join(dictDirNames['raw'], filename), 'w')
+            fileobj.write(makeBulletin(mostype, stations, cycle, seed))
+            fileobj.close()
+            rawfiles.append(filename)
+
+    return rawfiles
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Write made-up MOS bulletins to the raw files directory.')
+    parser.add_argument('--stations', type = int, default = 10,
+                        help = 'number of stations in each bulletin (default: 10)')
+    parser.add_argument('--cycles', type = int, default = 1,
+                        help = 'number of cycles of each MOS type (default: 1)')
+    parser.add_argument('--mos', nargs = '+', default = ['MAV', 'MET', 'MEX'],
+                        help = 'MOS types (default: MAV MET MEX)')
+    parser.add_argument('--last', default = None,
+                        help = 'last cycle as YYYYMMDDHH (default: the latest 00Z or 12Z)')
+    parser.add_argument('--seed', type = int, default = 0,
+                        help = 'random seed (default: 0)')
+    args = parser.parse_args()
+
+    if args.last is None:
+        lastcycle = dt.datetime.utcnow()
+        lastcycle = lastcycle.replace(hour = lastcycle.hour - lastcycle.hour % 12)
+    else:
+        lastcycle = dt.datetime.strptime(args.last, '%Y%m%d%H')
+
+    for filename in writeBulletins(args.mos, makeStationIDs(args.stations), lastcycle, args.cycles, args.seed):
+        print(filename)